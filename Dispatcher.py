@@ -10,59 +10,148 @@
 #
 ############################################################
 
-import re
+import os
+import math
 import time
-import numpy as np
-from control import dome, sun_tracker
-from irradiance import pyrheliometer
+import socket
+import calendar
+import threading
+import drivers
+from control import domeguard
+from control.workers import DeviceWorker, DeviceProxy, URGENT, MONITOR, NORMAL, BACKGROUND
+from telemetry import metrics
+from telemetry.snapshot import TelemetryPoller
 
-dispatcher = None
+dispatcher  = None # The default ('socal') dispatcher
+dispatchers = {}   # name -> SoCalDispatcher, one per calibrator driven by this process
 
-def CreateDispatcher():
+def CreateDispatcher(name='socal', endpoints=None):
+    '''
+    Create, start polling and register a dispatcher. If SOCAL_WIRELOG is set,
+    the device traffic is recorded to that directory (see telemetry.wirelog).
+    If SOCAL_POINTING_LOG is set, the tracker pointing is logged to that file and
+    a pointing model fitted to it (see start_pointing_log). If SOCAL_PROFILE is
+    set, the dispatcher is profiled until shutdown and the profile dumped to
+    <SOCAL_PROFILE>/<name>-profile.json (see telemetry.profiling). If
+    SOCAL_RECOVERY_LOG is set, a hung tracker is recovered automatically and
+    every incident logged to that file (see start_recovery).
+
+    Args:
+        name:      (str) name to look it up with connect()
+        endpoints: (dict) per-device (host, port) overrides, see SoCalDispatcher
+    '''
     global dispatcher
+    if os.environ.get('SOCAL_WIRELOG'):
+        from telemetry import wirelog
+        wirelog.record(os.environ['SOCAL_WIRELOG'])
     # try:
-    dispatcher = SoCalDispatcher()
+    dispatchers[name] = SoCalDispatcher(endpoints=endpoints, name=name)
+    if os.environ.get('SOCAL_POINTING_LOG'):
+        dispatchers[name].start_pointing_log(os.environ['SOCAL_POINTING_LOG'])
+    if os.environ.get('SOCAL_PROFILE'):
+        os.makedirs(os.environ['SOCAL_PROFILE'], exist_ok=True)
+        dispatchers[name].start_profiling(path=os.path.join(os.environ['SOCAL_PROFILE'], '{}-profile.json'.format(name)))
+    dispatchers[name].start_polling()
+    if os.environ.get('SOCAL_RECOVERY_LOG'):
+        dispatchers[name].start_recovery(os.environ['SOCAL_RECOVERY_LOG'])
+    if name == 'socal':
+        dispatcher = dispatchers[name]
     # dispatcher = 'TESTTEST'
-    print('Connected to SoCalDispatcher.')
+    print('Connected to SoCalDispatcher {}.'.format(name))
     # except:
     #     print('Could not create SoCalDispatcher.')
+    return dispatchers[name]
 
-def connect():
-    if  dispatcher is None:
-        print('SoCalDispatcher is not active.')
+def connect(name='socal'):
+    if dispatchers.get(name) is None:
+        print('SoCalDispatcher {} is not active.'.format(name))
         # TODO: change to exception?
     else:
-        print('Connected to SoCalDispatcher.')
-    return dispatcher
+        print('Connected to SoCalDispatcher {}.'.format(name))
+    return dispatchers.get(name)
 
 class SoCalDispatcher(object):
 
-    def __init__(self):
+    # Default seconds between background polls of each device
+    POLL_CADENCE = {'dome': 1.0, 'tracker': 1.0, 'pyrheliometer': 1.0,
+                    'guiding': 0.5} # Sun sensor offsets, only read while the tracker guides
+
+    # A polled value older than this many poll periods of its device (and at least
+    # MIN_MAX_AGE seconds) is stale: properties read the device instead (see _polled),
+    # giving up after LIVE_TIMEOUT seconds
+    MAX_AGE_POLLS = 5
+    MIN_MAX_AGE   = 5.
+    LIVE_TIMEOUT  = 5.
+
+    # Seconds shutdown() waits for each device worker to finish its queued requests
+    SHUTDOWN_TIMEOUT = 10.
+
+    # Seconds between full dome status reads; the polls in between read the short status
+    DOME_FULL_CADENCE = 30.0
+
+    # Seconds between pointing log rows while the tracker is locked on the Sun (see start_pointing_log)
+    POINTING_LOG_INTERVAL = 60.
+
+    # Seconds between pyrheliometer polls while an exposure is being metered
+    EXPOSURE_CADENCE = 0.2
+
+    # SNR per sqrt(J/m^2) of flux accumulated in an exposure (see irradiance.exposure_meter);
+    # None until calibrated: no SNR estimates
+    EXPOSURE_SNR_COEFFICIENT = None
+
+    # Tracker recovery (see start_recovery): the watchdog climbs the ladder once the
+    # tracker polls are TRACKER_STALE_AFTER seconds stale, and after a failed attempt
+    # waits RECOVERY_RETRY before the next; each step (and the check after it) has its own timeout [s]
+    TRACKER_STALE_AFTER = 30.
+    RECOVERY_RETRY      = 300.
+    RECOVERY_TIMEOUTS   = {'reconnect': 15., 'power_cycle': 120., 'reinit': 60., 'check': 5.}
+    RELAY_OFF_TIME      = 10.  # [s] tracker kept unpowered in a power cycle
+    TRACKER_BOOT_TIME   = 30.  # [s] from power on until the tracker answers
+    TRACKER_CLOCK_TOLERANCE = 5. # [s] tracker clock error beyond which it is re-initialised
+
+    # How close [deg] the tracker must be to HOME_ALT/HOME_AZ to count as stowed
+    HOME_TOLERANCE = 0.1
+
+    def __init__(self, endpoints=None, name='socal'):
+        '''
+        Args:
+            endpoints: (dict) device -> (host, port), e.g. {'dome': ('192.168.23.244', '4030')};
+                       devices not listed use the defaults of their driver module
+            name:      (str) name of this calibrator, for logs and worker threads
+        '''
+        self.name      = name
+        self.endpoints = dict(endpoints or {})
+        self._reads    = threading.local() # .snapshot_only: see from_snapshot
+
+        # Device backends are imported by the driver registry on first use.
+        # Each connected device is owned by its own worker thread (see _own)
+        self.workers = {}
 
         # Try to open a connection to the Dome
         try:
-            self.dome = dome.DougDimmadome()
+            self.dome = self._own('dome', self._create('dome'))
             self._dome_online    = self.dome.ws.connected
         except Exception as e:
-            print('Unable to connect to DomeGuard at {}/{}'.format(dome.DOME_IP, dome.DOME_PORT))
+            print('Unable to connect to DomeGuard at {}/{}'.format(*self._endpoint('dome', 'DOME_IP', 'DOME_PORT')))
             print(repr(e))
             self._dome_online = False
 
         # Try to open a connection to the tracker
         try:
-            self.tracker = sun_tracker.EKOSunTracker()
+            self.tracker = self._own('tracker', self._create('tracker'))
             self._tracker_online = True
         except:
-            print('Unable to connect to Lantronix UDS2100 (EKO Sun Tracker) at {}/'.format(sun_tracker.TCP_IP, sun_tracker.TCP_PORT))
+            print('Unable to connect to Lantronix UDS2100 (EKO Sun Tracker) at {}/{}'.format(*self._endpoint('tracker', 'TCP_IP', 'TCP_PORT')))
+            self.tracker = None # Until reconnect_tracker, e.g. once its relay is switched on
             self._tracker_online = False
 
         # Try to open a connection to the pyrheliometer
         try:
-            self.pyr = pyrheliometer.EKOPyrheliometer()
+            self.pyr = self._own('pyrheliometer', self._create('pyrheliometer'))
             self.poll_pyr()
             self._pyrheliometer_online = True
         except:
-            print('Unable to connect to Lantronix UDS1100-IAP (EKO MS-57 Pyrheliometer) at {}/'.format(pyrheliometer.TCP_IP, pyrheliometer.TCP_PORT))
+            print('Unable to connect to Lantronix UDS1100-IAP (EKO MS-57 Pyrheliometer) at {}/{}'.format(*self._endpoint('pyrheliometer', 'TCP_IP', 'TCP_PORT')))
             self._pyrheliometer_online = False
         
         # KTL keywords with hardcoded default values
@@ -70,6 +159,120 @@ class SoCalDispatcher(object):
         self._alt_to_slew = None
         self._az_to_slew  = None
 
+        # Background telemetry poller (see start_polling)
+        self.poller = None
+
+        # Local HTTP endpoint for the command metrics (see serve_metrics)
+        self.metrics_server = None
+
+        # Time-series archive of everything polled (see start_archive)
+        self.archive = None
+
+        # Streaming join of dome, guiding and irradiance into the per-second
+        # good-light mask (see start_goodlight)
+        self.goodlight = None
+
+        # Emergency dome close in flight, if any (see emergency_close)
+        self._emergency = None
+
+        # Last dome status (the full one, with the short ones merged in since)
+        # and when the full status was read (see poll_dome)
+        self._dome_full    = None
+        self._dome_full_at = None
+
+        # Sun sensor offsets sampled while guiding, for on_sun (see start_polling)
+        self.guiding = None
+
+        # Log of calculated vs. corrected tracker positions and the pointing model
+        # fitted to it, applied before acquiring the Sun (see start_pointing_log)
+        self.pointing_log   = None
+        self.pointing_model = None
+        self._pointing_fit  = 0    # Rows logged (since start_pointing_log) when the model was fitted
+        self._pointing_at   = None # When the last row was logged
+
+        # Profiler accounting device calls and property reads, if profiling (see start_profiling)
+        self.profiler = None
+
+        # Recovery ladder for a hung tracker and the watchdog that runs it (see start_recovery);
+        # the tracker is only watched while its relay is on (see set_tracker_power)
+        self.recovery       = None
+        self._watchdog      = None # (stop Event, thread)
+        self._tracker_power = 'on'
+        # Every reconnect or power action on the tracker takes a new generation. One that
+        # a recovery step abandoned at its timeout may still be running: once a later
+        # action has started, it neither publishes its worker nor switches the relay
+        self._tracker_generation = 0
+        self._tracker_lock  = threading.Lock() # Generation and the published tracker worker
+        self._relay_lock    = threading.Lock() # Generation check and the relay switch
+
+        # Integrates the irradiance over exposures, and the pyrheliometer cadence
+        # to go back to once none is open (see start_exposure)
+        self.exposure_meter = None
+        self._pyr_cadence   = None
+
+    def _own(self, device, driver):
+        '''
+        Hand a connected driver to a dedicated worker thread. The returned proxy
+        runs every driver method on that thread, so requests to one device are
+        strictly ordered while different devices are served in parallel.
+        '''
+        worker = DeviceWorker('{}-{}'.format(self.name, device), driver)
+        self.workers[device] = worker
+        return DeviceProxy(worker)
+
+    def submit(self, device, fn, *args, priority=NORMAL, **kwargs):
+        '''
+        Queue work on a device's worker thread without waiting for it
+
+        Args:
+            device:   (str) 'dome', 'tracker' or 'pyrheliometer'
+            fn:       name of a driver method (e.g. 'get_datetime') or any callable,
+                      e.g. `dispatcher.open_dome`, to run on that device's thread
+            priority: URGENT, MONITOR, NORMAL or BACKGROUND (see control.workers)
+
+        Returns:
+            future: (concurrent.futures.Future) with the result of the call
+        '''
+        assert device in self.workers, 'No worker for {}, is it online?'.format(device)
+        if isinstance(fn, str):
+            fn = getattr(self.workers[device].driver, fn)
+        return self.workers[device].submit(fn, *args, priority=priority, **kwargs)
+
+    def call(self, device, fn, *args, timeout=None, priority=NORMAL, **kwargs):
+        ''' Same as submit(), but wait for and return the result '''
+        return self.submit(device, fn, *args, priority=priority, **kwargs).result(timeout)
+
+    def shutdown(self):
+        ''' Stop background polling and the device worker threads '''
+        self.stop_recovery()
+        self.stop_polling()
+        self.stop_profiling()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+        for worker in self.workers.values():
+            worker.shutdown(self.SHUTDOWN_TIMEOUT)
+
+    def _create(self, device):
+        ''' Connect the driver of a device, at this instance's endpoint for it if one is configured '''
+        if device in self.endpoints:
+            host, port = self.endpoints[device]
+            return drivers.create(device, host=host, port=port, instance=self.name)
+        return drivers.create(device, instance=self.name)
+
+    def _endpoint(self, device, ip, port):
+        '''
+        The IP/port of a device: configured for this instance, or the default of its
+        driver module ('unknown' if it has none, e.g. a wire log or stand-in driver)
+        '''
+        if device in self.endpoints:
+            return tuple(self.endpoints[device])
+        try:
+            module = drivers.load_module(device)
+            return getattr(module, ip), getattr(module, port)
+        except (ImportError, AttributeError):
+            return 'unknown', 'unknown'
+
     ############################### EKO Sun Tracker Keywords ##############################
     @property
     def is_guiding(self):
@@ -77,7 +280,7 @@ class SoCalDispatcher(object):
 
     @property
     def tracking_mode(self):
-        return self.tracker.get_tracking_mode()
+        return self._polled('tracking_mode', 'tracker', lambda: self.tracker.get_tracking_mode())
 
     @tracking_mode.setter
     def tracking_mode(self, mode):
@@ -91,6 +294,7 @@ class SoCalDispatcher(object):
         '''
         assert str(mode) in ['0', '1', '2', '3']
         self.tracker.set_tracking_mode(str(mode))
+        self._refresh('tracker')
 
     @property
     def is_slewing(self):
@@ -109,6 +313,7 @@ class SoCalDispatcher(object):
         if (not self.az_to_slew is None) and (not self.alt_to_slew is None):
             self.is_slewing = True
             self.tracker.slew(self.alt_to_slew, self.az_to_slew)
+            self._refresh('tracker')
             # Reset slew staging
             self.is_slewing = False
             self.alt_to_slew = None
@@ -153,32 +358,28 @@ class SoCalDispatcher(object):
         '''
         Request the current pointing altitude from the Sun tracker
         '''
-        alt, az = self.tracker.get_corrected_position()
-        return alt
+        return self._polled('current_alt', 'tracker', lambda: self.tracker.get_corrected_position()[0])
 
     @property
     def current_az(self):
         '''
         Request the current pointing azimuth from the Sun tracker
         '''
-        alt, az = self.tracker.get_corrected_position()
-        return az
+        return self._polled('current_az', 'tracker', lambda: self.tracker.get_corrected_position()[1])
 
     @property
     def pred_sun_alt(self):
         '''
         Request the calculated current altitude of the Sun from the Sun tracker
         '''
-        alt, az = self.tracker.get_calculated_position()
-        return alt
+        return self._polled('pred_sun_alt', 'tracker', lambda: self.tracker.get_calculated_position()[0])
         
     @property
     def pred_sun_az(self):
         '''
         Request the calculated current altitude of the Sun from the Sun Tracker
         '''
-        alt, az = self.tracker.get_calculated_position()
-        return az
+        return self._polled('pred_sun_az', 'tracker', lambda: self.tracker.get_calculated_position()[1])
 
     @property
     def guiding_offset_alt(self):
@@ -187,8 +388,7 @@ class SoCalDispatcher(object):
         on the Sun Tracker. This is the equal to the difference between 
         `current_alt` and `pred_sun_alt`
         '''
-        az_offset, alt_offset = self.tracker.get_sun_sensor_offset()
-        return alt_offset
+        return self._polled('guiding_offset_alt', 'tracker', lambda: self.tracker.get_sun_sensor_offset()[1])
 
     @property
     def guiding_offset_az(self):
@@ -197,8 +397,7 @@ class SoCalDispatcher(object):
         on the Sun Tracker. This is the equal to the difference between 
         `current_az` and `pred_sun_az`
         '''
-        az_offset, alt_offset = self.tracker.get_sun_sensor_offset()
-        return az_offset
+        return self._polled('guiding_offset_az', 'tracker', lambda: self.tracker.get_sun_sensor_offset()[0])
 
     @property
     def datetime(self):
@@ -230,24 +429,365 @@ class SoCalDispatcher(object):
         '''
         return self.tracker.get_firmware_version()
    
+    @property
+    def is_home(self):
+        '''
+        Determine if the tracker is in manual mode and pointed at its 'home' position
+        (False if it was never connected)
+        '''
+        return self.tracker is not None and self.tracking_mode == '0' \
+                and abs(self.current_alt - self.tracker.HOME_ALT) < self.HOME_TOLERANCE \
+                and abs(self.current_az - self.tracker.HOME_AZ) < self.HOME_TOLERANCE
+
+    def stow_tracker(self):
+        '''
+        Switch the tracker to manual mode and slew it to its 'home' position
+        '''
+        assert not self.is_slewing, 'Please wait until current slew is complete before stowing.'
+        self.is_slewing = True
+        try:
+            self.tracker.slew(self.tracker.HOME_ALT, self.tracker.HOME_AZ)
+        finally:
+            self.is_slewing = False
+        self._refresh('tracker')
+
     # @property
     def on_sun(self, THRESHOLD=0.1):
         '''
         Determine if the tracker is guiding and aligned with the Sun.
-        If so, return True, otherwise return False
+        If so, return True, otherwise return False. While polling, this is
+        decided from the sun sensor offsets of the last GuidingMonitor window
+        (most samples, and the median, within THRESHOLD), otherwise (or until
+        there are enough samples) from the current offsets.
 
         Parameters:
             THRESHOLD: amount (in deg) to require alt/az guider offset be within
         '''
-        return self.is_guiding \
-                and (self.guiding_offset_alt < THRESHOLD) and (self.guiding_offset_az < THRESHOLD)
+        if not self.is_guiding:
+            return False
+        if self.guiding is not None:
+            locked = self.guiding.locked(now=time.time(), threshold=THRESHOLD)
+            if locked is not None:
+                return locked
+        return abs(self.guiding_offset_alt) < THRESHOLD and abs(self.guiding_offset_az) < THRESHOLD
+
+    def guiding_stats(self, window=None):
+        '''
+        Jitter statistics of the sun sensor offsets over the last `window`
+        seconds (RMS, drift, fraction in lock, ...), see GuidingMonitor.stats
+        '''
+        if self.guiding is None:
+            return {'samples': 0, 'locked': None}
+        return self.guiding.stats(window, now=time.time())
+
+    def poll_tracker(self):
+        '''
+        Poll the tracker pointing and prediction for the background poller. The sun
+        sensor offsets are the guiding device's (see poll_guiding)
+
+        Returns: (dict) keyword values
+        '''
+        mode = self.tracker.get_tracking_mode()
+        current_alt, current_az = self.tracker.get_corrected_position()
+        pred_alt, pred_az = self.tracker.get_calculated_position()
+        return {'tracking_mode': mode,
+                'current_alt'  : current_alt,
+                'current_az'   : current_az,
+                'pred_sun_alt' : pred_alt,
+                'pred_sun_az'  : pred_az,
+               }
+
+    ################################### POINTING MODEL ###################################
+    def start_pointing_log(self, path):
+        '''
+        Log the calculated (CR) and corrected (MR) tracker positions and the sun
+        sensor offsets to `path` (CSV) every POINTING_LOG_INTERVAL while the
+        tracker is locked on the Sun, and fit the pointing model to the log
+        (see control.pointing_model), which acquire_sun then applies
+        '''
+        from control import pointing_model
+        self.pointing_log = pointing_model.PointingLog(path)
+        self.fit_pointing_model()
+
+    def fit_pointing_model(self):
+        '''
+        Refit the pointing model to the whole pointing log
+
+        Returns: (PointingModel) or None if there are not enough samples yet
+        '''
+        from control import pointing_model
+        data = self.pointing_log.load()
+        model = pointing_model.fit(data)
+        self._pointing_fit = self.pointing_log.added
+        if model is not None:
+            self.pointing_model = model
+            print('Fitted {}'.format(model))
+        return model
+
+    def _log_pointing(self, now, offset_alt, offset_az):
+        '''
+        From a guiding poll: log a row, with the positions of the latest tracker
+        poll, if locked on the Sun and one is due
+        '''
+        if self.pointing_log is None:
+            return
+        if self._pointing_at is not None and now - self._pointing_at < self.POINTING_LOG_INTERVAL:
+            return
+        if not self.guiding.locked(now=now):
+            return
+        snapshot = self.poller.snapshot
+        positions = [snapshot.get(key) for key in ['pred_sun_alt', 'pred_sun_az', 'current_alt', 'current_az']]
+        if None in positions:
+            return
+        self._pointing_at = now
+        self.pointing_log.add(now, *positions, offset_alt, offset_az)
+
+    def acquire_sun(self):
+        '''
+        Start guiding on the Sun (tracking mode 3). With a pointing model, first
+        slew (manual mode) to the calculated position plus the model's correction,
+        so the sun sensor starts close to the Sun. The model is refitted first
+        if rows were logged since the last fit.
+        '''
+        if self.pointing_log is not None and self.pointing_log.added > self._pointing_fit:
+            self.fit_pointing_model()
+        if self.pointing_model is not None and self.tracking_mode != '3':
+            alt, az = self.tracker.get_calculated_position()
+            dalt, daz = self.pointing_model.correction(alt, az)
+            print('Pre-slewing by the pointing model: {:+.3f} deg alt, {:+.3f} deg az'.format(dalt, daz))
+            assert not self.is_slewing, 'Please wait until current slew is complete before acquiring the Sun.'
+            self.is_slewing = True
+            try:
+                self.tracker.slew(alt + dalt, az + daz)
+            finally:
+                self.is_slewing = False
+        self.tracking_mode = '3'
+
+    def poll_guiding(self):
+        '''
+        Sample the sun sensor offsets (one RO for both axes) into the guiding
+        monitor while the tracker guides (mode '3' in the latest tracker poll);
+        otherwise do nothing, and start over at the next guiding session
 
+        Returns: (dict) keyword values
+        '''
+        if self.poller.snapshot.get('tracking_mode') != '3':
+            if len(self.guiding):
+                self.guiding.clear()
+            return {}
+        offset_az, offset_alt = self.tracker.get_sun_sensor_offset()
+        now = time.time()
+        self.guiding.add(now, offset_alt, offset_az)
+        self._log_pointing(now, offset_alt, offset_az)
+        return {'guiding_offset_alt': offset_alt,
+                'guiding_offset_az' : offset_az,
+               }
+
+    ###################################### RECOVERY ######################################
+    def reconnect_tracker(self, generation=None):
+        '''
+        Connect to the tracker again on a new worker, then drop the old
+        connection and its worker, which may be stuck on a read that never returns.
+        The new connection is dropped instead if a later reconnect or power action
+        started meanwhile (see _tracker_action).
+        '''
+        generation = self._tracker_action(generation)
+        self._tracker_online = False
+        driver = self._create('tracker') # May hang on a dead tracker
+        with self._tracker_lock:
+            current = not self._superseded(generation)
+            if current:
+                old = self.workers.get('tracker')
+                self.tracker = self._own('tracker', driver) # Requests go to the new worker from here
+        if not current:
+            self._close_tracker(driver)
+            raise RuntimeError('Tracker reconnect superseded by a later reconnect or power action')
+        if old is None:
+            self._tracker_online = True
+            return
+        self.workers['tracker'].profiler = old.profiler
+        old.cancel_pending(URGENT)
+        transport = getattr(old.driver, 'socket', None)
+        if transport is not None:
+            try:
+                transport.shutdown(socket.SHUT_RDWR) # Wakes up a read blocked on it
+            except (OSError, AttributeError):
+                pass
+        self._close_tracker(old.driver)
+        old.shutdown(timeout=0)
+        self._tracker_online = True
+
+    def _close_tracker(self, driver):
+        try:
+            driver.close_connection()
+        except Exception as e:
+            print('Closing the tracker connection failed: {}'.format(repr(e)))
+
+    def _tracker_action(self, generation=None):
+        ''' Generation of a tracker reconnect or power action: a new one, unless continuing `generation` '''
+        with self._tracker_lock:
+            if generation is None:
+                self._tracker_generation += 1
+                generation = self._tracker_generation
+            return generation
+
+    def _superseded(self, generation):
+        ''' A later tracker reconnect or power action has started '''
+        return generation != self._tracker_generation
+
+    def initialize_tracker(self, mode=None):
+        '''
+        Set the tracker clock to the current UTC time, its location to the site,
+        and its tracking mode (default: the last one polled, else manual)
+        '''
+        from control.ephemeris import SITE_LAT, SITE_LON
+        if mode is None:
+            mode = self.poller.snapshot.get('tracking_mode', '0') if self.poller is not None else '0'
+        now = time.gmtime()
+        self.tracker.set_datetime(time.strftime('%Y-%m-%d', now), time.strftime('%H:%M:%S', now))
+        self.tracker.set_location(SITE_LAT, SITE_LON)
+        self.tracker.set_tracking_mode(mode)
+        self._refresh('tracker')
+
+    def power_cycle_tracker(self, generation=None):
+        ''' Switch the tracker off and on again through the DomeGuard output relay, then reconnect '''
+        generation = self._tracker_action(generation)
+        self.set_tracker_power('off', generation=generation)
+        time.sleep(self.RELAY_OFF_TIME)
+        self.set_tracker_power('on', initialize=False, generation=generation)
+
+    def set_tracker_power(self, state, initialize=True, generation=None):
+        '''
+        Switch the tracker's power on the DomeGuard output relay (ch1). Powering
+        on waits TRACKER_BOOT_TIME, reconnects and, if `initialize`, sets the
+        clock, location and manual mode (see initialize_tracker); tracker_power
+        is 'booting' until then.
+
+        Args:
+            state:      'on' or 'off'
+            generation: of the power cycle this is part of (see _tracker_action)
+        '''
+        assert state in ['on', 'off'], 'Tracker power must be on or off, not {}'.format(state)
+        generation = self._tracker_action(generation)
+        with self._relay_lock:
+            if self._superseded(generation):
+                raise RuntimeError('Tracker power {} superseded by a later reconnect or power action'.format(state))
+            self.dome.set_ch1(state)
+            self._tracker_power = 'off' if state == 'off' else 'booting'
+        if state == 'off':
+            self._tracker_online = False
+            return
+        try:
+            time.sleep(self.TRACKER_BOOT_TIME)
+            self.reconnect_tracker(generation)
+            if initialize:
+                self.initialize_tracker('0')
+        finally:
+            with self._relay_lock:
+                if not self._superseded(generation):
+                    self._tracker_power = 'on' # The relay is on, whether or not the tracker came back
+
+    @property
+    def tracker_power(self):
+        ''' The tracker relay: 'on', 'off', or 'booting' while powering on (see set_tracker_power) '''
+        return self._tracker_power
+
+    def tracker_answers(self):
+        ''' True if the tracker replies to a clock read '''
+        return self.call('tracker', 'get_datetime', priority=URGENT) is not None
+
+    def tracker_healthy(self):
+        ''' True if the tracker replies, with its clock within TRACKER_CLOCK_TOLERANCE of ours '''
+        reply = self.call('tracker', 'get_datetime', priority=URGENT)
+        if reply is None:
+            return False
+        clock = calendar.timegm(time.strptime(reply.replace('T', ' '), '%Y-%m-%d %H:%M:%S'))
+        return abs(clock - time.time()) <= self.TRACKER_CLOCK_TOLERANCE
+
+    def recover_tracker(self, reason, detected=None, log_path=None):
+        '''
+        Bring a tracker that stopped answering back: reconnect the socket, then
+        (if it still does not answer) power-cycle it on the relay, then set its
+        clock, location and mode again, until it answers with the right time.
+        Each step has a timeout (RECOVERY_TIMEOUTS).
+
+        Args:
+            reason:   (str) what gave the outage away, for the incident log
+            detected: (float) unix time the outage started (default now)
+            log_path: (str) JSON-lines incident log, if the ladder is not set up yet
+
+        Returns: (dict) the incident, see control.recovery.RecoveryLadder.recover
+        '''
+        if self.recovery is None:
+            from control.recovery import RecoveryLadder, Step
+            timeouts = self.RECOVERY_TIMEOUTS
+            self.recovery = RecoveryLadder('tracker',
+                                           [Step('reconnect', self.reconnect_tracker, timeouts['reconnect']),
+                                            Step('power_cycle', self.power_cycle_tracker, timeouts['power_cycle'],
+                                                 needed=lambda: not self._answers()),
+                                            Step('reinit', self.initialize_tracker, timeouts['reinit'])],
+                                           check=self.tracker_healthy, check_timeout=timeouts['check'],
+                                           log_path=log_path)
+        incident = self.recovery.recover(reason, detected)
+        if incident['recovered'] and self.poller is not None and 'tracker' in self.poller.devices:
+            self.poller.poll_now('tracker')
+        return incident
+
+    def _answers(self):
+        try:
+            return self.tracker_answers()
+        except Exception:
+            return False
+
+    def start_recovery(self, log_path=None, stale_after=None):
+        '''
+        Watch the tracker polls and recover the tracker (see recover_tracker)
+        when they have been stale for `stale_after` seconds (default
+        TRACKER_STALE_AFTER), logging every incident to `log_path` (JSON lines).
+        Starts polling if needed. Incidents: `dispatcher.recovery.incidents`.
+        '''
+        if self._watchdog is not None:
+            return
+        self.start_polling()
+        if self.recovery is not None and log_path is not None:
+            self.recovery.log_path = log_path
+        stop = threading.Event()
+        thread = threading.Thread(target=self._watch_tracker, args=(stop, stale_after or self.TRACKER_STALE_AFTER, log_path),
+                                  name='{}-watchdog'.format(self.name), daemon=True)
+        self._watchdog = (stop, thread)
+        thread.start()
+
+    def stop_recovery(self):
+        ''' Stop watching the tracker (a recovery in progress runs to its end) '''
+        if self._watchdog is not None:
+            stop, thread = self._watchdog
+            stop.set()
+            self._watchdog = None
+
+    def _watch_tracker(self, stop, stale_after, log_path):
+        while not stop.wait(1.):
+            poller = self.poller
+            if self._tracker_power != 'on' or poller is None or 'tracker' not in poller.devices:
+                continue
+            age = poller.snapshot.age('tracking_mode')
+            if age < stale_after:
+                continue
+            detected = None if math.isinf(age) else time.time() - age
+            try:
+                incident = self.recover_tracker('tracker polls stale for {:.0f} s'.format(age), detected, log_path)
+            except Exception as e:
+                print('Tracker recovery failed: {}'.format(repr(e)))
+                incident = {'recovered': False}
+            # Give the polls time to catch up after a recovery; back off after a failed one
+            stop.wait(stale_after if incident['recovered'] else self.RECOVERY_RETRY)
 
     #################################### PYRHELIOMETER ####################################
 
     def poll_pyr(self):
         '''
         Poll the pyrheliometer and save the resulting values
+
+        Returns: (dict) keyword values
         '''
 
         min_irrad, max_irrad, sensitivity, out_voltage, solar_irrad, temperature = self.pyr.poll()
@@ -255,6 +795,45 @@ class SoCalDispatcher(object):
         self.sensitivity = sensitivity
         self.outputvolt  = out_voltage
         self.heater_temp = temperature
+        return {'irradiance' : solar_irrad,
+                'sensitivity': sensitivity,
+                'outputvolt' : out_voltage,
+                'heater_temp': temperature,
+               }
+
+    def start_exposure(self, exposure_id):
+        '''
+        Start integrating the irradiance for an exposure. While any exposure is
+        open, the pyrheliometer is polled every EXPOSURE_CADENCE seconds.
+        Needs the background poller (start_polling) for the samples.
+        '''
+        if self.exposure_meter is None:
+            from irradiance.exposure_meter import ExposureMeter
+            self.exposure_meter = ExposureMeter(snr_coefficient=self.EXPOSURE_SNR_COEFFICIENT)
+            if self.poller is not None:
+                self.poller.subscribe(self.exposure_meter.on_telemetry)
+        self.exposure_meter.start(exposure_id)
+        if self._pyr_cadence is None and self.poller is not None and 'pyrheliometer' in self.poller.devices:
+            # First open exposure: poll faster (which also polls right away) until the last one stops
+            self._pyr_cadence = self.poller.cadence('pyrheliometer')
+            self.poller.set_cadence('pyrheliometer', min(self._pyr_cadence, self.EXPOSURE_CADENCE))
+
+    def stop_exposure(self, exposure_id):
+        '''
+        Stop integrating the irradiance for an exposure
+
+        Returns: (dict) accumulated flux, flux-weighted midpoint, etc. (see ExposureMeter.result)
+        '''
+        result = self.exposure_meter.stop(exposure_id)
+        if not self.exposure_meter.open and self._pyr_cadence is not None:
+            if self.poller is not None and 'pyrheliometer' in self.poller.devices:
+                self.poller.set_cadence('pyrheliometer', self._pyr_cadence)
+            self._pyr_cadence = None
+        return result
+
+    def exposure(self, exposure_id):
+        ''' Flux accumulated so far in an open exposure (or in total, if closed), see ExposureMeter.result '''
+        return self.exposure_meter.result(exposure_id)
 
     @property	
     def clear_sky(self):
@@ -263,7 +842,7 @@ class SoCalDispatcher(object):
 
     @property
     def irradiance(self):
-        return self._irradiance
+        return self._polled('irradiance', 'pyrheliometer', lambda: self.poll_pyr()['irradiance'])
 
     @irradiance.setter
     def irradiance(self, irrad):
@@ -271,7 +850,7 @@ class SoCalDispatcher(object):
 
     @property
     def outputvolt(self):
-        return self._outvoltage
+        return self._outputvolt
 
     @outputvolt.setter
     def outputvolt(self, voltage):
@@ -294,20 +873,35 @@ class SoCalDispatcher(object):
         self._sensitivity = sens
 
     ######################################## DOME ########################################
+    @property
+    def dome_status(self):
+        return self._polled('dome_status', 'dome', self.get_dome_status)
+
     @property
     def is_domeopen(self):
-        dome_status = self.get_dome_status()
-        return dome_status['Status'] == 'Open'
+        return self.dome_status['Status'] == 'Open'
 
     @property
     def is_domeclosed(self):
-        dome_status = self.get_dome_status()
-        return dome_status['Status'] == 'Closed'
+        return self.dome_status['Status'] == 'Closed'
 
     @property
     def is_dome_in_motion(self):
-        dome_status = self.get_dome_status()
-        return not (dome_status['Motor']['current'] == 0)
+        return not (self.dome_status['Motor']['current'] == 0)
+
+    def poll_dome(self):
+        '''
+        Poll the dome status for the background poller: the short status every
+        time, merged into the full status, which is re-read every DOME_FULL_CADENCE
+
+        Returns: (dict) keyword values
+        '''
+        now = time.monotonic()
+        if self._dome_full is None or now - self._dome_full_at >= self.DOME_FULL_CADENCE:
+            self._dome_full, self._dome_full_at = self.get_dome_status(), now
+            return {'dome_status': self._dome_full}
+        self._dome_full = domeguard.merge_status(self._dome_full, self.get_dome_status(short=True))
+        return {'dome_status': self._dome_full}
 
     def monitor_dome_in_motion(self, direction):
         ''''
@@ -317,7 +911,7 @@ class SoCalDispatcher(object):
         Returns: dome_status (dict)
         '''
         # TODO: If received an error in get_dome_status need to throw an exception to halt the motion
-        dome_status = self.get_dome_status()
+        dome_status = self.get_dome_status(short=True)
         motor_status = dome_status['Motor']
         time_in_waiting = 0
         while motor_status['status'] == 'Stopped':
@@ -326,7 +920,7 @@ class SoCalDispatcher(object):
                 self.dome.stop()
                 return
             time.sleep(1)
-            motor_status = self.get_dome_status()['Motor']
+            motor_status = self.get_dome_status(short=True)['Motor']
             time_in_waiting += 1
 
         assert motor_status['status'] == direction, 'Dome is {} but desired direction is {}'.format(motor_status['status'], direction)
@@ -339,7 +933,7 @@ class SoCalDispatcher(object):
             print('Dome move in progress: {}... motor current is {} A'.format(motor_status['status'], motor_status['current']))
             if motor_status['current'] == 0:
                 time_current_zero += 1
-            dome_status = self.get_dome_status()
+            dome_status = self.get_dome_status(short=True)
             motor_status = dome_status['Motor']
         print('Dome move complete.')
         return dome_status
@@ -350,7 +944,7 @@ class SoCalDispatcher(object):
         '''
         
         print('Opening SoCal dome...')
-        if self.is_domeopen:
+        if self.get_dome_status(short=True)['Status'] == 'Open':
             print('Dome is already open.')
             return
 
@@ -359,6 +953,7 @@ class SoCalDispatcher(object):
 
         # Monitor the dome status as it opens
         dome_status = self.monitor_dome_in_motion('Opening')
+        self._refresh('dome')
 
         # When that concludes, confirm the dome opened
         if self.is_domeopen and not self.is_domeclosed:
@@ -379,15 +974,21 @@ class SoCalDispatcher(object):
         '''
         
         print('Closing SoCal dome...')
-        if self.is_domeclosed:
+        status = self.get_dome_status(short=True)['Status']
+        if status == 'Closed':
             print('Dome is already closed.')
             return
 
-        response = self.dome.close()
-        assert len(response) == 1 and (response[0] == self.dome.possible_responses[0]), "CANNOT CLOSE: {}".format(response)
+        if status == 'Closing':
+            # e.g. after an emergency close, just follow the move
+            print('Dome is already closing.')
+        else:
+            response = self.dome.close()
+            assert len(response) == 1 and (response[0] == self.dome.possible_responses[0]), "CANNOT CLOSE: {}".format(response)
  
         # Monitor the dome status as it closes
         dome_status = self.monitor_dome_in_motion('Closing')
+        self._refresh('dome')
 
         # When that concludes, confirm the dome closed
         if self.is_domeclosed and not self.is_domeopen:
@@ -404,77 +1005,310 @@ class SoCalDispatcher(object):
             print("     Likely did not wait long enough before checking if dome started moving.")
 
 
+    def emergency_close(self, reason='WXSAFE', signaled=None):
+        '''
+        Close the dome ahead of everything else: queued background polls are
+        dropped on every device (the dome's own safety poll is kept) and the
+        close command goes to the front of the dome's queue, so it only waits
+        for the request already on the wire.
+        Does not wait for the dome to move; SoCal follows it through ENCSTATUS.
+
+        Args:
+            reason:   (str) what made it unsafe, e.g. 'WXSAFE' or 'rain'
+            signaled: (float) time.monotonic() of the unsafe signal, for the
+                      socal_emergency_close_latency_seconds metric (default: now)
+
+        Returns:
+            future: (concurrent.futures.Future) with the DomeGuard response
+        '''
+        signaled = time.monotonic() if signaled is None else signaled
+        emergency = self._emergency
+        if emergency is not None and not emergency.done():
+            return emergency
+        for worker in self.workers.values():
+            worker.cancel_pending(BACKGROUND)
+        self._emergency = self.submit('dome', self._emergency_close, reason, signaled, priority=URGENT)
+        return self._emergency
+
+    def _emergency_close(self, reason, signaled):
+        # Runs on the dome's worker thread
+        latency = time.monotonic() - signaled
+        response = self.dome.close()
+        metrics.REGISTRY.observe('socal_emergency_close_latency_seconds', latency, instance=self.name, reason=reason)
+        metrics.REGISTRY.inc('socal_emergency_closes_total', instance=self.name, reason=reason)
+        print('Emergency close ({}): close command sent {:.1f} ms after the signal'.format(reason, 1e3*latency))
+        self._refresh('dome')
+        return response
+
+    def _watch_rain(self, snapshot, device, values):
+        ''' Poller listener: the DomeGuard rain sensor closes an open dome right away '''
+        if device == 'dome' and 'dome_status' in values:
+            dome_status = values['dome_status']
+            if str(dome_status['Sensors'].get('rain')).lower() == 'on' and dome_status['Status'] not in ['Closed', 'Closing']:
+                self.emergency_close('rain')
+
     def get_dome_status(self, short=False):
         '''
         Get the current status of the various Dome sensors and parse
+
+        Args:
+            short: (bool) read the short `s` status (state, limits, motor and
+                   sensors) instead of the full one, much cheaper
         '''
         status, response = self.dome.status(short=short)
         if short:
-            # Technically the "software readable" status, this only contains a portion of the keywords: 
-            # Example `status`:
-            #     "Closed,0,0,1,1,Stopped,0.0,Remote,Sensors:, Power: on, Rain: off, Light: off"
-            # Also the sensors can be in a random order!!!!
-            is_domeopen, leftopen, rightopen, leftclose, rightclose, motorrunning, motorcurrent, opmode, _, s1, s2, s3 = status.split(',')
-            s1name, s1state = s1.split(':'); s2name, s2state = s2.split(':'); s3name, s3state = s3.split(':')
-            sensors = {s1name.strip(): s1state.strip(), s2name.strip(): s2state.strip(), s3name.strip(): s3state.strip()}
-            dome_status =  {'Status': is_domeopen, 'OP mode': opmode, 
-                            'Limits': {'open left' : bool(leftopen),  'open right' : bool(rightopen), 
-                                    'close left': bool(leftclose), 'close right': bool(rightclose)},
-                            'Motor': {'status': motorrunning, 
-                                    'current': float(motorcurrent)},
-                            'Temperatures': {},
-                            'Sensors': {'rain' : sensors['Rain'], 
-                                        'light': sensors['Light'], 
-                                        'power': sensors['Power']},
-                        }
-        else:            
-            # Technically the human-readable status, this actally contains all the keywords
-            # Format into key-value pairs for dome_status dictionary
-            ds = {}
-            for stat in status.replace('Guard ', '').split('\n')[:-1]:
-                vals = re.split(':|, ', stat)
-            #     print(vals)
-                if len(vals) == 2:
-                    ds[vals[0].strip()] = vals[1].strip()
-                else:
-                    if vals[0] in ['Limits']:
-                        vals = vals[1:]
-                    elif vals[0] in ['Temperatures']:
-                        temps = []
-                        for val in vals[1:]:
-                            temps.extend(val.strip().split(' '))
-                        vals = temps
-                    elif vals[0] in ['Sensors']:
-                        vals = vals[2:]
-                    elif vals[0] in 'Watchdog':
-                        wd = ':'.join([v.strip() for v in vals]).replace(' sec','').replace(' ', ':')
-                        vals = wd.split(':')
-                    ds |=  {key.strip(): val.strip() for key, val in zip(vals[0::2], vals[1::2])}
-            # s = status.replace('\n', ',')
-            # s = s.replace('Limits:', '').replace('Temperatures:','').replace('Sensors:,', '')
-            # # s = s.replace('Guard', ',Guard').replace('Inside', ',Inside').replace('timeout', ',timeout')
-            # s = s.replace('Outside', ',Outside').replace('Inside', ',Inside').replace('timeout', ',timeout')
-            # ds = {key.strip(): val.strip() for key, val in (pair.split(':') for pair in s[:-1].split(','))}
-            # Reformat into appropriate datatypes
-            dome_status =  {'Status': ds['Status'], 'OP mode': ds['OP mode'], 
-                            'Limits': {key: {'ON': True, 'OFF': False}[ds[key]] 
-                                    for key in ['open left', 'open right', 'close left', 'close right']},
-                            'Motor': {'status': ds['Motor'], 
-                                    'current': float(ds['actual current'].replace(' A', '')),
-                                    'measured max': float(ds['measured max'].replace(' A', '')),
-                                    'last overcurrent': np.nan if ds['last overcurrent']=='N/A' 
-                                                                else float(ds['last overcurrent'])},
-                            'Temperatures': {'inside': float(ds['Inside'])*(9/5) + 32,
-                                            'outside': float(ds['Outside'])*(9/5) + 32,
-                                            'ebox'   : float(ds['electronics'])*(9/5) + 32},
-                            'Sensors': {'rain' : ds['Rain'], 
-                                        'light': ds['Light'], 
-                                        'power': ds['Power']},
-                            'Watchdog': {'status' : ds['Watchdog'], 
-                                        'timeout' : ds['timeout']},
-                            'Last command': ds['Last command']
-                        }
-        return dome_status
+            return domeguard.parse_short_status(status)
+        return domeguard.parse_status(status)
+
+    ###################################### TELEMETRY ######################################
+    def start_polling(self, cadence=None):
+        '''
+        Start polling every online device in the background. Keyword reads are
+        then served from the latest snapshot instead of doing device I/O.
+
+        Args:
+            cadence: (dict) seconds between polls per device, overriding POLL_CADENCE
+        '''
+        if self.poller is not None and self.poller.running:
+            return
+        cadence = dict(self.POLL_CADENCE, **(cadence or {}))
+        self.poller = TelemetryPoller()
+        # Each poll runs as a single request on the device's worker. The dome poll
+        # watches the rain sensor, so it goes ahead of ordinary requests
+        if self._dome_online:
+            self.poller.add_device('dome', lambda: self.call('dome', self.poll_dome, priority=MONITOR), cadence['dome'])
+            self.poller.subscribe(self._watch_rain)
+        if self._tracker_online:
+            self.poller.add_device('tracker', lambda: self.call('tracker', self.poll_tracker, priority=BACKGROUND), cadence['tracker'])
+            if self.guiding is None:
+                from control.guiding import GuidingMonitor
+                self.guiding = GuidingMonitor()
+            self.poller.add_device('guiding', lambda: self.call('tracker', self.poll_guiding, priority=BACKGROUND), cadence['guiding'])
+        if self._pyrheliometer_online:
+            self.poller.add_device('pyrheliometer', lambda: self.call('pyrheliometer', self.poll_pyr, priority=BACKGROUND), cadence['pyrheliometer'])
+            if self.exposure_meter is not None:
+                self.poller.subscribe(self.exposure_meter.on_telemetry)
+                if self.exposure_meter.open:
+                    self._pyr_cadence = cadence['pyrheliometer']
+                    self.poller.set_cadence('pyrheliometer', min(cadence['pyrheliometer'], self.EXPOSURE_CADENCE))
+        self.poller.start()
+
+    def stop_polling(self):
+        ''' Stop the background poller; keyword reads go back to the devices '''
+        self.stop_archive()
+        self.stop_goodlight()
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+
+    def start_archive(self, root, flush_interval=10.):
+        '''
+        Archive every background poll (dome, tracker and pyrheliometer) to an
+        append-only columnar store under `root`. Starts polling if needed.
+        Read it back with `dispatcher.archive.query(device, t0, t1, fields)`.
+        '''
+        from telemetry.archive import TelemetryArchive # numpy is only needed when archiving
+        if self.archive is not None:
+            return self.archive
+        self.start_polling()
+        self.archive = TelemetryArchive(root, flush_interval=flush_interval)
+        self.archive.start()
+        self.poller.subscribe(self.archive.listener)
+        return self.archive
+
+    def stop_archive(self):
+        ''' Stop archiving and flush the buffered rows to disk '''
+        if self.archive is not None:
+            if self.poller is not None:
+                self.poller.unsubscribe(self.archive.listener)
+            self.archive.stop()
+            self.archive = None
+
+    def start_goodlight(self, root):
+        '''
+        Record the per-second good-light mask (dome open, tracker locked on the
+        Sun, clear sky) under `root`, joined live from the background polls.
+        Starts polling if needed. Read it back with `dispatcher.goodlight_mask(t0, t1)`.
+        '''
+        from telemetry.goodlight import GoodLightJoin, GoodLightMask # numpy is only needed for the mask
+        if self.goodlight is not None:
+            return self.goodlight
+        self.start_polling()
+        self.goodlight = GoodLightJoin(GoodLightMask(root))
+        self.poller.subscribe(self._feed_goodlight)
+        return self.goodlight
+
+    def stop_goodlight(self):
+        ''' Stop recording the good-light mask, after emitting the seconds that are final by now '''
+        if self.goodlight is not None:
+            if self.poller is not None:
+                self.poller.unsubscribe(self._feed_goodlight)
+            self.goodlight.flush()
+            self.goodlight = None
+
+    def _feed_goodlight(self, snapshot, device, values):
+        ''' TelemetryPoller listener: the polls as good-light signals '''
+        goodlight, t = self.goodlight, snapshot.timestamp
+        if goodlight is None:
+            return
+        if device == 'dome' and 'dome_status' in values:
+            goodlight.add('dome_open', t, values['dome_status']['Status'] == 'Open')
+        elif device == 'tracker' and values.get('tracking_mode', '3') != '3':
+            goodlight.add('on_sun', t, False)
+        elif device == 'guiding' and values:
+            # This sample's own verdict: the mask is per second, the on_sun window spans 30 s
+            goodlight.add('on_sun', t, math.hypot(values['guiding_offset_alt'], values['guiding_offset_az'])
+                                       <= self.guiding.threshold)
+        elif device == 'pyrheliometer' and 'irradiance' in values:
+            goodlight.add('irradiance', t, values['irradiance'])
+
+    def goodlight_mask(self, t0, t1):
+        '''
+        The good-light quality bits of every second in [t0, t1), e.g. an exposure
+        window (see telemetry.goodlight)
+
+        Returns: (times, bits) arrays
+        '''
+        if self.goodlight is None:
+            raise RuntimeError('Good-light mask is not being recorded, see start_goodlight')
+        self.goodlight.flush()
+        return self.goodlight.mask.query(t0, t1)
+
+    def read_keyword(self, keyword):
+        '''
+        Read a keyword along with how stale it is
+
+        Returns:
+            value: keyword value, from the latest snapshot if it has been polled
+            age:   (float) seconds since the value was read from its device
+        '''
+        if self.poller is not None and keyword in self.poller.snapshot:
+            value, age = self.poller.read(keyword)
+            if age <= self.max_age(self.poller.snapshot.reading(keyword).device):
+                return value, age
+        return getattr(self, keyword), 0.
+
+    def max_age(self, device):
+        ''' Seconds after which a value polled from `device` is stale (MAX_AGE_POLLS poll periods) '''
+        poller = self.poller
+        if poller is None or device not in poller.devices:
+            return self.MIN_MAX_AGE
+        return max(self.MAX_AGE_POLLS*poller.cadence(device), self.MIN_MAX_AGE)
+
+    def keyword_age(self, keyword):
+        '''
+        Seconds since the value from_snapshot serves for `keyword` was read from
+        its device, however old; 0 if it is not polled (read live)
+        '''
+        poller = self.poller
+        if poller is None:
+            return 0.
+        reading = poller.snapshot.reading(keyword)
+        if reading is None:
+            return 0.
+        return time.time() - reading.timestamp
+
+    def from_snapshot(self, fn, *args, **kwargs):
+        '''
+        Call `fn`, e.g. a keyword getter, with every polled property served from
+        the latest snapshot however old (see keyword_age) and never read from its
+        device, so that a hung device cannot block the calling thread (e.g. a
+        TelemetryPoller listener). A polled property that was never published
+        raises LookupError. Without a poller, properties are read live as usual.
+        '''
+        if self.poller is None or getattr(self._reads, 'snapshot_only', False):
+            return fn(*args, **kwargs)
+        self._reads.snapshot_only = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._reads.snapshot_only = False
+
+    def _polled(self, keyword, device, fetch):
+        '''
+        Serve `keyword` from the telemetry snapshot while it is fresh (see max_age),
+        otherwise call `fetch` on the worker of `device`: a device that stopped
+        answering then raises, or times out after LIVE_TIMEOUT seconds, instead
+        of its last value being served indefinitely. None (unknown) for a device
+        that was never connected (e.g. offline or unpowered at startup)
+        '''
+        if device not in self.workers:
+            return None
+        poller = self.poller
+        if poller is None:
+            return fetch()
+        reading = poller.snapshot.reading(keyword)
+        if getattr(self._reads, 'snapshot_only', False):
+            if reading is None:
+                raise LookupError('{} has not been polled yet'.format(keyword))
+            return reading.value
+        if reading is not None and time.time() - reading.timestamp <= self.max_age(reading.device):
+            return reading.value
+        return self.call(device, fetch, timeout=self.LIVE_TIMEOUT)
+
+    def _refresh(self, device):
+        ''' After a command, re-poll the device right away so the snapshot catches up '''
+        if self.poller is not None and device in self.poller.devices:
+            self.poller.poll(device)
+
+    ####################################### METRICS #######################################
+    def serve_metrics(self, port=metrics.METRICS_PORT, host='127.0.0.1'):
+        '''
+        Export the device command metrics (latency histograms, errors, timeouts
+        and bytes on the wire) in Prometheus text format at http://host:port/metrics
+        '''
+        if self.metrics_server is None:
+            self.metrics_server = metrics.REGISTRY.serve(port=port, host=host)
+        return self.metrics_server
+
+    def dump_metrics(self, path):
+        ''' Write the current device command metrics to a file in Prometheus text format '''
+        metrics.REGISTRY.dump(path)
+
+    ###################################### PROFILING ######################################
+    def start_profiling(self, path=None, interval=None, memory=True):
+        '''
+        Start profiling this dispatcher: stack samples of every thread, time and
+        memory allocated by every device call, and reads of every property
+
+        Args:
+            path:     (str) dump the profile to this file when profiling stops
+            interval: (float) seconds between stack samples (default profiling.SAMPLE_INTERVAL)
+            memory:   (bool) also trace allocations with tracemalloc
+
+        Returns: (telemetry.profiling.Profiler)
+        '''
+        from telemetry import profiling
+        if self.profiler is None:
+            profiling.count_properties(type(self))
+            self.profiler = profiling.Profiler(interval=interval or profiling.SAMPLE_INTERVAL,
+                                               memory=memory, path=path).start()
+            for worker in self.workers.values():
+                worker.profiler = self.profiler
+        return self.profiler
+
+    def stop_profiling(self, path=None):
+        '''
+        Stop profiling and dump the profile to `path` (or the path given to
+        start_profiling)
+
+        Returns: (telemetry.profiling.Profiler) the stopped profiler, or None if not profiling
+        '''
+        profiler = self.profiler
+        if profiler is None:
+            return None
+        self.profiler = None
+        for worker in self.workers.values():
+            worker.profiler = None
+        if path:
+            profiler.path = path
+        profiler.stop()
+        return profiler
+
+    def dump_profile(self, path):
+        ''' Write the profile collected so far to `path`, and keep profiling '''
+        assert self.profiler is not None, 'Not profiling, see start_profiling'
+        return self.profiler.dump(path)
 
     #################################### CONNECTIVITY ####################################
     @property
@@ -484,6 +1318,23 @@ class SoCalDispatcher(object):
             self._tracker_online = True
         except:
             self._tracker_online = False
+        return self._tracker_online
+
+    @property
+    def tracker_alive(self):
+        '''
+        Whether the tracker answers, from its polls: the last successful one is
+        fresh (see max_age). Asks the tracker (tracker_online) if it is not polled
+        (within from_snapshot: whether it answered last time)
+        '''
+        poller = self.poller
+        if poller is None or 'tracker' not in poller.devices:
+            if getattr(self._reads, 'snapshot_only', False):
+                return self._tracker_online
+            return self.tracker_online
+        reading = poller.snapshot.reading('tracking_mode')
+        return (self._tracker_online and reading is not None
+                and time.time() - reading.timestamp <= self.max_age('tracker'))
 
     @property
     def pyrheliometer_online(self):
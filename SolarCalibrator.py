@@ -9,15 +9,87 @@
 #
 ############################################################
 
-# import ktl
-import time
+import os
+import json
+from collections import deque
 from transitions import Machine
-from transitions.extensions import GraphMachine # For visualizing the state machine
+from eventloop import EventLoop
+from localktl import as_bool
+from telemetry import metrics
+
+def connect_ktl(name='kpfsocal'):
+    ''' Connect to a KTL service at Keck (ktl is only importable there) '''
+    import ktl
+    return ktl.Service(name)
+
+def read_keywords(service, keywords):
+    '''
+    Read several keywords of a KTL service in one go
+
+    Returns: (dict) keyword -> value (as returned by Keyword.read())
+    '''
+    if hasattr(service, 'read_many'):
+        # In-process services read everything in a single request
+        return service.read_many(keywords)
+    # KTLPython: issue all reads without waiting, then collect them, so the
+    # round trips overlap instead of adding up
+    pending = [(keyword, service[keyword], service[keyword].read(wait=False)) for keyword in keywords]
+    values = {}
+    for keyword, kw, sequence in pending:
+        kw.wait(sequence=sequence)
+        values[keyword] = kw['ascii']
+    return values
+
+class KeywordSnapshot(object):
+    '''
+    Keyword values for the evaluation of one trigger. The first read fetches
+    every keyword in `keywords` as one bulk request, so all conditions of the
+    trigger are decided on the same, consistent set of values.
+    '''
+
+    def __init__(self, service, keywords):
+        self.service  = service
+        self.keywords = list(keywords)
+        self.values   = None
+
+    def __getitem__(self, keyword):
+        if self.values is None:
+            self.values = read_keywords(self.service, self.keywords)
+        if keyword not in self.values:
+            # Not part of the bulk set, read it once and keep it
+            self.values[keyword] = self.service[keyword].read()
+        return self.values[keyword]
+
+    def invalidate(self):
+        ''' Forget the values, e.g. after a command was sent; the next read refetches '''
+        self.values = None
+
+def save_checkpoint(path, context):
+    ''' Write `context` to `path` as compact JSON, atomically (a crash leaves the old or the new file) '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(context, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    ''' Read a checkpoint written by save_checkpoint; None if there is none or it is unreadable '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        if os.path.exists(path):
+            print('Ignoring unreadable checkpoint {}: {}'.format(path, repr(e)))
+        return None
 
 class SoCal(object):
 
     # SoCal operational states
     states = ['PoweredOff',     # Dome CLOSED and tracker stowed at 'home', powered OFF 
+              'PoweringOn',     # Tracker relay switched ON, tracker booting and being initialized
               'Stowed',         # Dome CLOSED and tracker stowed at 'home', powered ON 
               'Opening',        # Dome is OPENING
               'Open',           # Dome OPEN and tracker stowed at 'home'
@@ -26,6 +98,7 @@ class SoCal(object):
               'Closing',        # Dome is CLOSING
               'Closed',         # Dome CLOSED and tracker is in active guiding mode
               'StowingTracker', # Tracker is switched to manual pointing mode and moving to its 'home' position
+              'PoweringOff',    # Tracker relay is being switched OFF
               'ERROR',          # State to put SoCal in if one of the above transitions does not succeed
               'OFFLINE',        # At least one of the SoCal devices is offline/unreachable
               'RECOVERING',     # ERROR/OFFLINE is resolved and soCal is attempting to recover into the last defined state
@@ -35,8 +108,16 @@ class SoCal(object):
     transitions = [
         # Power on the SoCal system
         {'trigger': 'power_on', 
-            'source': 'PoweredOff', 'dest':'Stowed', 
-            'prepare': 'can_power_on', 'before': 'power_on_system', 'after': 'did_power_on'},
+            'source': 'PoweredOff', 'dest':'PoweringOn', 
+            'prepare': 'can_power_on', 'after': 'done_powering_on'},
+            # After powering on, check the tracker and make next transition accordingly
+            {'trigger': 'done_powering_on',
+                'source': 'PoweringOn', 'dest':'Stowed', 'conditions':['operate', 'tracker_is_powered'],
+                'after': 'did_power_on'},
+            {'trigger': 'done_powering_on',
+                'source': 'PoweringOn', 'dest':None, 'conditions':['operate', 'awaiting_command']},
+            {'trigger': 'done_powering_on',
+                'source': 'PoweringOn', 'dest':'ERROR', 'conditions':['operate', 'tracker_not_powered'], 'after': 'recover'},
         # Open the dome, while the tracker is homed. Only open if conditions are safe
         {'trigger': 'open', 
             'source': 'Stowed', 'dest':'Opening',
@@ -44,27 +125,45 @@ class SoCal(object):
             'before': 'can_open', 'after': 'done_opening'},
             # After opening, check dome status and make next transition accordingly
             {'trigger': 'done_opening', 
-                'source': 'Opening', 'dest':'Open', 'conditions':['operate', 'dome_is_open'], 'after': 'guide'},
+                'source': 'Opening', 'dest':'Open', 'conditions':['operate', 'dome_is_open'],
+                'before': 'end_preposition', 'after': 'guide'},
+            {'trigger': 'done_opening', 
+                'source': 'Opening', 'dest':'ERROR', 'conditions':['operate', 'dome_fault'],
+                'before': 'abort_preposition', 'after': 'recover'},
+            {'trigger': 'done_opening', 
+                'source': 'Opening', 'dest':None, 'conditions':['operate', 'awaiting_command']},
             {'trigger': 'done_opening', 
-                'source': 'Opening', 'dest':'ERROR', 'conditions':['operate', 'dome_not_open'], 'after': 'recover'},
+                'source': 'Opening', 'dest':'ERROR', 'conditions':['operate', 'dome_not_open'],
+                'before': 'abort_preposition', 'after': 'recover'},
         # With the dome open, enable active guiding on the solar tracker 
         {'trigger': 'guide',
             'source': 'Open', 'dest': 'AcquiringSun', 
             'conditions':['operate', 'is_safe_to_open'],
             'before': 'can_guide', 'after': 'done_acquiring'},
+            # Weather turned while the dome was opening: close it again
+            {'trigger': 'guide',
+                'source': 'Open', 'dest': 'Closing',
+                'conditions':['operate'], 'unless':['is_safe_to_open'],
+                'before': ['stow_prepositioned', 'can_close'], 'after': 'done_closing'},
             # After acquiring, check guiding status and make next transition accordingly
             {'trigger': 'done_acquiring', 
-                'source': 'AcquiringSun', 'dest':'OnSky', 'conditions':['operate', 'tracker_is_guiding']},
+                'source': 'AcquiringSun', 'dest':'OnSky', 'conditions':['operate', 'tracker_is_guiding'],
+                'before': 'end_acquisition'},
+            {'trigger': 'done_acquiring', 
+                'source': 'AcquiringSun', 'dest':None, 'conditions':['operate', 'awaiting_command']},
             {'trigger': 'done_acquiring', 
                 'source': 'AcquiringSun', 'dest':'ERROR', 'conditions':['operate', 'tracker_not_guiding'], 'after': 'recover'},
-        # OnSky guiding loop: during normal operations, this routinely checks weather status and sun altitude
+        # OnSky guiding loop: during normal operations, this routinely checks weather status and sun altitude.
+        # Staying OnSky is an internal transition (dest=None) that just arms the timer for the next check
         {'trigger': 'monitor_onsky', 
-            'source': 'OnSky', 'dest':'OnSky', 'conditions':['operate', 'keep_observing'], 'after': 'wait'},
+            'source': 'OnSky', 'dest':None, 'conditions':['operate', 'keep_observing'], 'after': 'schedule_onsky_check'},
         {'trigger': 'monitor_onsky', 
             'source': 'OnSky', 'dest':'Closing', 'conditions':['operate', 'stop_observing'], 'before': 'can_close', 'after': 'done_closing'},
             # After closing, check dome status and make next transition accordingly
             {'trigger': 'done_closing', 
                 'source': 'Closing', 'dest':'Closed', 'conditions':['operate', 'dome_is_closed'], 'after': 'stow'},
+            {'trigger': 'done_closing', 
+                'source': 'Closing', 'dest':None, 'conditions':['operate', 'awaiting_command']},
             {'trigger': 'done_closing', 
                 'source': 'Closing', 'dest':'ERROR', 'conditions':['operate', 'dome_not_closed'], 'after': 'recover'},
         # With the dome closed, home the tracker
@@ -73,12 +172,21 @@ class SoCal(object):
             # After stowing, check tracker status and make next transition accordingly
             {'trigger': 'done_stowing', 
                 'source': 'StowingTracker', 'dest':'Stowed', 'conditions':['operate', 'tracker_is_home']},
+            {'trigger': 'done_stowing', 
+                'source': 'StowingTracker', 'dest':None, 'conditions':['operate', 'awaiting_command']},
             {'trigger': 'done_stowing', 
                 'source': 'StowingTracker', 'dest':'ERROR', 'conditions':['operate', 'tracker_not_home'], 'after': 'recover'},
         # Power-down the SoCal system
         {'trigger': 'power_off', 
-            'source': 'Stowed', 'dest': 'PoweredOff', 
-            'prepare': 'can_power_off', 'before': 'power_down_system', 'after': 'did_power_off'},
+            'source': 'Stowed', 'dest': 'PoweringOff', 
+            'prepare': 'can_power_off', 'after': 'done_powering_off'},
+            {'trigger': 'done_powering_off',
+                'source': 'PoweringOff', 'dest':'PoweredOff', 'conditions':['operate', 'tracker_is_off'],
+                'after': 'did_power_off'},
+            {'trigger': 'done_powering_off',
+                'source': 'PoweringOff', 'dest':None, 'conditions':['operate', 'awaiting_command']},
+            {'trigger': 'done_powering_off',
+                'source': 'PoweringOff', 'dest':'ERROR', 'conditions':['operate', 'tracker_not_off'], 'after': 'recover'},
         # If a device goes offline, transition to OFFLINE state
         {'trigger': 'offline', 'source': '*', 'dest': 'OFFLINE'},
         # If all devices come back online, enter RECOVERING state to attempt to transition back to last online state
@@ -90,106 +198,496 @@ class SoCal(object):
         },
     ]
 
-    def __init__(self, graph=False):
+    # Keywords read (in one bulk request) for every trigger evaluation. SUNALT is not
+    # among them: the Sun's altitude comes from the daily ephemeris schedule
+    SNAPSHOT_KEYWORDS = ['WXSAFE', 'ENCSTATUS', 'ENCONLINE', 'EKOMODE', 'EKOHOME', 'EKOGUIDING', 'EKOONLINE']
+
+    # OnSky check cadence [s]: checks speed up near the sun altitude limit and after weather changes
+    SUN_ALT_LIMIT      = 30.     # [deg] keep observing while the Sun is above this altitude
+    SUN_ALT_MAX_RATE   = 1/240.  # [deg/s] fastest the Sun's altitude can change (15 deg/hr)
+    ONSKY_MIN_INTERVAL = 1.
+    ONSKY_MAX_INTERVAL = 30.
+    WX_SETTLE_TIME     = 600.    # [s] keep checking at the fastest cadence this long after WXSAFE changes
+    OPEN_RETRY         = 300.    # [s] while the Sun is up, how often a Stowed SoCal tries to open again
+
+    # Keywords whose changes are acted on as soon as they are broadcast
+    EVENT_KEYWORDS = ['WXSAFE', 'ENCSTATUS', 'EKOGUIDING', 'EKOHOME', 'EKOPOWER']
+
+    # Device commands are sent without waiting (so one loop can drive several
+    # calibrators). Each moving state waits for its command to complete: its
+    # done_* trigger re-runs on keyword events and every COMMAND_POLL seconds,
+    # and fails into ERROR after COMMAND_TIMEOUT.
+    DONE_TRIGGERS   = {'Opening': 'done_opening', 'AcquiringSun': 'done_acquiring',
+                       'Closing': 'done_closing', 'StowingTracker': 'done_stowing',
+                       'PoweringOn': 'done_powering_on', 'PoweringOff': 'done_powering_off'}
+    COMMAND_TIMEOUT = {'Opening': 300., 'AcquiringSun': 600., 'Closing': 300., 'StowingTracker': 600.,
+                       'PoweringOn': 180., 'PoweringOff': 60.} # [s]
+    COMMAND_POLL    = 5. # [s]
+    # What the device reports while each state's command is under way (keyword, values), and before
+    # it took effect. The command is only waited for while the device reports it under way, or still
+    # reports the state before it within COMMAND_START s of being sent: a device that went another way
+    # fails the state right away instead of after COMMAND_TIMEOUT
+    IN_PROGRESS     = {'Opening'       : ('ENCSTATUS', ['Opening'], ['Closed']),
+                       'AcquiringSun'  : ('EKOMODE', ['3'], ['0', '1']),
+                       'Closing'       : ('ENCSTATUS', ['Closing'], ['Open']),
+                       'StowingTracker': ('EKOMODE', ['0'], ['1', '2', '3']),
+                       'PoweringOn'    : ('EKOPOWER', ['booting'], ['off', 'on']),
+                       'PoweringOff'   : ('EKOPOWER', [], ['on', 'booting'])}
+    COMMAND_START   = 10. # [s]
+
+    # Overlapped acquisition: pre-position the tracker while the dome opens (see preposition_tracker)
+    TRACKER_SLEW_RATE = 1.0 # [deg/s] nominal, to estimate the slew time saved
+
+    # Device keywords (ENCSTATUS, EKOMODE, EKOHOME) expected in each settled state
+    DEVICE_STATUS = {'PoweredOff': ('Closed', '0', True),
+                     'Stowed'    : ('Closed', '0', True),
+                     'Closed'    : ('Closed', '3', False),
+                     'Open'      : ('Open', '3', True),
+                     'OnSky'     : ('Open', '3', False),
+                    }
+
+    # Warm restart
+    CHECKPOINT_MAX_AGE = 3600. # [s] older checkpoints are not trusted, SoCal starts from LASTSTATE
+    ERROR_HISTORY      = 50    # ERROR/OFFLINE entries kept in the checkpoint
+    CHECKPOINT_REFRESH = 300.  # [s] how often the OnSky loop (no state change) re-saves the checkpoint
+    # Settled states SoCal only passes through: the trigger that moves on from each
+    RESUME_TRIGGERS    = {'Open': 'guide', 'Closed': 'stow'}
+
+    def __init__(self, graph=False, loop=None, service=None, ephemeris=True, checkpoint=None, tracer=None,
+                 name='KPF Solar Calibrator', overlap=False):
+        '''
+        Args:
+            graph:      (bool) only build the machine to draw the state diagram
+            loop:       (EventLoop) loop to run the machine on (default: a new one).
+                        Several SoCal instances can share one loop
+            service:    KTL service to talk to: a service object (e.g. a localktl.Service)
+                        or the name of a KTL service (default: 'kpfsocal')
+            ephemeris:  (bool) open and close on timers at the Sun's computed limit
+                        crossings (see schedule_day); if False, poll SUNALT instead
+            checkpoint: (str) file to save the machine's context to after every
+                        transition, and to resume from at startup if the devices
+                        still agree with it (see restore_checkpoint)
+            tracer:     (telemetry.tracing.Tracer) record every trigger, callback and
+                        keyword read/write as spans (opt-in; off by default)
+            name:       (str) name of this calibrator
+            overlap:    (bool) slew the tracker to the Sun (calculation mode 1) while the
+                        dome opens, so only the sun-sensor lock is left once it is open
+        '''
 
-        self.name = 'KPF Solar Calibrator'
+        self.name = name
+
+        # Event loop the machine runs on (see run()). Triggers are queued rather than
+        # nested, so chained transitions and the OnSky loop keep a flat call stack
+        self.loop = EventLoop() if loop is None else loop
+        self._onsky_timer  = None
+        self._last_sunalt  = None
+        self._last_wxsafe  = None
+        self._wx_changed_at = None
+        self._snapshot     = None # KeywordSnapshot of the trigger being evaluated
+        self.schedule      = None # ephemeris.DailySchedule of the current local day
+        self._day_timers   = []
+        self._reopen_timer = None
+        self.checkpoint_path = checkpoint
+        self.last_snapshot = {}   # Keyword values of the last bulk read
+        self.errors        = deque(maxlen=SoCal.ERROR_HISTORY) # (time, state, from state)
+        self.restored      = None # Checkpoint the machine resumed from, if any
+        self._saved_at     = None
+        self._command_deadline = None # Until when the current state's command may still complete
+        self._command_sent     = None # When it was sent
+        self._power_write  = None # Sequence number of the pending EKOPOWER write, if any
+        self._command_timer    = None
+        self.overlap       = overlap
+        self._preposition  = None # (start time, expected slew [s]) while the tracker is pre-positioned
+        self.overlap_saved = {}   # local date -> seconds of acquisition saved by the overlap
+        self._acquiring    = None # When the tracker was told to guide, while AcquiringSun
+        self.acquisition_times = {} # local date -> [seconds from the guide command to OnSky, ...]
         
         if graph:
+            # Only pull in graphviz when the diagram is actually wanted
+            from transitions.extensions import GraphMachine # For visualizing the state machine
             self.machine = GraphMachine(model=self, states=SoCal.states, show_conditions=True,
-                                transitions=SoCal.transitions, initial='PoweredOff')     
+                                transitions=SoCal.transitions, initial='PoweredOff', queued=True,
+                                prepare_event='take_snapshot', finalize_event='release_snapshot')     
         else: 
             # Connect to SoCal ktl service
-            self.socal = ktl.Service ('kpfsocal')
+            if service is None or isinstance(service, str):
+                service = connect_ktl(service or 'kpfsocal')
+            self.socal = service
+            if tracer is not None:
+                from telemetry.tracing import TracedService
+                self.socal = TracedService(self.socal, tracer)
     
+            # Resume from the checkpoint if the devices agree with it, else from LASTSTATE
+            initial = self.socal['LASTSTATE'].read()
+            if checkpoint is not None:
+                self.restored = self.restore_checkpoint(checkpoint)
+                if self.restored is not None:
+                    initial = self.restored['state']
+
             # Initialize the state machine
             self.machine = Machine(model=self, states=SoCal.states, transitions=SoCal.transitions, 
-                                    initial=self.socal['LASTSTATE'].read())
+                                    initial=initial, queued=True,
+                                    prepare_event='take_snapshot', finalize_event='release_snapshot',
+                                    after_state_change='write_checkpoint')
+            self._previous_state = self.state
         
         # Define functions to perform when entering each state
+        for state in SoCal.DONE_TRIGGERS:
+            getattr(self.machine, 'on_enter_' + state)('start_command_wait')
+            getattr(self.machine, 'on_exit_' + state)('end_command_wait')
         self.machine.on_enter_Opening('open_dome')
+        self.machine.on_enter_Opening('preposition_tracker')
         self.machine.on_enter_AcquiringSun('acquire_sun')
-        self.machine.on_enter_OnSky('monitor_onsky')
+        self.machine.on_enter_OnSky('schedule_onsky_check')
+        self.machine.on_exit_OnSky('cancel_onsky_check')
         self.machine.on_enter_Closing('close_dome')
         self.machine.on_enter_StowingTracker('home_tracker')
+        self.machine.on_enter_PoweringOn('power_on_system')
+        self.machine.on_enter_PoweringOff('power_down_system')
+        self.machine.on_enter_Stowed('schedule_reopen')
+        self.machine.on_exit_Stowed('cancel_reopen')
         # self.machine.on_enter_OFFLINE('go_offline')
         self.machine.on_enter_RECOVERING('try_recover')
+        self.tracer = tracer
+        if tracer is not None:
+            from telemetry.tracing import trace_machine
+            trace_machine(self.machine, tracer)
+
+        if not graph:
+            self.subscribe(SoCal.EVENT_KEYWORDS)
+            if ephemeris:
+                self.schedule_day()
+            self.resume()
+
+    ################################# KEYWORD SNAPSHOT #################################
+    def take_snapshot(self, *args, **kwargs):
+        ''' Start a keyword snapshot for this trigger evaluation (machine prepare_event) '''
+        self._snapshot = KeywordSnapshot(self.socal, SoCal.SNAPSHOT_KEYWORDS)
+
+    def release_snapshot(self, *args, **kwargs):
+        ''' Drop the snapshot once the trigger is processed (machine finalize_event) '''
+        if self._snapshot is not None and self._snapshot.values is not None:
+            self.last_snapshot = self._snapshot.values
+        self._snapshot = None
+
+    def kw(self, keyword):
+        ''' Read a KTL keyword, from the current trigger's snapshot if one is active '''
+        if self._snapshot is not None:
+            return self._snapshot[keyword]
+        return self.socal[keyword].read()
+
+    def kw_write(self, keyword, value, wait=True):
+        '''
+        Write a KTL keyword. Commands change device state, so the snapshot is re-read afterwards
+
+        Returns: sequence number of the write (see written)
+        '''
+        sequence = self.socal[keyword].write(value, wait=wait)
+        if self._snapshot is not None:
+            self._snapshot.invalidate()
+        return sequence
+
+    def written(self, keyword, sequence):
+        ''' Whether a write issued with wait=False has completed (without waiting for it) '''
+        return sequence is None or self.socal[keyword].wait(timeout=0, sequence=sequence)
+
+    ################################# CHECKPOINT / WARM RESTART #################################
+    def context(self):
+        '''
+        Everything needed to resume the machine: state, last keyword snapshot, pending
+        OnSky check (the day's timers are recomputed by schedule_day), error history
+        '''
+        values = self._snapshot.values if (self._snapshot is not None and self._snapshot.values) else self.last_snapshot
+        return {'time'     : self.loop.time(),
+                'state'    : self.state,
+                'previous' : self._previous_state,
+                'snapshot' : dict(values),
+                'timers'   : {'onsky': None if self._onsky_timer is None else self._onsky_timer.when},
+                'weather'  : {'wxsafe': self._last_wxsafe, 'changed_at': self._wx_changed_at},
+                'errors'   : list(self.errors),
+               }
+
+    def write_checkpoint(self, *args, **kwargs):
+        '''
+        Record the transition and save the context (machine after_state_change).
+        Every state change is saved; internal transitions (the OnSky loop) only
+        refresh the file every CHECKPOINT_REFRESH seconds.
+        '''
+        now = self.loop.time()
+        changed = self.state != self._previous_state
+        if changed:
+            if self.state in ['ERROR', 'OFFLINE']:
+                self.errors.append((now, self.state, self._previous_state))
+            self._previous_state = self.state
+        if self.checkpoint_path is None:
+            return
+        if not changed and self._saved_at is not None and now - self._saved_at < self.CHECKPOINT_REFRESH:
+            return
+        try:
+            save_checkpoint(self.checkpoint_path, self.context())
+            self._saved_at = now
+        except OSError as e:
+            print('Could not write checkpoint {}: {}'.format(self.checkpoint_path, repr(e)))
+
+    def restore_checkpoint(self, path):
+        '''
+        Check a saved context against one bulk read of the devices
+
+        Returns: the checkpoint (dict) if SoCal can resume in its state directly
+                 (see resume), None if it must start from LASTSTATE (and recover if needed)
+        '''
+        context = load_checkpoint(path)
+        if context is None:
+            return None
+        age = self.loop.time() - context.get('time', 0.)
+        state = context.get('state')
+        if age > self.CHECKPOINT_MAX_AGE:
+            print('Checkpoint is {:.0f} s old, not resuming from it'.format(age))
+            return None
+        if state not in self.DEVICE_STATUS:
+            print('Checkpoint was taken in the middle of {}, not resuming from it'.format(state))
+            return None
+        try:
+            values = read_keywords(self.socal, SoCal.SNAPSHOT_KEYWORDS)
+        except Exception as e:
+            # E.g. the tracker is offline or its relay is off
+            print('Could not read the devices ({}), not resuming from the checkpoint'.format(repr(e)))
+            return None
+        devices = (values['ENCSTATUS'], values['EKOMODE'], as_bool(values['EKOHOME']))
+        if devices != self.DEVICE_STATUS[state] or (state == 'OnSky' and not as_bool(values['EKOGUIDING'])):
+            print('Devices {} do not match checkpointed state {}, not resuming from it'.format(devices, state))
+            return None
+
+        self.last_snapshot = values
+        self.errors.extend(tuple(error) for error in context.get('errors', []))
+        weather = context.get('weather', {})
+        self._last_wxsafe   = weather.get('wxsafe')
+        self._wx_changed_at = weather.get('changed_at')
+        print('Resuming in {} from checkpoint ({:.0f} s old)'.format(state, age))
+        return context
+
+    def resume(self):
+        '''
+        Carry on from the initial state, which doesn't fire its on_enter callbacks:
+        re-arm the OnSky loop (when the checkpoint had it due, if resuming from one)
+        or the Stowed reopening, and move on from Open or Closed (RESUME_TRIGGERS),
+        which nothing else would leave
+        '''
+        if self.state == 'OnSky' and self._onsky_timer is None:
+            due = (self.restored or {}).get('timers', {}).get('onsky')
+            if due is None:
+                self.schedule_onsky_check()
+            else:
+                self._onsky_timer = self.loop.call_at(max(due, self.loop.time()), self._onsky_check)
+        elif self.state == 'Stowed' and self._reopen_timer is None:
+            self.schedule_reopen()
+        elif self.state in self.RESUME_TRIGGERS:
+            state = self.state
+            self.loop.call_soon(lambda: self.state == state and self.trigger(self.RESUME_TRIGGERS[state]))
+
+    def shutdown(self):
+        ''' Stop reacting to keywords and cancel all timers, e.g. before handing over to a new instance '''
+        self.unsubscribe(SoCal.EVENT_KEYWORDS)
+        self.cancel_onsky_check()
+        self.cancel_reopen()
+        self.end_command_wait()
+        for timer in self._day_timers:
+            timer.cancel()
+        self._day_timers = []
+
+    ################################# KEYWORD EVENTS #################################
+    def subscribe(self, keywords):
+        '''
+        Monitor keywords and react to their broadcasts instead of waiting for the next poll.
+        A keyword that cannot be read yet (e.g. the tracker is off) stays unknown until it can.
+        '''
+        for keyword in keywords:
+            self.socal[keyword].callback(self._keyword_callback)
+            try:
+                self.socal[keyword].monitor()
+            except Exception as e:
+                print('Could not prime {}: {}'.format(keyword, repr(e)))
+
+    def unsubscribe(self, keywords):
+        for keyword in keywords:
+            self.socal[keyword].callback(self._keyword_callback, remove=True)
+
+    def _keyword_callback(self, keyword):
+        # Called from the KTL (or poller) thread: hand the event over to the machine's loop
+        self.loop.call_soon(self.on_keyword_event, keyword['name'], keyword['ascii'])
+
+    def on_keyword_event(self, keyword, value):
+        ''' A monitored keyword changed: re-check the OnSky conditions or a pending command right away '''
+        if keyword == 'WXSAFE':
+            self.note_conditions(as_bool(value))
+            if self.state == 'Stowed' and as_bool(value):
+                self.reopen()
+        if self.state == 'OnSky':
+            self._poke()
+        elif self.state in SoCal.DONE_TRIGGERS:
+            self.trigger(SoCal.DONE_TRIGGERS[self.state])
+
+    ################################# PENDING COMMANDS #################################
+    @property
+    def awaiting_command(self):
+        """ The command sent on entering this state may still be in progress: not timed out, and under way (IN_PROGRESS) """
+        now = self.loop.time()
+        if self._command_deadline is None or now >= self._command_deadline:
+            return False
+        if self.state not in SoCal.IN_PROGRESS:
+            return True
+        keyword, moving, before = SoCal.IN_PROGRESS[self.state]
+        value = self.kw(keyword)
+        return value in moving or (value in before and now < self._command_sent + SoCal.COMMAND_START)
+
+    def start_command_wait(self):
+        ''' Entering a moving state: allow its command COMMAND_TIMEOUT to complete '''
+        self._command_sent     = self.loop.time()
+        self._command_deadline = self._command_sent + SoCal.COMMAND_TIMEOUT[self.state]
+        self._arm_command_poll()
+
+    def end_command_wait(self):
+        self._command_deadline = None
+        self._command_sent     = None
+        if self._command_timer is not None:
+            self._command_timer.cancel()
+            self._command_timer = None
+
+    def _arm_command_poll(self):
+        when = min(self.loop.time() + SoCal.COMMAND_POLL, self._command_deadline)
+        self._command_timer = self.loop.call_at(when, self._command_poll)
+
+    def _command_poll(self):
+        # Fallback for devices whose keywords are not broadcast, and the timeout
+        self._command_timer = None
+        state = self.state
+        if state in SoCal.DONE_TRIGGERS:
+            self.trigger(SoCal.DONE_TRIGGERS[state])
+            if self.state == state and self._command_deadline is not None and self._command_timer is None:
+                self._arm_command_poll()
 
     ################################# CONDITION DEFINITIONS #################################
     @property
     def operate(self):
         """ If True, SoCal runs in autonomous mode. if False, prevents state transitions from occuring. """
-        # return self.socal['OPERATE'].read()
+        # return self.kw('OPERATE')
         return True
 
     @property
     def is_safe_to_open(self):
         """ Verify conditions are safe to open """
-        return self.socal['WXSAFE'].read()
+        return as_bool(self.kw('WXSAFE'))
 
     @property
-    def keep_observering(self):
+    def sun_is_up(self):
+        """ Is the Sun above SUN_ALT_LIMIT? From the daily schedule if there is one, else SUNALT """
+        if self.schedule is not None:
+            return self.schedule.is_up(self.loop.time())
+        sunalt = float(self.kw('SUNALT'))
+        self._last_sunalt = sunalt
+        return sunalt >= self.SUN_ALT_LIMIT
+
+    @property
+    def keep_observing(self):
         """ Verify conditions are good to keep observing """
-        return (self.socal['WXSAFE'].read()) and (self.socal['SUNALT'].read() >= 30)
+        wxsafe = as_bool(self.kw('WXSAFE'))
+        sun_up = self.sun_is_up
+        self.note_conditions(wxsafe)
+        return wxsafe and sun_up and (self.kw('ENCSTATUS') == 'Open')
     
     @property
     def stop_observing(self):
         """ Check if weather is unsafe or if day has ended """
-        return not self.keep_observing()
+        return not self.keep_observing
     
     @property
     def tracker_is_guiding(self):
         """ Verify tracker is guiding on the Sun """
-        # return (self.socal['EKOMODE'].read() == '3') # TODO: and OFFSETALT is nominal and OFFSETAZ is nominal
-        if self.socal['EKOGUIDING'].read():
+        # return (self.kw('EKOMODE') == '3') # TODO: and OFFSETALT is nominal and OFFSETAZ is nominal
+        if as_bool(self.kw('EKOGUIDING')):
             print('Guiding on Sun. Get yer photons here!')
+            return True
         else:
-            print("Guiding failed. If it's not cloudy, check the sun sensor alignment.")
-
+            if not self.awaiting_command:
+                print("Guiding failed. If it's not cloudy, check the sun sensor alignment.")
+            return False
 
     @property
     def tracker_not_guiding(self):
         """ Check that the tracker is not guiding on the Sun """
-        return not self.tracker_is_guiding()
+        return not as_bool(self.kw('EKOGUIDING'))
     
     @property
     def dome_is_open(self):
         """ Check that the enclosure is open """
-        if self.socal['ENCSTATUS'].read() == "Open":
+        encstatus = self.kw('ENCSTATUS')
+        if encstatus == "Open":
             return True
         else:
-            print('ERROR! The dome did not open. In fact, it is {}'.format(self.socal['ENCSTATUS'].read()))
+            if not self.awaiting_command:
+                print('ERROR! The dome did not open. In fact, it is {}'.format(encstatus))
+            return False
+
+    @property
+    def dome_fault(self):
+        """ The enclosure reports a state other than open/closed/moving, e.g. stopped halfway """
+        return self.kw('ENCSTATUS') not in ['Open', 'Closed', 'Opening', 'Closing']
 
     @property
     def dome_not_open(self):
         """ Check if enclosure is not open """
-        return not self.dome_is_open()
+        return self.kw('ENCSTATUS') != "Open"
     
     @property
     def dome_is_closed(self):
         """ Check that the enclosure is closed """
-        if self.socal['ENCSTATUS'].read() == "Closed":
+        encstatus = self.kw('ENCSTATUS')
+        if encstatus == "Closed":
             return True
         else:
-            print('ERROR! The dome did not close. In fact, it is {}'.format(self.socal['ENCSTATUS'].read()))
+            if not self.awaiting_command:
+                print('ERROR! The dome did not close. In fact, it is {}'.format(encstatus))
+            return False
                
     @property
     def dome_not_closed(self):
         """ Check if enclosure is not closed """
-        return not self.dome_is_closed()
+        return self.kw('ENCSTATUS') != "Closed"
     
     @property
     def tracker_is_home(self):
         """ Verify tracker is in 'home' position """
-        # current_alt = self.socal['EKOALT'].read()
-        # current_az  = self.socal['EKOAZ'].read()
-        # track_mode  = self.socal['EKOMODE'].read()
+        # current_alt = self.kw('EKOALT')
+        # current_az  = self.kw('EKOAZ')
+        # track_mode  = self.kw('EKOMODE')
         # return (current_alt == 0) and (current_az == 0) and (track_mode == '0')
-        return self.socal['EKOHOME'].read()
+        return as_bool(self.kw('EKOHOME'))
     
     @property
     def tracker_not_home(self):
         """ Check that the tracker is not guiding on the Sun """
-        return not self.tracker_is_home()
+        return not self.tracker_is_home
+
+    @property
+    def tracker_is_powered(self):
+        """ Verify the tracker relay is on and the tracker answers (booted and initialized) """
+        return self.written('EKOPOWER', self._power_write) and self.kw('EKOPOWER') == 'on' \
+            and as_bool(self.kw('EKOONLINE'))
+
+    @property
+    def tracker_not_powered(self):
+        """ Check that the tracker is not powered on and answering """
+        return not self.tracker_is_powered
+
+    @property
+    def tracker_is_off(self):
+        """ Verify the tracker relay is off """
+        return self.written('EKOPOWER', self._power_write) and self.kw('EKOPOWER') == 'off'
+
+    @property
+    def tracker_not_off(self):
+        """ Check that the tracker relay is not off """
+        return not self.tracker_is_off
 
     ################################# TRANSITION DEFINITIONS #################################
     # Three stages to every transition
@@ -202,16 +700,16 @@ class SoCal(object):
         # 3. postcondition: Did the device(s) successfully transition?
         #   - If not, move to ERROR STATE
 
-    ############################ power_on: PoweredOff --> Stowed ############################
+    ############################ power_on: PoweredOff --> PoweringOn --> Stowed ############################
     def can_power_on(self):
         # Precondition check for transition `power_on`
         # TODO
         return True
 
     def power_on_system(self):
-        # Turn on SoCal main power
-        # TODO
+        ''' Power the tracker on (DomeGuard relay); it boots and is initialized while SoCal waits PoweringOn '''
         print('Powering on SoCal')
+        self._power_write = self.kw_write('EKOPOWER', 'on', wait=False)
 
     def did_power_on(self):
         # Postcondition check for transition `power_on`
@@ -221,56 +719,222 @@ class SoCal(object):
     ############################ open: Stowed --> Opening ############################
     def can_open(self):
         ''' Verify we can communicate with the enclosure '''
-        return self.socal['ENCONLINE'].read()
+        return as_bool(self.kw('ENCONLINE'))
 
     def open_dome(self):
         ''' Send command to DomeGuard to open the enclosure '''
-        self.socal['ENCCMD'].write('open')
+        self.kw_write('ENCCMD', 'open', wait=False)
         
+    def preposition_tracker(self):
+        '''
+        With `overlap`, start the tracker toward the Sun in calculation mode (1) as
+        soon as the dome is told to open, instead of once it is open
+        '''
+        if not self.overlap:
+            return
+        alt, az = float(self.kw('EKOALT')), float(self.kw('EKOAZ'))
+        sun_alt, sun_az = float(self.kw('SUNALT')), float(self.kw('SUNAZ'))
+        print('Pre-positioning the tracker on the Sun while the dome opens...')
+        self.kw_write('EKOMODE', '1', wait=False)
+        self._preposition = (self.loop.time(), max(abs(sun_alt - alt), abs(sun_az - az))/self.TRACKER_SLEW_RATE)
+
+    def end_preposition(self):
+        ''' The dome is open: count the slew time that overlapped with the opening '''
+        if self._preposition is None:
+            return
+        start, slew = self._preposition
+        self._preposition = None
+        saved = min(self.loop.time() - start, slew)
+        day = self.schedule.day if self.schedule is not None else None
+        self.overlap_saved[day] = self.overlap_saved.get(day, 0.) + saved
+        metrics.REGISTRY.inc('socal_overlap_seconds_saved_total', saved, instance=self.name)
+
+    def abort_preposition(self):
+        ''' Interlock: the dome faulted (or the weather turned) while the tracker was pre-positioned '''
+        if self._preposition is None:
+            return
+        self._preposition = None
+        print('Dome did not open cleanly, stowing the pre-positioned tracker.')
+        self.kw_write('EKOCMD', 'stow', wait=False)
+        metrics.REGISTRY.inc('socal_overlap_aborts_total', instance=self.name)
+
+    def stow_prepositioned(self):
+        '''
+        Interlock: the weather turned while the dome opened, so it closes again right away.
+        A tracker pre-positioned on the Sun (still in calculation mode 1) is stowed meanwhile
+        '''
+        if not self.overlap or self.kw('EKOMODE') != '1':
+            return
+        print('Weather turned while the dome opened, stowing the pre-positioned tracker.')
+        self.kw_write('EKOCMD', 'stow', wait=False)
+        metrics.REGISTRY.inc('socal_overlap_aborts_total', instance=self.name)
+
     ############################ guide: Opening --> OnSky ############################
     def can_guide(self):
         ''' Verify we can communicate with the sun tracker '''
-        return self.socal['EKOONLINE'].read()
+        return as_bool(self.kw('EKOONLINE'))
 
     def acquire_sun(self):
         ''' set tracking_mode 3 '''
         print('Setting tracker to active guiding mode...')
-        self.socal['EKOCMD'].write('guide') # self.socal['EKOMODE'].write('3')
+        self._acquiring = self.loop.time()
+        self.kw_write('EKOCMD', 'guide', wait=False) # self.kw_write('EKOMODE', '3')
+
+    def end_acquisition(self):
+        ''' Locked on the Sun: record how long the acquisition took, per day '''
+        if self._acquiring is None:
+            return
+        seconds = self.loop.time() - self._acquiring
+        self._acquiring = None
+        day = self.schedule.day if self.schedule is not None else None
+        self.acquisition_times.setdefault(day, []).append(seconds)
+        metrics.REGISTRY.observe('socal_acquisition_seconds', seconds, instance=self.name)
+
+    ############################ Daily schedule ############################
+    def schedule_day(self):
+        '''
+        Compute today's Sun limit crossings from the ephemeris and arm timers to
+        open at sunrise (through SUN_ALT_LIMIT) and close at sunset, instead of
+        polling SUNALT. Re-runs itself at the next local midnight.
+        '''
+        from control import ephemeris # numpy is only needed once the machine runs
+
+        for timer in self._day_timers:
+            timer.cancel()
+        now = self.loop.time()
+        self.schedule = ephemeris.schedule_for(now, self.SUN_ALT_LIMIT)
+        print('Sun schedule: {}'.format(self.schedule))
+        self._day_timers = [self.loop.call_at(self.schedule.end, self.schedule_day)]
+        rise = self.schedule.next_rise(now)
+        if rise is not None:
+            self._day_timers.append(self.loop.call_at(rise, self.on_sunrise))
+        if self.state == 'OnSky':
+            self.schedule_onsky_check() # Re-arm against the new sunset
+
+    def on_sunrise(self):
+        ''' The Sun just cleared SUN_ALT_LIMIT: open if SoCal is waiting Stowed '''
+        self.reopen()
+
+    def reopen(self):
+        '''
+        While the Sun is up, open if SoCal is waiting Stowed (e.g. closed for the
+        weather, or powered on late). If it cannot yet, try again in OPEN_RETRY s;
+        WXSAFE turning safe tries right away (see on_keyword_event)
+        '''
+        self.cancel_reopen()
+        if self.state != 'Stowed' or self.schedule is None or not self.schedule.is_up(self.loop.time()):
+            return
+        self.open()
+        if self.state == 'Stowed':
+            self._reopen_timer = self.loop.call_later(self.OPEN_RETRY, self.reopen)
+
+    def schedule_reopen(self):
+        ''' Entering Stowed: try to open once the transition is over '''
+        self.cancel_reopen()
+        self._reopen_timer = self.loop.call_soon(self.reopen)
+
+    def cancel_reopen(self):
+        if self._reopen_timer is not None:
+            self._reopen_timer.cancel()
+            self._reopen_timer = None
+
+    ############################ OnSky loop: OnSky --> OnSky ############################
+    def note_conditions(self, wxsafe):
+        ''' Remember the latest weather reading, used to pick the next OnSky check interval '''
+        if self._last_wxsafe is not None and wxsafe != self._last_wxsafe:
+            self._wx_changed_at = self.loop.time()
+        self._last_wxsafe = wxsafe
+
+    def onsky_interval(self):
+        '''
+        Seconds until the next OnSky check. Checks are frequent right after a weather
+        change and when the Sun is close to the altitude limit, and back off to
+        ONSKY_MAX_INTERVAL when the Sun is high and the weather is stable.
+        '''
+        if self._wx_changed_at is not None and self.loop.time() - self._wx_changed_at < self.WX_SETTLE_TIME:
+            return self.ONSKY_MIN_INTERVAL
+        if self.schedule is not None:
+            # The end of the day is its own timer, at the scheduled crossing (schedule_onsky_check)
+            return self.ONSKY_MAX_INTERVAL
+        if self._last_sunalt is None:
+            return self.ONSKY_MIN_INTERVAL
+        # Check at least twice before the Sun could possibly reach the limit
+        time_to_limit = (self._last_sunalt - self.SUN_ALT_LIMIT) / self.SUN_ALT_MAX_RATE
+        return min(max(time_to_limit/2., self.ONSKY_MIN_INTERVAL), self.ONSKY_MAX_INTERVAL)
+
+    def schedule_onsky_check(self):
+        ''' Arm the timer for the next OnSky check (replaces the old sleep + re-entry recursion) '''
+        self.cancel_onsky_check()
+        now  = self.loop.time()
+        when = now + self.onsky_interval()
+        if self.schedule is not None:
+            sunset = self.schedule.next_set(now)
+            if sunset is not None:
+                when = min(when, sunset)
+        self._onsky_timer = self.loop.call_at(when, self._onsky_check)
+
+    def cancel_onsky_check(self):
+        if self._onsky_timer is not None:
+            self._onsky_timer.cancel()
+            self._onsky_timer = None
+
+    def _onsky_check(self):
+        self._onsky_timer = None
+        if self.state == 'OnSky':
+            self.monitor_onsky()
+
+    def poke(self):
+        '''
+        Check the OnSky conditions right away instead of waiting for the timer,
+        e.g. on a weather alert. Safe to call from any thread.
+        '''
+        self.loop.call_soon(self._poke)
+
+    def _poke(self):
+        if self.state == 'OnSky':
+            self.cancel_onsky_check()
+            self.monitor_onsky()
+
+    def trigger_soon(self, trigger, *args, **kwargs):
+        ''' Fire a trigger (e.g. 'open') on the machine's event loop; safe to call from any thread '''
+        self.loop.call_soon(lambda: self.trigger(trigger, *args, **kwargs))
 
-    def wait(self):
-        ''' wait a few seconds so we don't have a super-fast internal loop '''
-        time.sleep(5)
+    def run(self):
+        ''' Run the machine's event loop in this thread until loop.stop() is called '''
+        self.resume()
+        self.loop.run_forever()
         
     ############################ close: OnSky --> Closing ############################
     def can_close(self):
         ''' Verify we can communicate with the enclosure '''
-        return self.socal['ENCONLINE'].read()
+        return as_bool(self.kw('ENCONLINE'))
 
     def close_dome(self):
         ''' Send command to DomeGuard to open the enclosure '''
-        self.socal['ENCCMD'].write('close')
+        self.kw_write('ENCCMD', 'close', wait=False)
 
     ############################ stow: Closing --> Stowed ############################
     def can_stow(self):
         ''' Verify we can communicate with the sun tracker '''
-        return self.socal['EKOONLINE'].read()
+        return as_bool(self.kw('EKOONLINE'))
 
     def home_tracker(self):
         ''' Tell the tracker to point back to its 'home' position '''
         print("Dome closed. Moving tracker to 'home'...")
-        self.socal['EKOCMD'].write('stow')
-        # self.socal['EKOSETALT'].write(0.0)
-        # self.socal['EKOSETAZ'].write(0.0)
-        # self.socal['EKOSLEW'].write(True)
+        self.kw_write('EKOCMD', 'stow', wait=False)
+        # self.kw_write('EKOSETALT', 0.0)
+        # self.kw_write('EKOSETAZ', 0.0)
+        # self.kw_write('EKOSLEW', True)
 
-    ############################ close: Stowed --> PoweredOff ############################
+    ############################ power_off: Stowed --> PoweringOff --> PoweredOff ############################
     def can_power_off(self):
         # Precondition check for transition `power_off`
         return True
 
     def power_down_system(self):
-        # Turn off SoCal main power
+        ''' Power the (stowed) tracker off on the DomeGuard relay, without waiting (see PoweringOff) '''
         print('Powering off SoCal.')
+        self._power_write = self.kw_write('EKOPOWER', 'off', wait=False)
 
     def did_power_off(self):
         # Postcondition check for transition `power_off`
@@ -281,9 +945,9 @@ class SoCal(object):
     def go_offline(self):
         ''' If the something goes offline, close the dome for safety '''
         if self.can_close():
-            self.close_dome()
+            self.kw_write('ENCCMD', 'close') # Wait for the dome, unlike close_dome()
 
-            if self.dome_not_closed():
+            if self.dome_not_closed:
                 print('ERRROR: Dome did not close!')
         else:
             print('ERRROR: Cannot close dome!')
@@ -292,34 +956,30 @@ class SoCal(object):
 
     def try_recover(self):
         ''' Figure out what state SoCal was in when it went offline, and try to re-establish that state '''
-        if self.socal['ENCSTATUS'].read() == 'Open' and self.socal['EKOMODE'] == '3':
+        encstatus = self.kw('ENCSTATUS')
+        ekomode   = self.kw('EKOMODE')
+        ekohome   = as_bool(self.kw('EKOHOME'))
+        if encstatus == 'Open' and ekomode == '3':
             # force transition to OnSky
             self.to_OnSky()
-        elif self.socal['ENCSTATUS'].read() == 'Open' and self.socal['EKOHOME'].read():
+        elif encstatus == 'Open' and ekohome:
             # force transition to Open
             self.to_Open()
-        elif self.socal['ENCSTATUS'].read() == 'Closed' and not self.socal['EKOHOME'].read():
+        elif encstatus == 'Closed' and not ekohome:
             # force transition to Closed
             self.to_Closed()
         else:
             # Try to restore tracker and dome to stowed/closed positions
             try:
-                self.socal['ENCCMD'].write('close')
-                self.socal['EKOCMD'].write('home')        
+                self.kw_write('ENCCMD', 'close')
+                self.kw_write('EKOCMD', 'home')        
                 self.to_Stowed()
             except Exception as e:
                 print(e)
         
     def did_recover(self):
         ''' Verify self.state is consistent with ENCSTATUS and EKOMODE/EKOHOME '''
-        encstatus = self.socal['ENCSTATUS'].read()
-        ekomode   = self.socal['EKOMODE'].read()
-        ekohome   = self.socal['EKOHOME'].read()
-
-        device_status = {'Stowed': ('Closed', '0', True),
-                         'Closed': ('Closed', '3', False),
-                         'Open'  : ('Open', '3', True),
-                         'OnSky' : ('Open', '3', False),
-                        }
-                        
-        return device_status[str(self.state)] == (encstatus, ekomode, ekohome)
\ No newline at end of file
+        encstatus = self.kw('ENCSTATUS')
+        ekomode   = self.kw('EKOMODE')
+        ekohome   = as_bool(self.kw('EKOHOME'))
+        return SoCal.DEVICE_STATUS.get(str(self.state)) == (encstatus, ekomode, ekohome)
\ No newline at end of file
@@ -0,0 +1,91 @@
+############################################################
+#
+#  bench_broadcast.py
+#
+#  Volume of kpfsocal keyword broadcasts with and without
+#  deadbands. A real SoCalDispatcher polls stand-in devices
+#  (sim.standins) with noise on every reading, and two
+#  services on top of it follow the same telemetry: one with
+#  the default deadbands and heartbeat (localktl.DEADBANDS),
+#  one broadcasting every change. A stand-in client
+#  (localktl.BroadcastCounter) monitors each and counts what
+#  reaches it, against the values read, which a server
+#  republishing everything would have sent.
+#
+#  Usage: python benchmarks/bench_broadcast.py [-d SECONDS] [--json]
+#
+############################################################
+
+import os
+import sys
+import json
+import time
+import argparse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import localktl
+from sim import standins
+
+POLL = 0.1 # [s] device poll cadence, faster than in operation
+
+# Reading noise of the stand-ins, about that of the real devices
+NOISE = {standins.StandInTracker      : 0.001, # [deg]
+         standins.StandInPyrheliometer: 0.5,   # [W/m^2]
+         standins.StandInDome         : 0.05,  # [A, C]
+        }
+
+def run(duration=10., heartbeat=localktl.HEARTBEAT):
+    '''
+    Returns: (dict) 'deadband' and 'every_change': BroadcastCounter reports
+    '''
+    from Dispatcher import SoCalDispatcher
+    noise = {cls: cls.NOISE for cls in NOISE}
+    for cls, sigma in NOISE.items():
+        cls.NOISE = sigma
+    standins.use_standins()
+    dispatcher = SoCalDispatcher(name='bench')
+    try:
+        dispatcher.start_polling({device: POLL for device in dispatcher.POLL_CADENCE})
+        dispatcher.tracking_mode = '3' # Guiding, so the sun sensor offsets are polled too
+        deadbanded = localktl.dispatcher_service(dispatcher, heartbeat=heartbeat)
+        every_change = localktl.dispatcher_service(dispatcher, deadbands={name: None for name in localktl.DEADBANDS},
+                                                   heartbeat=None)
+        counters = {'deadband'    : localktl.BroadcastCounter(deadbanded),
+                    'every_change': localktl.BroadcastCounter(every_change)}
+        time.sleep(duration)
+        for counter in counters.values():
+            counter.close()
+        return {name: counter.report() for name, counter in counters.items()}
+    finally:
+        dispatcher.shutdown()
+        for cls, sigma in noise.items():
+            cls.NOISE = sigma
+
+def main():
+    parser = argparse.ArgumentParser(description='kpfsocal keyword broadcast volume with and without deadbands')
+    parser.add_argument('-d', '--duration', type=float, default=10., help='seconds of polling')
+    parser.add_argument('--heartbeat', type=float, default=localktl.HEARTBEAT, help='seconds between heartbeats')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.duration, args.heartbeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    deadband, every_change = results['deadband'], results['every_change']
+    print('{:<12} {:>8} {:>13} {:>10} {:>10}'.format('keyword', 'updates', 'every change', 'deadband', 'reduction'))
+    for name in sorted(deadband):
+        if name == 'total' or not deadband[name]['updates']: # Memory keywords nobody wrote
+            continue
+        updates, sent = deadband[name]['updates'], deadband[name]['received']
+        print('{:<12} {:>8} {:>13} {:>10} {:>9.0%}'.format(name, updates, every_change[name]['received'], sent,
+                                                          1. - sent/updates if updates else 0.))
+    total = deadband['total']
+    print('{:<12} {:>8} {:>13} {:>10} {:>9.0%}'.format('total', total['updates'], every_change['total']['received'],
+                                                      total['received'], total['reduction']))
+    print('bytes: {} every change, {} with deadbands'.format(every_change['total']['bytes'], total['bytes']))
+
+if __name__ == '__main__':
+    main()
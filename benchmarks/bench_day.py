@@ -0,0 +1,76 @@
+############################################################
+#
+#  bench_day.py
+#
+#  Full-day regression benchmark: runs the SoCal state
+#  machine through simulated days (sim.day) in virtual time
+#  and reports transitions, time-to-OnSky, on-sky fraction,
+#  seconds saved by pre-positioning the tracker while the
+#  dome opens, mean Sun acquisition time, and the wall-clock
+#  cost of a day. Exits non-zero if a day does not end
+#  PoweredOff or misses its on-sky floor.
+#
+#  Usage: python benchmarks/bench_day.py [-n REPEATS] [--json]
+#
+############################################################
+
+import os
+import sys
+import json
+import argparse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from sim.day import simulate_day
+
+# name -> (simulate_day kwargs, minimum on-sky fraction)
+SCENARIOS = {
+    'clear':        ({'date': '2024-06-21'}, 0.95),
+    'winter':       ({'date': '2024-12-21'}, 0.95),
+    'midday-cloud': ({'date': '2024-06-21', 'unsafe': [('13:00', '13:45')]}, 0.95),
+    'restart':      ({'date': '2024-06-21', 'restart': '11:00'}, 0.95),
+    'overlap':      ({'date': '2024-06-21', 'socal_options': {'overlap': True}}, 0.95),
+    'showers':      ({'date': '2024-06-21', 'unsafe': [('09:30', '09:50'), ('11:10', '12:00'), ('15:00', '15:05')]}, 0.90),
+}
+
+def run_scenario(name, repeats=3):
+    kwargs, floor = SCENARIOS[name]
+    walls = []
+    for i in range(repeats):
+        report = simulate_day(**kwargs)
+        walls.append(report['wall_seconds'])
+    walls.sort()
+    ok = report['final_state'] == 'PoweredOff' and report['onsky_fraction'] >= floor \
+        and all(r['resumed'] for r in report['restarts']) # Warm restarts must resume from the checkpoint
+    return {'scenario': name, 'transitions': report['transitions'],
+            'time_to_onsky': report['time_to_onsky'], 'onsky_fraction': report['onsky_fraction'],
+            'overlap_saved': report['overlap_saved'],
+            'acquisition': sum(report['acquisitions'])/len(report['acquisitions']) if report['acquisitions'] else None,
+            'final_state': report['final_state'], 'best': walls[0], 'median': walls[len(walls)//2],
+            'ok': ok}
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated-day regression benchmark for SoCal')
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='runs per scenario')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('scenarios', nargs='*', default=sorted(SCENARIOS), help='scenarios to run')
+    args = parser.parse_args()
+
+    results = [run_scenario(name, args.repeats) for name in args.scenarios]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:<14} {:>5} {:>10} {:>8} {:>8} {:>8} {:>12} {:>10}  {}'.format(
+            'scenario', 'trans', 'to OnSky', 'on-sky', 'saved', 'acquire', 'final', 'wall [ms]', ''))
+        for r in results:
+            to_onsky = '-' if r['time_to_onsky'] is None else '{:.0f} s'.format(r['time_to_onsky'])
+            print('{:<14} {:>5} {:>10} {:>8.1%} {:>8} {:>8} {:>12} {:>10.1f}  {}'.format(
+                r['scenario'], r['transitions'], to_onsky, r['onsky_fraction'],
+                '{:.0f} s'.format(r['overlap_saved']),
+                '-' if r['acquisition'] is None else '{:.0f} s'.format(r['acquisition']), r['final_state'],
+                1e3*r['median'], 'ok' if r['ok'] else 'REGRESSION'))
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+############################################################
+#
+#  bench_emergency_close.py
+#
+#  Latency from an unsafe signal (WXSAFE written unsafe, or
+#  rain on the DomeGuard sensor) to the close command reaching
+#  the dome, through a real SoCalDispatcher and its kpfsocal
+#  keywords on stand-in devices (sim.standins) under load:
+#  aggressive background polling plus bursts of ordinary
+#  dome requests. Compares the emergency lane with a close
+#  queued like any other request, and exits non-zero if the
+#  emergency close ever exceeds its bound: the request
+#  already on the wire plus a small scheduling margin (and,
+#  for rain, one dome poll).
+#
+#  Usage: python benchmarks/bench_emergency_close.py [-n TRIALS] [--json]
+#
+############################################################
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import localktl
+from sim.standins import use_standins, StandInDome
+from control.workers import NORMAL
+
+MARGIN = 0.010 # [s] allowed on top of the dome request in flight
+POLL   = 0.1   # [s] device poll cadence, much faster than in operation
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q*len(values)))]
+
+def close_sent(dome, since, timeout=5.):
+    ''' Time the first close command at/after `since` reached the dome '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for t, command in list(dome.commands):
+            if t >= since and command == 'close':
+                return t
+        time.sleep(0.0005)
+    raise RuntimeError('Dome never got a close command')
+
+def run(trials=20, backlog=20, latency=0.02, signal='WXSAFE', lane='emergency'):
+    '''
+    Returns: (list) latencies [s] from the signal to the close command at the dome
+    '''
+    from Dispatcher import SoCalDispatcher
+    StandInDome.LATENCY = latency
+    dispatcher = SoCalDispatcher(name='bench')
+    dispatcher.start_polling({'dome': POLL, 'tracker': POLL, 'pyrheliometer': POLL})
+    service = localktl.dispatcher_service(dispatcher)
+    dome = dispatcher.workers['dome'].driver
+    if lane != 'emergency':
+        # Baseline: the unsafe signal queues an ordinary close behind everything else
+        dispatcher.emergency_close = lambda reason='WXSAFE', signaled=None: \
+            dispatcher.submit('dome', 'close', priority=NORMAL)
+
+    # Bursts of `backlog` ordinary dome requests (KTL reads, commands) keep the dome
+    # busy half of the time, on top of its polls
+    stop = threading.Event()
+    def load():
+        while not stop.wait(2*backlog*latency):
+            for i in range(backlog):
+                dispatcher.submit('dome', 'status')
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+
+    latencies = []
+    try:
+        for i in range(trials):
+            service['WXSAFE'].write(True)
+            dome.rain = 'off'
+            dome.set_position('Open')
+            time.sleep(0.1 + 0.01*(i % 7)) # Land at different points of the poll cycle
+            signaled = time.monotonic()
+            if signal == 'WXSAFE':
+                service['WXSAFE'].write(False)
+            else:
+                dome.rain = 'on'
+            latencies.append(close_sent(dome, signaled) - signaled)
+            while dome.position != 'Closing': # Let the close finish before resetting the dome
+                time.sleep(0.001)
+    finally:
+        stop.set()
+        loader.join()
+        dispatcher.shutdown()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of the SoCal emergency dome close under load')
+    parser.add_argument('-n', '--trials', type=int, default=20, help='unsafe signals per case')
+    parser.add_argument('--backlog', type=int, default=20, help='ordinary dome requests per burst')
+    parser.add_argument('--latency', type=float, default=0.02, help='stand-in dome round trip [s]')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    use_standins()
+    bound = args.latency + MARGIN
+    results = []
+    import contextlib
+    for signal, lane in [('WXSAFE', 'emergency'), ('rain', 'emergency'), ('WXSAFE', 'queued')]:
+        with open(os.devnull, 'w') as out, contextlib.redirect_stdout(out):
+            latencies = run(args.trials, args.backlog, args.latency, signal, lane)
+        # Rain is only seen by the next dome poll: a poll cycle, the request ahead of it and the poll itself
+        limit = bound + (POLL + 2*args.latency if signal == 'rain' else 0.)
+        results.append({'signal': signal, 'lane': lane, 'p50': percentile(latencies, 0.5),
+                        'p99': percentile(latencies, 0.99), 'max': max(latencies),
+                        'bound': limit if lane == 'emergency' else None,
+                        'ok': lane != 'emergency' or max(latencies) <= limit})
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:<8} {:<10} {:>9} {:>9} {:>9} {:>10}  {}'.format('signal', 'lane', 'p50 [ms]', 'p99 [ms]',
+                                                               'max [ms]', 'bound [ms]', ''))
+        for r in results:
+            print('{:<8} {:<10} {:>9.1f} {:>9.1f} {:>9.1f} {:>10}  {}'.format(
+                r['signal'], r['lane'], 1e3*r['p50'], 1e3*r['p99'], 1e3*r['max'],
+                '-' if r['bound'] is None else '{:.0f}'.format(1e3*r['bound']),
+                '' if r['bound'] is None else ('ok' if r['ok'] else 'REGRESSION')))
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+if __name__ == '__main__':
+    main()
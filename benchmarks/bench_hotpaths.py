@@ -0,0 +1,349 @@
+############################################################
+#
+#  bench_hotpaths.py
+#
+#  Micro-benchmarks of the hot paths, offline: EKO reply
+#  parsing, DomeGuard status parsing (full and short, both
+#  on its own and through the dispatcher), Modbus register
+#  decoding in the pyrheliometer poll, exposure metering
+#  (irradiance.exposure_meter), kpfsocal keyword
+#  reads through a real SoCalDispatcher on zero-latency
+#  stand-ins (sim.standins), and SoCal open/close cycles in
+#  virtual time (sim.world). Reports the median time per
+#  operation, writes the results as JSON, and compares them
+#  with a stored baseline: exits non-zero if any case got
+#  slower than the baseline by more than the tolerance.
+#
+#  The EKO commands sleep a fixed 0.1 s for the reply to
+#  arrive; that settle is skipped here so the parsing (and
+#  the metrics around it) is what gets measured.
+#
+#  Usage: python benchmarks/bench_hotpaths.py [--output results.json]
+#             [--baseline baseline.json [--tolerance 0.5]] [--save-baseline baseline.json]
+#             [CASE ...]
+#
+############################################################
+
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import contextlib
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+REPEATS  = 5   # timings per case, the median is reported
+MIN_TIME = 0.2 # [s] each timing runs for at least this long
+
+def timeit(fn, repeats=REPEATS, min_time=MIN_TIME):
+    '''
+    Time `fn()`, autoranging the number of calls per timing
+
+    Returns: (median, best) [ns] per call, and the calls per timing
+    '''
+    number = 1
+    while True:
+        start = time.perf_counter_ns()
+        for i in range(number):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= 1e9*min_time:
+            break
+        number *= 10 if elapsed < 1e8*min_time else 2
+    timings = [elapsed/number]
+    for r in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for i in range(number):
+            fn()
+        timings.append((time.perf_counter_ns() - start)/number)
+    timings.sort()
+    return timings[len(timings)//2], timings[0], number
+
+############################### EKO sun tracker ###############################
+class EKOSocket(object):
+    ''' Answers EKO commands like the tracker does, at once '''
+
+    REPLIES = {b'MR': b'123.13300,15.12300,OK\r', # Corrected position: az, alt
+               b'MD': b'3,OK\r'}                  # Tracking mode
+
+    def __init__(self):
+        self.reply = b''
+
+    def send(self, command):
+        self.reply = self.REPLIES.get(command.split(b',')[0].strip(), b'OK\r')
+        return len(command)
+
+    def recv(self, size):
+        return self.reply
+
+@contextlib.contextmanager
+def no_settle(module):
+    ''' Skip the fixed settle sleeps of `module` (its `time.sleep`) '''
+    real = module.time
+    module.time = types.SimpleNamespace(sleep=lambda seconds: None)
+    try:
+        yield
+    finally:
+        module.time = real
+
+def eko_cases():
+    from control import eko_commands as eko
+    tracker = EKOSocket()
+    def position():
+        with no_settle(eko):
+            return eko.get_corrected_position(tracker)
+    def mode():
+        with no_settle(eko):
+            return eko.get_tracking_mode(tracker)
+    assert position() == (15.123, 123.133) and mode() == '3'
+    return {'eko.get_corrected_position': position, 'eko.get_tracking_mode': mode}
+
+################################### DomeGuard ##################################
+def domeguard_cases():
+    from control import domeguard
+    from sim.standins import StandInDome
+    dome = StandInDome(latency=0.)
+    dome.set_position('Open')
+    full, short = dome.status()[0], dome.status(short=True)[0]
+    assert domeguard.parse_status(full)['Status'] == domeguard.parse_short_status(short)['Status'] == 'Open'
+    dome.set_position('Closed')
+    moved = dome.status(short=True)[0]
+    # A short poll between two full reads: parse the short status and merge it into the full one
+    parsed = domeguard.parse_status(full)
+    return {'domeguard.parse_status':       lambda: domeguard.parse_status(full),
+            'domeguard.parse_short_status': lambda: domeguard.parse_short_status(short),
+            'domeguard.merge_status':       lambda: domeguard.merge_status(parsed, domeguard.parse_short_status(short)),
+            'domeguard.merge_status.moved': lambda: domeguard.merge_status(parsed, domeguard.parse_short_status(moved))}
+
+################################# Pyrheliometer #################################
+def pyrheliometer_cases():
+    from pymodbus.constants import Endian
+    from pymodbus.payload import BinaryPayloadBuilder
+    from pymodbus.register_read_message import ReadHoldingRegistersResponse
+    from irradiance.pyrheliometer import EKOPyrheliometer
+
+    # Registers 16-24 as the MC-20 holds them: sensitivity, (unused), output voltage, irradiance, temperature
+    builder = BinaryPayloadBuilder(byteorder=Endian.Big, wordorder=Endian.Little)
+    builder.add_32bit_float(8.0)
+    builder.add_16bit_uint(0)
+    for value in [7.2, 900., 25.]:
+        builder.add_32bit_float(value)
+    values = builder.to_registers()
+
+    class Client(object):
+        ''' ModbusTcpClient answering from fixed registers '''
+        def __init__(self, **kwargs):
+            pass
+        def read_holding_registers(self, address, count, unit=1):
+            return ReadHoldingRegistersResponse([0, 2000] if address == 13 else values)
+
+    pyr = EKOPyrheliometer('standin', 502, transport=Client)
+    assert round(pyr.poll()[4]) == 900
+    return {'pyrheliometer.poll': pyr.poll}
+
+################################ Exposure meter ################################
+def exposure_meter_cases():
+    from irradiance.exposure_meter import ExposureMeter
+    meter = ExposureMeter(snr_coefficient=1.0)
+    for i in range(3): # Overlapping exposures, each sample updates all of them
+        meter.start('exposure{}'.format(i), 0.)
+    clock = iter(range(1, 1 << 62))
+    return {'exposure_meter.add'   : lambda: meter.add(next(clock), 900.),
+            'exposure_meter.result': lambda: meter.result('exposure0', now=1e9)}
+
+################################## Dispatcher ##################################
+@contextlib.contextmanager
+def zero_latency_dispatcher(polling=False):
+    ''' A SoCalDispatcher on stand-ins that answer at once, polling in the background or not '''
+    import drivers
+    from sim import standins
+    from Dispatcher import SoCalDispatcher
+    registered = dict(drivers.DRIVERS)
+    classes = [standins.StandInDome, standins.StandInTracker, standins.StandInPyrheliometer]
+    latencies = [cls.LATENCY for cls in classes]
+    for cls in classes:
+        cls.LATENCY = 0.
+    standins.use_standins()
+    dispatcher = SoCalDispatcher(name='bench')
+    try:
+        if polling:
+            dispatcher.start_polling()
+            deadline = time.monotonic() + 5.
+            while not all(key in dispatcher.poller.snapshot for key in ['dome_status', 'tracking_mode']):
+                assert time.monotonic() < deadline, 'No telemetry snapshot from the stand-ins'
+                time.sleep(0.01)
+        yield dispatcher
+    finally:
+        dispatcher.shutdown()
+        for cls, latency in zip(classes, latencies):
+            cls.LATENCY = latency
+        drivers.DRIVERS.update(registered)
+
+def dispatcher_cases():
+    return {'dispatcher.get_dome_status':       lambda d: d.get_dome_status(),
+            'dispatcher.get_dome_status.short': lambda d: d.get_dome_status(short=True)}
+
+KEYWORDS = ['ENCSTATUS', 'EKOMODE', 'EKOGUIDING']
+SNAPSHOT = ['WXSAFE', 'ENCSTATUS', 'ENCONLINE', 'EKOMODE', 'EKOHOME', 'EKOGUIDING', 'EKOONLINE']
+
+def keyword_cases(prefix):
+    cases = {'{}.{}'.format(prefix, keyword): (lambda keyword: lambda s: s[keyword].read())(keyword)
+             for keyword in KEYWORDS}
+    cases['{}.read_many'.format(prefix)] = lambda s: s.read_many(SNAPSHOT)
+    return cases
+
+##################################### SoCal #####################################
+def socal_cases():
+    return {'socal.open_close_cycle': None} # Timed by run_socal_cycles
+
+def run_socal_cycles(repeats=REPEATS, min_time=MIN_TIME):
+    '''
+    Open to OnSky and close back to Stowed, over and over, on the simulated
+    hardware at local noon in virtual time (fast moves). Each cycle is
+    `open` -> Opening -> Open -> AcquiringSun -> OnSky, then WXSAFE goes
+    unsafe -> Closing -> Closed -> StowingTracker -> Stowed.
+    '''
+    from eventloop import EventLoop
+    from SolarCalibrator import SoCal
+    from sim.clock import VirtualClock
+    from sim.world import SimWorld, SimWeather, local_midnight
+
+    start = local_midnight('2024-06-21') + 12*3600
+    clock = VirtualClock(start)
+    loop  = EventLoop(clock)
+    world = SimWorld(clock, loop, weather=SimWeather(), dome_move_time=1., slew_rate=100., lock_time=1.)
+    service = world.service()
+    socal = SoCal(loop=loop, service=service)
+
+    def run_to(state, limit=3600.):
+        deadline = loop.time() + limit
+        while socal.state != state:
+            assert loop.time() < deadline, 'SoCal stuck in {} on the way to {}'.format(socal.state, state)
+            loop.run_once()
+
+    def weather(safe):
+        world.weather.unsafe = [] if safe else [(loop.time(), float('inf'))]
+        service.refresh(['WXSAFE'])
+
+    def cycle():
+        weather(safe=True)
+        socal.open()
+        run_to('OnSky')
+        weather(safe=False)
+        run_to('Stowed')
+
+    socal.power_on()
+    run_to('Stowed')
+    try:
+        return timeit(cycle, repeats, min_time)
+    finally:
+        socal.shutdown()
+
+##################################### Runner #####################################
+# Self-contained cases -> the function that sets them up
+BUILDERS = [eko_cases, domeguard_cases, pyrheliometer_cases, exposure_meter_cases]
+CASES = {'eko.get_corrected_position'  : eko_cases,
+         'eko.get_tracking_mode'       : eko_cases,
+         'domeguard.parse_status'      : domeguard_cases,
+         'domeguard.parse_short_status': domeguard_cases,
+         'domeguard.merge_status'      : domeguard_cases,
+         'domeguard.merge_status.moved': domeguard_cases,
+         'pyrheliometer.poll'          : pyrheliometer_cases,
+         'exposure_meter.add'          : exposure_meter_cases,
+         'exposure_meter.result'       : exposure_meter_cases,
+        }
+
+def run(names=None, repeats=REPEATS, min_time=MIN_TIME):
+    '''
+    Returns: (dict) case -> {'median_ns', 'best_ns', 'number'}
+    '''
+    selected = lambda cases: {name: fn for name, fn in cases.items() if not names or name in names}
+    results = {}
+    def record(name, timing):
+        median, best, number = timing
+        results[name] = {'median_ns': median, 'best_ns': best, 'number': number}
+
+    for builder in sorted(set(CASES[name] for name in CASES if not names or name in names), key=BUILDERS.index):
+        for name, fn in selected(builder()).items():
+            record(name, timeit(fn, repeats, min_time))
+    for polling, prefix in [(False, 'keyword.direct'), (True, 'keyword.polled')]:
+        cases = selected(keyword_cases(prefix))
+        if not polling:
+            cases.update(selected(dispatcher_cases()))
+        if cases:
+            import localktl
+            with zero_latency_dispatcher(polling) as dispatcher:
+                service = localktl.dispatcher_service(dispatcher)
+                for name, fn in cases.items():
+                    target = dispatcher if name.startswith('dispatcher.') else service
+                    record(name, timeit(lambda: fn(target), repeats, min_time))
+    if selected(socal_cases()):
+        record('socal.open_close_cycle', run_socal_cycles(repeats, min_time))
+    return results
+
+def all_cases():
+    return list(CASES) + list(dispatcher_cases()) + list(keyword_cases('keyword.direct')) \
+        + list(keyword_cases('keyword.polled')) + list(socal_cases())
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns: (dict) case -> median relative to the baseline (None if not in it), and
+             the cases slower than the baseline by more than `tolerance`
+    '''
+    ratios, regressions = {}, []
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratios[name] = None if base is None else result['median_ns']/base['median_ns']
+        if ratios[name] is not None and ratios[name] > 1 + tolerance:
+            regressions.append(name)
+    return ratios, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot-path micro-benchmarks for SoCal')
+    parser.add_argument('-n', '--repeats', type=int, default=REPEATS, help='timings per case')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='minimum seconds per timing')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown against the baseline (0.5: 50%% slower)')
+    parser.add_argument('--save-baseline', help='write the results as a new baseline to this JSON file')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('cases', nargs='*', help='cases to run (default: all), one of: ' + ', '.join(all_cases()))
+    args = parser.parse_args()
+
+    unknown = set(args.cases) - set(all_cases())
+    if unknown:
+        parser.error('unknown cases: {}'.format(', '.join(sorted(unknown))))
+    with open(os.devnull, 'w') as out, contextlib.redirect_stdout(out):
+        results = run(args.cases, args.repeats, args.min_time)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    ratios, regressions = compare(results, baseline, args.tolerance)
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'results': results}
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(dict(report, baseline=ratios, regressions=regressions), indent=2))
+    else:
+        print('{:<36} {:>12} {:>12} {:>10}  {}'.format('case', 'median', 'best', 'vs base', ''))
+        unit = lambda ns: '{:.1f} us'.format(ns/1e3) if ns < 1e6 else '{:.2f} ms'.format(ns/1e6)
+        for name, r in results.items():
+            ratio = ratios[name]
+            print('{:<36} {:>12} {:>12} {:>10}  {}'.format(
+                name, unit(r['median_ns']), unit(r['best_ns']), '-' if ratio is None else '{:.2f}x'.format(ratio),
+                'REGRESSION' if name in regressions else ''))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
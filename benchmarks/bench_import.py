@@ -0,0 +1,74 @@
+############################################################
+#
+#  bench_import.py
+#
+#  Import-time benchmark for the SoCal dispatcher and state
+#  machine. Each module is imported in a fresh interpreter so
+#  the numbers reflect a cold dispatcher restart / CLI start.
+#
+#  Usage: python benchmarks/bench_import.py [-n REPEATS]
+#
+############################################################
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules to time, and the heavy dependencies that should NOT be imported along with them
+MODULES = ['drivers', 'Dispatcher', 'SolarCalibrator']
+HEAVY   = ['numpy', 'websocket', 'pymodbus', 'astropy', 'graphviz', 'pygraphviz',
+           'transitions.extensions.diagrams',
+           'control.dome', 'control.sun_tracker', 'irradiance.pyrheliometer']
+
+PROBE = '''
+import sys, time, json
+t0 = time.perf_counter()
+try:
+    import {module}
+    error = None
+except Exception as e:
+    error = repr(e)
+t1 = time.perf_counter()
+print(json.dumps({{'seconds': t1 - t0, 'error': error,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def time_import(module, repeats=5):
+    '''
+    Import `module` in `repeats` fresh interpreters
+
+    Returns:
+        result: (dict) best/median import time [s], import error (if any)
+                       and the heavy modules that were pulled in
+    '''
+    times = []
+    for i in range(repeats):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+                             cwd=REPO, capture_output=True, text=True, check=True)
+        probe = json.loads(out.stdout.strip().split('\n')[-1])
+        times.append(probe['seconds'])
+    times.sort()
+    return {'module': module, 'best': times[0], 'median': times[len(times)//2],
+            'error': probe['error'], 'heavy': probe['heavy']}
+
+def main():
+    parser = argparse.ArgumentParser(description='Time cold imports of SoCal modules')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = [time_import(module, args.repeats) for module in MODULES]
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    for r in results:
+        print('{:<16s} best {:7.2f} ms   median {:7.2f} ms   heavy imports: {}{}'.format(
+              r['module'], 1e3*r['best'], 1e3*r['median'], ', '.join(r['heavy']) or 'none',
+              '' if r['error'] is None else '   ERROR: ' + r['error']))
+
+if __name__ == '__main__':
+    main()
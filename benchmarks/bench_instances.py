@@ -0,0 +1,68 @@
+############################################################
+#
+#  bench_instances.py
+#
+#  How many SoCal instances can one core drive? Runs N
+#  simulated calibrators (sim.day.simulate_fleet) for a full
+#  day on a single event loop in one thread, and reports the
+#  wall-clock cost per instance-day and the number of
+#  instances that cost would sustain in real time.
+#
+#  Usage: python benchmarks/bench_instances.py [N ...] [--json]
+#
+############################################################
+
+import os
+import sys
+import json
+import random
+import argparse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from sim.day import simulate_fleet, DAY
+
+def weather(i):
+    ''' A different, reproducible set of passing clouds for every instance '''
+    rng = random.Random(i)
+    windows = []
+    for k in range(rng.randint(0, 4)):
+        start = rng.randint(8*60, 16*60)
+        windows.append(('{:02d}:{:02d}'.format(*divmod(start, 60)),
+                        '{:02d}:{:02d}'.format(*divmod(start + rng.randint(5, 60), 60))))
+    return windows
+
+def run(count):
+    result = simulate_fleet(count, unsafe=weather)
+    reports = result['reports']
+    per_instance = result['wall_seconds']/count
+    return {'instances': count, 'wall_seconds': result['wall_seconds'],
+            'per_instance_day': per_instance,
+            'realtime_capacity': DAY/per_instance, # instances one core could keep up with
+            'transitions': sum(r['transitions'] for r in reports),
+            'all_powered_off': all(r['final_state'] == 'PoweredOff' for r in reports),
+            'mean_onsky_fraction': sum(r['onsky_fraction'] for r in reports)/count}
+
+def main():
+    parser = argparse.ArgumentParser(description='SoCal instances multiplexed on one event loop')
+    parser.add_argument('counts', nargs='*', type=int, default=[1, 10, 50, 100])
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = [run(count) for count in args.counts]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{:>9} {:>10} {:>14} {:>12} {:>9} {:>8}'.format(
+        'instances', 'wall [s]', 'ms/inst-day', 'transitions', 'on-sky', 'ok'))
+    for r in results:
+        print('{:>9} {:>10.2f} {:>14.1f} {:>12} {:>9.1%} {:>8}'.format(
+            r['instances'], r['wall_seconds'], 1e3*r['per_instance_day'], r['transitions'],
+            r['mean_onsky_fraction'], 'ok' if r['all_powered_off'] else 'FAILED'))
+    best = min(results, key=lambda r: r['per_instance_day'])
+    print('One core sustains ~{:,.0f} instances in real time (at {} instances per loop)'.format(
+        best['realtime_capacity'], best['instances']))
+
+if __name__ == '__main__':
+    main()
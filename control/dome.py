@@ -10,6 +10,7 @@
 ############################################################
 
 import websocket
+from telemetry import metrics
 
 DOME_IP = "192.168.23.244"
 DOME_PORT = "4030"
@@ -26,13 +27,22 @@ class DougDimmadome(object):
                           "7 Rejected. Operation blocked by sensor"
                          ]
 
-    def __init__(self):
-        self.wsPath = "ws://{}:{}/ws".format(DOME_IP, DOME_PORT)
+    def __init__(self, host=DOME_IP, port=DOME_PORT, transport=None):
+        '''
+        Args:
+            host: (str) DomeGuard IP address
+            port: (str) DomeGuard WebServer port
+            transport: WebSocket-like object to use instead of a new websocket.WebSocket,
+                       e.g. a recording or replay WebSocket from telemetry.wirelog
+        '''
+        self.host, self.port = host, port
+        self.wsPath = "ws://{}:{}/ws".format(host, port)
+        self.transport = transport
         self.connect_ws()
 
     def connect_ws(self):
         """ Open the WebSocket connection """
-        self.ws = websocket.WebSocket()
+        self.ws = websocket.WebSocket() if self.transport is None else self.transport
         self.ws.connect(self.wsPath)
         self.ws.settimeout(60)
         print('Opened WebSocket at {}'.format(self.wsPath))
@@ -47,10 +57,14 @@ class DougDimmadome(object):
 
     def __execCommands(self, cmd):
         """ Send command to the DomeGuard and recieve response """
-        self.ws.send(cmd)
-        result = [self.ws.recv()]
-        while not result[-1] in self.possible_responses:
-            result.append(self.ws.recv())
+        with metrics.timed('dome', cmd.split(' ')[0]) as stats:
+            self.ws.send(cmd)
+            stats['sent'] = len(cmd)
+            result = [self.ws.recv()]
+            while not result[-1] in self.possible_responses:
+                result.append(self.ws.recv())
+            stats['received'] = sum(len(r) for r in result)
+            stats['error'] = (result[-1] != self.possible_responses[0])
         return result
                 
     def open(self):
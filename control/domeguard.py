@@ -0,0 +1,115 @@
+############################################################
+#
+#  domeguard.py
+#
+#  Parsing of DomeGuard status replies, kept apart from the
+#  WebSocket driver (control/dome.py) so the dispatcher can
+#  use it without importing websocket.
+#
+#  The full `status` is the human-readable report of every
+#  sensor; the short `s` status is one line with the dome
+#  state, limits, motor and sensors, cheap to read often:
+#
+#      "Closed,0,0,1,1,Stopped,0.0,Remote,Sensors:, Power: on, Rain: off, Light: off"
+#
+############################################################
+
+import re
+
+def _fahrenheit(celsius):
+    return float(celsius)*(9/5) + 32
+
+def parse_status(status):
+    '''
+    Parse the full (human-readable) DomeGuard status
+
+    Returns: (dict) dome status, see parse_short_status for the common keys, plus
+             measured max and last overcurrent of the motor, temperatures [F],
+             watchdog and last command
+    '''
+    # Format into key-value pairs
+    ds = {}
+    for stat in status.replace('Guard ', '').split('\n')[:-1]:
+        vals = re.split(':|, ', stat)
+        if len(vals) == 2:
+            ds[vals[0].strip()] = vals[1].strip()
+        else:
+            if vals[0] in ['Limits']:
+                vals = vals[1:]
+            elif vals[0] in ['Temperatures']:
+                temps = []
+                for val in vals[1:]:
+                    temps.extend(val.strip().split(' '))
+                vals = temps
+            elif vals[0] in ['Sensors']:
+                vals = vals[2:]
+            elif vals[0] in 'Watchdog':
+                wd = ':'.join([v.strip() for v in vals]).replace(' sec','').replace(' ', ':')
+                vals = wd.split(':')
+            ds |=  {key.strip(): val.strip() for key, val in zip(vals[0::2], vals[1::2])}
+    # Reformat into appropriate datatypes
+    return {'Status': ds['Status'], 'OP mode': ds['OP mode'],
+            'Limits': {key: {'ON': True, 'OFF': False}[ds[key]]
+                       for key in ['open left', 'open right', 'close left', 'close right']},
+            'Motor': {'status': ds['Motor'],
+                      'current': float(ds['actual current'].replace(' A', '')),
+                      'measured max': float(ds['measured max'].replace(' A', '')),
+                      'last overcurrent': float('nan') if ds['last overcurrent']=='N/A'
+                                                   else float(ds['last overcurrent'])},
+            'Temperatures': {'inside' : _fahrenheit(ds['Inside']),
+                             'outside': _fahrenheit(ds['Outside']),
+                             'ebox'   : _fahrenheit(ds['electronics'])},
+            'Sensors': {'rain' : ds['Rain'],
+                        'light': ds['Light'],
+                        'power': ds['Power']},
+            'Watchdog': {'status' : ds['Watchdog'],
+                         'timeout': ds['timeout']},
+            'Last command': ds['Last command']
+           }
+
+def parse_short_status(status):
+    '''
+    Parse the short (software-readable) DomeGuard status. The sensors
+    can come in any order (and any number of them).
+
+    Returns: (dict) dome status with 'Status', 'OP mode', 'Limits' (bools),
+             'Motor' status and current, and 'Sensors' (lower-case names)
+    '''
+    fields = [field.strip() for field in status.strip().split(',')]
+    state, open_left, open_right, close_left, close_right, motor, current, opmode = fields[:8]
+    sensors = {}
+    for field in fields[8:]:
+        name, _, value = field.partition(':')
+        if value.strip(): # Skips the 'Sensors:' header
+            sensors[name.strip().lower()] = value.strip()
+    return {'Status': state, 'OP mode': opmode,
+            'Limits': {'open left'  : bool(int(open_left)),  'open right' : bool(int(open_right)),
+                       'close left' : bool(int(close_left)), 'close right': bool(int(close_right))},
+            'Motor': {'status': motor, 'current': float(current)},
+            'Sensors': sensors,
+           }
+
+def merge_status(full, short):
+    '''
+    Update the last full status with a newer short status, into one dome
+    status: the short status wins for everything it reports, the slow
+    fields (temperatures, watchdog, motor history, last command) come
+    from the full status. `full` may be None, or an earlier merge.
+
+    Statuses are shared (e.g. by telemetry snapshots), so `full` is never
+    modified: only the fields that changed are replaced, in a shallow copy,
+    and `full` itself is returned if nothing changed.
+    '''
+    if full is None:
+        return short
+    merged = None
+    for key in ('Status', 'OP mode', 'Limits'):
+        if full.get(key) != short[key]:
+            merged = merged or dict(full)
+            merged[key] = short[key]
+    for key in ('Motor', 'Sensors'):
+        fields = full.get(key, {})
+        if any(fields.get(name) != value for name, value in short[key].items()):
+            merged = merged or dict(full)
+            merged[key] = dict(fields, **short[key])
+    return full if merged is None else merged
@@ -9,6 +9,7 @@
 #
 ############################################################
 import time
+from telemetry import metrics
 
 # Global static variables
 BUFFER_SIZE = 256 # Max number of bytes to read out
@@ -37,18 +38,24 @@ def send_command(command, tracker, wait_for_response=False):
         response: string output from the tracker (decoded)
     '''
 
-    print('Sending command: {}'.format(command))
-    bytes_sent = tracker.send(command)
-    print('Sent {} bytes'.format(bytes_sent))
-    time.sleep(0.1)
-    if wait_for_response: 
-        complete_msg = [success_msg, error_msg]
-        response = b''
-        while not response in complete_msg: 
-            response += tracker.recv(BUFFER_SIZE)
-            time.sleep(1) # wait for complete response
-    else:
-        response = tracker.recv(BUFFER_SIZE)
+    # Command name for the latency metrics, e.g. b'MR\r' -> 'MR', b'TM,2020,...' -> 'TM'
+    name = command.split(b',')[0].strip().decode(errors='replace')
+    with metrics.timed('tracker', name) as stats:
+        print('Sending command: {}'.format(command))
+        bytes_sent = tracker.send(command)
+        stats['sent'] = bytes_sent
+        print('Sent {} bytes'.format(bytes_sent))
+        time.sleep(0.1)
+        if wait_for_response: 
+            complete_msg = [success_msg, error_msg]
+            response = b''
+            while not response in complete_msg: 
+                response += tracker.recv(BUFFER_SIZE)
+                time.sleep(1) # wait for complete response
+        else:
+            response = tracker.recv(BUFFER_SIZE)
+        stats['received'] = len(response)
+        stats['error'] = (response == error_msg)
     
     if response == error_msg:
         print('ERROR: command [{}] not recognized!'.format(command)) 
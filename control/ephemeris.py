@@ -0,0 +1,158 @@
+############################################################
+#
+#  ephemeris.py
+#
+#  Solar ephemeris for the SoCal site and the daily schedule
+#  derived from it: the instants the Sun crosses the SoCal
+#  altitude limit, so the state machine can arm timers for
+#  opening and closing instead of polling SUNALT.
+#
+#  Solar position follows the NOAA solar calculator
+#  (Meeus, Astronomical Algorithms), good to ~0.01 deg,
+#  vectorized over arrays of unix times.
+#
+############################################################
+
+import time
+import calendar
+import numpy as np
+
+# SoCal site (Maunakea)
+SITE_LAT   = 19.8260   # [deg] +North
+SITE_LON   = -155.4747 # [deg] +East
+UTC_OFFSET = -10       # [hr] HST, no daylight saving
+
+DAY = 86400.
+
+def sun_position(t, lat=SITE_LAT, lon=SITE_LON, refraction=True):
+    '''
+    Apparent position of the Sun
+
+    Args:
+        t:   (float or array) unix time(s) [s]
+        lat: (float) site latitude in decimal degrees, + North
+        lon: (float) site longitude in decimal degrees, + East
+        refraction: (bool) include atmospheric refraction in the altitude
+
+    Returns:
+        alt: altitude in decimal degrees (0 = Horizon, 90 = Zenith)
+        az:  azimuth in decimal degrees (0 = South, + West, - East), as the tracker reports it
+    '''
+    t  = np.asarray(t, dtype=float)
+    jc = (t/DAY + 2440587.5 - 2451545.)/36525. # Julian centuries since J2000
+
+    L0 = np.radians((280.46646 + jc*(36000.76983 + jc*0.0003032)) % 360) # Mean longitude
+    M  = np.radians(357.52911 + jc*(35999.05029 - 0.0001537*jc))          # Mean anomaly
+    e  = 0.016708634 - jc*(0.000042037 + 0.0000001267*jc)                 # Orbit eccentricity
+    C  = np.radians(np.sin(M)*(1.914602 - jc*(0.004817 + 0.000014*jc))
+                    + np.sin(2*M)*(0.019993 - 0.000101*jc) + np.sin(3*M)*0.000289)
+    omega = np.radians(125.04 - 1934.136*jc)
+    app_long = L0 + C - np.radians(0.00569 + 0.00478*np.sin(omega))
+    eps = np.radians(23 + (26 + (21.448 - jc*(46.815 + jc*(0.00059 - jc*0.001813)))/60)/60
+                     + 0.00256*np.cos(omega))                             # Obliquity (corrected)
+    dec = np.arcsin(np.sin(eps)*np.sin(app_long))
+
+    # Equation of time [minutes]
+    y   = np.tan(eps/2)**2
+    eot = 4*np.degrees(y*np.sin(2*L0) - 2*e*np.sin(M) + 4*e*y*np.sin(M)*np.cos(2*L0)
+                       - 0.5*y*y*np.sin(4*L0) - 1.25*e*e*np.sin(2*M))
+
+    solar_minutes = (t % DAY)/60. + eot + 4*lon
+    ha  = np.radians(solar_minutes/4. - 180.) # Hour angle, + West
+    phi = np.radians(lat)
+    alt = np.degrees(np.arcsin(np.sin(phi)*np.sin(dec) + np.cos(phi)*np.cos(dec)*np.cos(ha)))
+    az  = np.degrees(np.arctan2(np.sin(ha), np.cos(ha)*np.sin(phi) - np.tan(dec)*np.cos(phi)))
+
+    if refraction:
+        # Bennett's formula [arcmin], only meaningful above about -1 deg
+        h   = np.maximum(alt, -1.)
+        alt = alt + np.where(alt > -1., 1.02/np.tan(np.radians(h + 10.3/(h + 5.11)))/60., 0.)
+    return alt, az
+
+def local_midnight(t, utc_offset=UTC_OFFSET):
+    ''' Unix time of the local midnight at or before `t` '''
+    offset = 3600.*utc_offset
+    return np.floor((t + offset)/DAY)*DAY - offset
+
+def date_midnight(date, utc_offset=UTC_OFFSET):
+    ''' Unix time of local midnight at the start of `date` ('YYYY-MM-DD') '''
+    return calendar.timegm(time.strptime(date, '%Y-%m-%d')) - 3600.*utc_offset
+
+def altitude_crossings(t0, t1, limit, lat=SITE_LAT, lon=SITE_LON, step=60., tol=0.01):
+    '''
+    Times the Sun crosses altitude `limit` between t0 and t1
+
+    The altitude is evaluated on a `step` grid in one vectorized call, and every
+    bracketed crossing is then refined by bisection (all brackets at once)
+    down to `tol` seconds.
+
+    Returns:
+        times:  (array) crossing times [unix s]
+        rising: (bool array) True where the Sun rises through the limit
+    '''
+    grid  = np.arange(t0, t1 + step, step)
+    above = sun_position(grid, lat, lon)[0] >= limit
+    idx   = np.nonzero(above[1:] != above[:-1])[0]
+    lo, hi = grid[idx], grid[idx + 1]
+    rising = ~above[idx]
+    for i in range(int(np.ceil(np.log2(step/tol)))):
+        mid = 0.5*(lo + hi)
+        mid_above = sun_position(mid, lat, lon)[0] >= limit
+        # Keep the half that still contains the crossing
+        moved_lo = mid_above != rising
+        lo = np.where(moved_lo, mid, lo)
+        hi = np.where(moved_lo, hi, mid)
+    return hi, rising
+
+
+class DailySchedule(object):
+    '''
+    When the Sun is above `limit` during one local day. `rise` and `set` are the
+    first upward and last downward crossings (None if there are none).
+    '''
+
+    def __init__(self, start, limit, lat=SITE_LAT, lon=SITE_LON, step=60.):
+        self.start = float(start)
+        self.end   = self.start + DAY
+        self.day   = time.strftime('%Y-%m-%d', time.gmtime(self.start + 3600.*UTC_OFFSET))
+        self.limit = limit
+        times, rising = altitude_crossings(self.start, self.end, limit, lat, lon, step=step)
+        up = sun_position(self.start, lat, lon)[0] >= limit
+        # Intervals [begin, end) with the Sun above the limit
+        self.intervals = []
+        begin = self.start if up else None
+        for t, r in zip(times.tolist(), rising.tolist()):
+            if r:
+                begin = t
+            elif begin is not None:
+                self.intervals.append((begin, t))
+                begin = None
+        if begin is not None:
+            self.intervals.append((begin, self.end))
+        self.rise = next((float(t) for t, r in zip(times, rising) if r), None)
+        self.set  = next((float(t) for t, r in zip(times[::-1], rising[::-1]) if not r), None)
+
+    def __repr__(self):
+        fmt = lambda t: '-' if t is None else time.strftime('%H:%M:%S', time.gmtime(t + 3600.*UTC_OFFSET))
+        return '<DailySchedule {} rise {} set {} (limit {} deg)>'.format(
+            self.day, fmt(self.rise), fmt(self.set), self.limit)
+
+    def is_up(self, t):
+        ''' Is the Sun above the limit at time `t`? '''
+        return any(begin <= t < end for begin, end in self.intervals)
+
+    def next_rise(self, t):
+        ''' Next time at/after `t` the Sun rises above the limit this day, or None '''
+        return next((begin for begin, end in self.intervals if begin >= t and begin > self.start), None)
+
+    def next_set(self, t):
+        ''' Next time after `t` the Sun drops below the limit this day, or None '''
+        return next((end for begin, end in self.intervals if end > t and end < self.end), None)
+
+    @property
+    def up_seconds(self):
+        return sum(end - begin for begin, end in self.intervals)
+
+def schedule_for(t, limit, lat=SITE_LAT, lon=SITE_LON, utc_offset=UTC_OFFSET):
+    ''' DailySchedule of the local day containing time `t` '''
+    return DailySchedule(local_midnight(t, utc_offset), limit, lat, lon)
@@ -0,0 +1,135 @@
+############################################################
+#
+#  guiding.py
+#
+#  Guiding monitor for the EKO sun tracker: sun sensor
+#  offsets (RO, both axes from one reply) sampled at a
+#  high rate while the tracker guides, kept in a
+#  preallocated NumPy ring buffer, with windowed jitter
+#  statistics (RMS, drift, fraction of samples in lock)
+#  computed vectorized over the buffer. Whether the tracker
+#  is locked on the Sun is decided from those statistics
+#  rather than from a single noisy sample.
+#
+############################################################
+
+import threading
+import numpy as np
+
+CAPACITY       = 4096 # samples kept (at 4 Hz, about 17 minutes)
+WINDOW         = 30.  # [s] default statistics window
+LOCK_THRESHOLD = 0.1  # [deg] radial offset within which a sample counts as locked
+LOCK_FRACTION  = 0.8  # fraction of the samples in the window that must be locked
+MIN_SAMPLES    = 5    # fewer samples in the window than this: no verdict
+
+class GuidingMonitor(object):
+    '''
+    Ring buffer of (time, alt offset, az offset) samples. Samples are added
+    by the tracker's worker thread and statistics read from any thread.
+    '''
+
+    def __init__(self, capacity=CAPACITY, window=WINDOW, threshold=LOCK_THRESHOLD,
+                 lock_fraction=LOCK_FRACTION, min_samples=MIN_SAMPLES):
+        self.capacity      = int(capacity)
+        self.window        = window
+        self.threshold     = threshold
+        self.lock_fraction = lock_fraction
+        self.min_samples   = min_samples
+        self._buffer = np.full((self.capacity, 3), np.nan) # Columns: time [unix], alt, az offsets [deg]
+        self._next   = 0 # Index the next sample goes to
+        self._count  = 0 # Samples held, up to capacity
+        self._lock   = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, t, alt, az):
+        ''' Record the sun sensor offsets [deg] read at time `t` '''
+        with self._lock:
+            self._buffer[self._next] = (t, alt, az)
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def clear(self):
+        ''' Forget all samples, e.g. when the tracker stops guiding '''
+        with self._lock:
+            self._next, self._count = 0, 0
+
+    @property
+    def last(self):
+        ''' The most recent (time, alt, az) sample, or None '''
+        with self._lock:
+            if not self._count:
+                return None
+            return tuple(float(value) for value in self._buffer[self._next - 1])
+
+    def samples(self, window=None, now=None):
+        '''
+        The samples of the last `window` seconds before `now` (default: the
+        latest sample), oldest first
+
+        Returns: (ndarray) shape (n, 3): time, alt, az
+        '''
+        window = self.window if window is None else window
+        with self._lock:
+            if self._count < self.capacity:
+                data = self._buffer[:self._count].copy()
+            else:
+                data = np.roll(self._buffer, -self._next, axis=0) # Oldest first
+        if not len(data):
+            return data
+        now = data[-1, 0] if now is None else now
+        return data[(data[:, 0] > now - window) & (data[:, 0] <= now)]
+
+    def stats(self, window=None, now=None, threshold=None):
+        '''
+        Jitter statistics over the last `window` seconds, with samples counted
+        as locked within `threshold` [deg] (default: the monitor's)
+
+        Returns: (dict) 'samples'; 'rms_alt', 'rms_az' and 'rms' (radial) [deg]
+                 about zero offset; 'std_alt', 'std_az' [deg] about the mean;
+                 'median' radial offset and 'max' [deg]; 'drift_alt', 'drift_az'
+                 [deg/s] (least-squares slope); 'locked_fraction' of samples within
+                 the threshold; 'longest_unlocked' [s] run of samples out of lock;
+                 'locked' (None if there are fewer than min_samples)
+        '''
+        data = self.samples(window, now)
+        n = len(data)
+        if n < self.min_samples:
+            return {'samples': n, 'locked': None}
+        threshold = self.threshold if threshold is None else threshold
+        t, alt, az = data[:, 0], data[:, 1], data[:, 2]
+        radial = np.hypot(alt, az)
+        inlock = radial <= threshold
+        # Drift: slope of a straight-line fit, vectorized for both axes at once
+        dt = t - t.mean()
+        denominator = np.dot(dt, dt)
+        drift = (dt @ (data[:, 1:] - data[:, 1:].mean(axis=0)))/denominator if denominator > 0 else np.zeros(2)
+        # Longest run out of lock: time from the first to the last unlocked sample of each run
+        unlocked = np.flatnonzero(~inlock)
+        longest = 0.
+        if len(unlocked):
+            breaks = np.flatnonzero(np.diff(unlocked) > 1)
+            starts = unlocked[np.r_[0, breaks + 1]]
+            ends   = unlocked[np.r_[breaks, len(unlocked) - 1]]
+            longest = float(np.max(t[ends] - t[starts]))
+        locked_fraction = float(inlock.mean())
+        median = float(np.median(radial))
+        return {'samples'         : n,
+                'rms_alt'         : float(np.sqrt(np.mean(alt**2))),
+                'rms_az'          : float(np.sqrt(np.mean(az**2))),
+                'rms'             : float(np.sqrt(np.mean(radial**2))),
+                'std_alt'         : float(alt.std()),
+                'std_az'          : float(az.std()),
+                'median'          : median,
+                'max'             : float(radial.max()),
+                'drift_alt'       : float(drift[0]),
+                'drift_az'        : float(drift[1]),
+                'locked_fraction' : locked_fraction,
+                'longest_unlocked': longest,
+                'locked'          : median <= threshold and locked_fraction >= self.lock_fraction,
+               }
+
+    def locked(self, window=None, now=None, threshold=None):
+        ''' True/False if the tracker is (not) locked on the Sun over the window, None without enough samples '''
+        return self.stats(window, now, threshold)['locked']
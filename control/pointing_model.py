@@ -0,0 +1,139 @@
+############################################################
+#
+#  pointing_model.py
+#
+#  Pointing model of the EKO sun tracker. While it guides
+#  on the Sun, the corrected position (MR) differs from the
+#  calculated one (CR) by the tracker's systematic pointing
+#  error, which the sun sensor has to find again every
+#  morning. The dispatcher logs (time, calculated,
+#  corrected, sun sensor offset) while locked; the model is
+#  a least-squares fit of MR - CR over that history, solved
+#  for both axes at once, and gives the correction to apply
+#  to the calculated position for a manual pre-slew before
+#  acquisition.
+#
+#  Each axis is modelled as
+#
+#      c0 + c1 sin(alt) + c2 cos(alt) + c3 sin(az) + c4 cos(az)
+#
+#  a constant (index) error, an elevation-dependent term
+#  (flexure, tilt) and one azimuth harmonic (a tilted base).
+#
+############################################################
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+COLUMNS = ('time', 'calc_alt', 'calc_az', 'corr_alt', 'corr_az', 'offset_alt', 'offset_az')
+TERMS   = ('constant', 'sin_alt', 'cos_alt', 'sin_az', 'cos_az')
+MIN_SAMPLES = 20 # below this, no model
+
+class PointingLog(object):
+    ''' Append-only CSV log of tracker positions taken while locked on the Sun '''
+
+    def __init__(self, path):
+        self.path  = path
+        self.added = 0 # rows added since opened
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'w') as f:
+                f.write(','.join(COLUMNS) + '\n')
+
+    def add(self, t, calc_alt, calc_az, corr_alt, corr_az, offset_alt, offset_az):
+        row = (t, calc_alt, calc_az, corr_alt, corr_az, offset_alt, offset_az)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(','.join(repr(float(value)) for value in row) + '\n')
+            self.added += 1
+
+    def load(self, since=None):
+        '''
+        Returns: (ndarray) shape (n, len(COLUMNS)), the rows logged at or after `since` (unix)
+        '''
+        with self._lock:
+            data = np.loadtxt(self.path, delimiter=',', skiprows=1, ndmin=2)
+        if not data.size:
+            return np.empty((0, len(COLUMNS)))
+        if since is not None:
+            data = data[data[:, 0] >= since]
+        return data
+
+
+def design_matrix(alt, az):
+    ''' The model terms (TERMS) for positions in degrees, one row per position '''
+    alt, az = np.radians(np.atleast_1d(alt)), np.radians(np.atleast_1d(az))
+    return np.column_stack([np.ones_like(alt), np.sin(alt), np.cos(alt), np.sin(az), np.cos(az)])
+
+
+class PointingModel(object):
+    ''' Fitted correction (corrected - calculated) [deg] in alt and az, as a function of position '''
+
+    def __init__(self, coefficients, samples=0, rms_before=None, rms_after=None, fitted_at=None):
+        self.coefficients = np.asarray(coefficients, dtype=float) # shape (len(TERMS), 2): alt, az
+        self.samples      = samples
+        self.rms_before   = rms_before # [deg] radial CR-MR difference without the model
+        self.rms_after    = rms_after  # [deg] ... left after the model
+        self.fitted_at    = fitted_at
+
+    def __repr__(self):
+        return '<PointingModel {} samples, rms {:.4f} -> {:.4f} deg>'.format(self.samples, self.rms_before,
+                                                                            self.rms_after)
+
+    def correction(self, alt, az):
+        '''
+        Correction to add to a calculated position [deg]
+
+        Returns: (dalt, daz), floats for scalar positions, arrays otherwise
+        '''
+        correction = design_matrix(alt, az) @ self.coefficients
+        if np.ndim(alt) == 0 and np.ndim(az) == 0:
+            return float(correction[0, 0]), float(correction[0, 1])
+        return correction[:, 0], correction[:, 1]
+
+    def to_dict(self):
+        return {'terms': list(TERMS), 'coefficients': self.coefficients.tolist(), 'samples': self.samples,
+                'rms_before': self.rms_before, 'rms_after': self.rms_after, 'fitted_at': self.fitted_at}
+
+    @classmethod
+    def from_dict(cls, d):
+        assert list(d['terms']) == list(TERMS), 'Pointing model has terms {}, expected {}'.format(d['terms'], TERMS)
+        return cls(d['coefficients'], d['samples'], d['rms_before'], d['rms_after'], d['fitted_at'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def fit(data, min_samples=MIN_SAMPLES):
+    '''
+    Least-squares fit of corrected - calculated over logged rows (see
+    PointingLog.load), both axes in one solve. With too little sky coverage
+    to constrain every term, only the constant terms are fitted.
+
+    Returns: (PointingModel), or None with fewer than `min_samples` rows
+    '''
+    data = np.asarray(data, dtype=float)
+    if len(data) < min_samples:
+        return None
+    calc_alt, calc_az = data[:, 1], data[:, 2]
+    residual = data[:, 3:5] - data[:, 1:3]
+    residual[:, 1] = (residual[:, 1] + 180.) % 360. - 180. # Azimuth wraps
+    A = design_matrix(calc_alt, calc_az)
+    coefficients, _, rank, _ = np.linalg.lstsq(A, residual, rcond=None)
+    if rank < A.shape[1]:
+        coefficients = np.zeros((A.shape[1], 2))
+        coefficients[0] = residual.mean(axis=0)
+    left = residual - A @ coefficients
+    rms = lambda r: float(np.sqrt(np.mean(np.sum(r**2, axis=1))))
+    return PointingModel(coefficients, len(data), rms(residual), rms(left), time.time())
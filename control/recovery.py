@@ -0,0 +1,165 @@
+############################################################
+#
+#  recovery.py
+#
+#  Escalating recovery of a device that stopped answering.
+#  A RecoveryLadder runs its steps in order, cheapest first
+#  (e.g. reconnect the socket, power-cycle the device, re-
+#  initialise it), each under its own timeout, and after
+#  every step checks whether the device answers again; it
+#  stops at the first step that brings it back. Every
+#  incident (what triggered it, each step tried, how long
+#  it took to recover) is kept and appended to a JSON-lines
+#  log, and the time to recover goes to the metrics.
+#
+#  A step that hangs (a read that never returns on a wedged
+#  socket) is abandoned on its daemon thread at its timeout,
+#  so a stuck device cannot stall the ladder itself. As it
+#  may still complete later, a step must not publish what it
+#  did once a later step has started (the dispatcher's
+#  tracker actions check a generation counter for this).
+#
+############################################################
+
+import json
+import time
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future, TimeoutError
+
+from telemetry import metrics
+
+# A rung of the ladder: `action()` is run, at most `timeout` seconds, then the device is checked.
+# If `needed` is given, the step is skipped when needed() returns False (not if it fails)
+Step = namedtuple('Step', ['name', 'action', 'timeout', 'needed'], defaults=[None])
+
+KEEP_INCIDENTS = 100 # incidents kept in memory
+
+def run_with_timeout(fn, timeout, name='recovery'):
+    '''
+    Run `fn()` on a daemon thread and wait at most `timeout` seconds
+
+    Returns: what fn returned; raises its exception, or TimeoutError (the
+             thread is left to finish, or hang, on its own: fn must then not
+             undo what was done after it was given up on)
+    '''
+    future = Future()
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future.result(timeout)
+
+
+class RecoveryLadder(object):
+    '''
+    Steps to bring one device back, tried in order until `check()` succeeds.
+    One recovery runs at a time: a request while one is running waits for it,
+    then starts with a check, so finds the device already healthy if it was.
+    '''
+
+    def __init__(self, device, steps, check, check_timeout=10., log_path=None):
+        '''
+        Args:
+            device:        (str) device name, for the log and metrics
+            steps:         (list of Step) cheapest first
+            check:         callable, returns True if the device is healthy (raising counts as not)
+            check_timeout: (float) seconds allowed for a check
+            log_path:      (str) JSON-lines file to append every incident to, if any
+        '''
+        self.device        = device
+        self.steps         = list(steps)
+        self.check         = check
+        self.check_timeout = check_timeout
+        self.log_path      = log_path
+        self.incidents     = deque(maxlen=KEEP_INCIDENTS)
+        self.current       = None # Incident being recovered from, if any
+        self._lock         = threading.Lock()
+
+    def _healthy(self):
+        ''' (bool, error) of one check, under its timeout '''
+        try:
+            return bool(run_with_timeout(self.check, self.check_timeout, 'check-{}'.format(self.device))), None
+        except TimeoutError:
+            return False, 'check timed out after {} s'.format(self.check_timeout)
+        except Exception as e:
+            return False, repr(e)
+
+    def recover(self, reason, detected=None):
+        '''
+        Climb the ladder until the device answers again
+
+        Args:
+            reason:   (str) what gave the device away, e.g. 'tracker poll stale for 35 s'
+            detected: (float) unix time the outage started (default now), counted
+                      in the time to recover
+
+        Returns: (dict) the incident: 'device', 'reason', 'detected', 'start' and
+                 'end' (unix), 'steps' tried (name, seconds, ok, error; 'skipped' if
+                 not needed), 'recovered' (bool), 'step' that recovered it (None if
+                 none did, or if it was healthy by the time recovery started) and
+                 'time_to_recover' [s] from detection (None if not recovered)
+        '''
+        with self._lock:
+            start = time.time()
+            incident = {'device': self.device, 'reason': reason, 'detected': start if detected is None else detected,
+                        'start': start, 'end': None, 'steps': [], 'recovered': False, 'step': None,
+                        'time_to_recover': None}
+            self.current = incident
+            try:
+                recovered, _ = self._healthy()
+                for step in ([] if recovered else self.steps):
+                    if step.needed is not None and not self._needed(step):
+                        incident['steps'].append({'name': step.name, 'seconds': 0., 'ok': False,
+                                                  'error': None, 'skipped': True})
+                        continue
+                    t0 = time.monotonic()
+                    error = None
+                    try:
+                        run_with_timeout(step.action, step.timeout, '{}-{}'.format(step.name, self.device))
+                    except TimeoutError:
+                        error = 'timed out after {} s'.format(step.timeout)
+                    except Exception as e:
+                        error = repr(e)
+                    recovered, check_error = self._healthy()
+                    incident['steps'].append({'name': step.name, 'seconds': time.monotonic() - t0,
+                                              'ok': recovered, 'error': error or check_error})
+                    print('Recovering {}: {} {}'.format(self.device, step.name,
+                                                        'succeeded' if recovered else 'failed: {}'.format(error or check_error or 'check failed')))
+                    if recovered:
+                        incident['step'] = step.name
+                        break
+            finally:
+                self.current = None
+            incident['end'] = time.time()
+            incident['recovered'] = recovered
+            if recovered:
+                incident['time_to_recover'] = incident['end'] - incident['detected']
+                metrics.REGISTRY.observe('socal_recovery_seconds', incident['time_to_recover'], device=self.device)
+            metrics.REGISTRY.inc('socal_recovery_incidents_total', device=self.device, recovered=str(recovered).lower())
+            self.incidents.append(incident)
+            self._log(incident)
+            return incident
+
+    def _needed(self, step):
+        try:
+            return bool(run_with_timeout(step.needed, self.check_timeout, 'needed-{}'.format(self.device)))
+        except Exception:
+            return True
+
+    def _log(self, incident):
+        if self.log_path is None:
+            return
+        try:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(incident) + '\n')
+        except OSError as e:
+            print('Unable to log recovery incident to {}: {}'.format(self.log_path, repr(e)))
+
+    def time_to_recover(self):
+        ''' Seconds from detection to recovery of each recovered incident, oldest first '''
+        return [incident['time_to_recover'] for incident in self.incidents if incident['recovered']]
@@ -18,24 +18,31 @@ TCP_PORT = 10001 # Local port for serial 1 on UDS2100
 
 class EKOSunTracker(object):
 
-    def __init__(self):
+    def __init__(self, host=TCP_IP, port=TCP_PORT, transport=None):
         '''
         Initialize SoCal object and open 
         the connection to the TCP/IP port
+
+        Args:
+            host: (str) Lantronix UDS2100 IP address
+            port: (int) local port for serial 1 on the UDS2100
+            transport: socket-like object to use instead of a new TCP socket,
+                       e.g. a recording or replay socket from telemetry.wirelog
         '''
         self.HOME_ALT = 0.0
         self.HOME_AZ  = 0.0
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((TCP_IP, TCP_PORT))
+        self.host, self.port = host, int(port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) if transport is None else transport
+        self.socket.connect((self.host, self.port))
         print('Connected to {} at Port {}'.format(*self.socket.getpeername()))
 
     def close_connection(self):
         self.socket.close()
-        print('Closed connection to {} at Port {}'.format(TCP_IP, TCP_PORT))
+        print('Closed connection to {} at Port {}'.format(self.host, self.port))
 
     def open_connection(self):
-        self.socket.connect((TCP_IP, TCP_PORT))
-        print('Opened connection to {} at Port {}'.format(TCP_IP, TCP_PORT))
+        self.socket.connect((self.host, self.port))
+        print('Opened connection to {} at Port {}'.format(self.host, self.port))
 
     def set_datetime(self, date, time):
         '''
@@ -0,0 +1,150 @@
+############################################################
+#
+#  workers.py
+#
+#  Per-device worker threads. Each device connection is owned
+#  by one worker that executes requests from its queue in
+#  order, so I/O is serialized per device (no interleaved
+#  bytes on a socket) but runs in parallel across devices.
+#  Requests are served by priority: an URGENT request (e.g.
+#  an emergency dome close) goes ahead of everything queued,
+#  safety MONITOR polls ahead of ordinary requests, and
+#  BACKGROUND requests (telemetry polls) can be dropped.
+#
+############################################################
+
+import heapq
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+
+# Request priorities, lowest served first
+URGENT     = 0 # Safety commands: jump the queue
+MONITOR    = 1 # Polls that watch safety sensors (the dome's rain sensor)
+NORMAL     = 2 # Commands and reads on behalf of SoCal/KTL
+BACKGROUND = 3 # Telemetry polls, can be cancelled
+_STOP      = 4 # Shutdown, after everything already queued
+
+class DeviceWorker(object):
+    '''
+    A thread that owns a device and runs submitted calls one at a time, in
+    order of priority and, within a priority, in the order they were submitted.
+    A call already running is never interrupted.
+    '''
+
+    def __init__(self, name, driver=None):
+        self.name     = name
+        self.driver   = driver
+        self.profiler = None # telemetry.profiling.Profiler accounting every call, if profiling
+        self._queue   = queue.PriorityQueue() # (priority, sequence, future, fn, args, kwargs)
+        self._order   = itertools.count()
+        self._stopped = False # Set once the thread has stopped: later requests are cancelled
+        self._submit  = threading.Lock()
+        self._thread  = threading.Thread(target=self._run, name='worker-{}'.format(name), daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, priority=NORMAL, **kwargs):
+        '''
+        Queue `fn(*args, **kwargs)` to run on this device's thread
+
+        Args:
+            priority: URGENT, MONITOR, NORMAL or BACKGROUND
+
+        Returns:
+            future: (concurrent.futures.Future) resolves to the return value of fn
+        '''
+        future = Future()
+        if self.in_worker():
+            # Already on this device's thread (e.g. a poll calling a driver method), run inline
+            self._execute(future, fn, args, kwargs)
+            return future
+        with self._submit:
+            if self._stopped:
+                future.cancel() # Nobody left to run it (e.g. the worker of a replaced connection)
+            else:
+                self._queue.put((priority, next(self._order), future, fn, args, kwargs))
+        return future
+
+    def call(self, fn, *args, timeout=None, priority=NORMAL, **kwargs):
+        ''' Run `fn` on this device's thread and wait for the result (exceptions are re-raised) '''
+        return self.submit(fn, *args, priority=priority, **kwargs).result(timeout)
+
+    def cancel_pending(self, priority=BACKGROUND):
+        '''
+        Drop the queued requests of `priority` or lower (not the one running);
+        their futures are cancelled
+
+        Returns: (int) number of requests dropped
+        '''
+        with self._queue.mutex:
+            items   = self._queue.queue
+            dropped = [item for item in items if priority <= item[0] < _STOP]
+            if dropped:
+                items[:] = [item for item in items if not (priority <= item[0] < _STOP)]
+                heapq.heapify(items)
+        for item in dropped:
+            item[2].cancel()
+        return len(dropped)
+
+    def in_worker(self):
+        ''' True if called from this worker's own thread '''
+        return threading.current_thread() is self._thread
+
+    @property
+    def pending(self):
+        ''' Number of queued requests not yet started '''
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=None):
+        ''' Finish the queued requests, then stop the thread '''
+        self._queue.put((_STOP, next(self._order), None, None, (), {}))
+        if not self.in_worker():
+            self._thread.join(timeout)
+
+    def _execute(self, future, fn, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        profiler = self.profiler
+        try:
+            if profiler is None:
+                result = fn(*args, **kwargs)
+            else:
+                result = profiler.device_call(self.name, fn, args, kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            priority, order, future, fn, args, kwargs = self._queue.get()
+            if priority == _STOP:
+                with self._submit:
+                    self._stopped = True
+                    self.cancel_pending(URGENT)
+                break
+            self._execute(future, fn, args, kwargs)
+
+
+class DeviceProxy(object):
+    '''
+    Stands in for the driver owned by a worker: every method call is executed
+    on the device's worker thread, other attributes are read straight from the driver.
+    '''
+
+    def __init__(self, worker):
+        object.__setattr__(self, '_worker', worker)
+
+    def __getattr__(self, attr):
+        value = getattr(self._worker.driver, attr)
+        if not callable(value):
+            return value
+        worker = self._worker
+        def call_on_worker(*args, **kwargs):
+            return worker.call(value, *args, **kwargs)
+        call_on_worker.__name__ = attr
+        return call_on_worker
+
+    def __setattr__(self, attr, value):
+        setattr(self._worker.driver, attr, value)
@@ -0,0 +1,66 @@
+############################################################
+#
+#  drivers.py
+#
+#  Registry of SoCal device drivers. Each backend module is
+#  only imported the first time its driver is used, so that
+#  importing the dispatcher (or a CLI tool) does not pull in
+#  websocket, pymodbus, numpy, etc.
+#
+############################################################
+
+import sys
+import inspect
+import importlib
+
+# Device name -> (module, driver class)
+DRIVERS = {'dome'         : ('control.dome', 'DougDimmadome'),
+           'tracker'      : ('control.sun_tracker', 'EKOSunTracker'),
+           'pyrheliometer': ('irradiance.pyrheliometer', 'EKOPyrheliometer'),
+          }
+
+def register(name, module, cls):
+    '''
+    Register (or replace) the driver used for a device
+
+    Args:
+        name:   (str) device name, e.g. 'dome'
+        module: (str) dotted path of the module defining the driver
+        cls:    (str) name of the driver class in that module
+    '''
+    DRIVERS[name] = (module, cls)
+
+def load_module(name):
+    '''
+    Import (on first use) and return the backend module for a device
+    '''
+    assert name in DRIVERS, 'Unknown device {}, must be one of {}'.format(name, list(DRIVERS))
+    return importlib.import_module(DRIVERS[name][0])
+
+def driver_class(name):
+    '''
+    Return the driver class for a device, importing its backend if needed
+    '''
+    module, cls = DRIVERS[name]
+    return getattr(load_module(name), cls)
+
+def create(name, *args, instance=None, **kwargs):
+    '''
+    Instantiate the driver for a device. Arguments are passed to the driver.
+
+    Args:
+        instance: (str) name of the dispatcher the driver is for, passed on only to
+                  drivers (factories) that take an `instance` argument, e.g. those
+                  of telemetry.wirelog, which keep one log per dispatcher
+    '''
+    factory = driver_class(name)
+    if instance is not None and 'instance' in inspect.signature(factory).parameters:
+        kwargs['instance'] = instance
+    return factory(*args, **kwargs)
+
+def is_loaded(name):
+    '''
+    Check whether the backend for a device has already been imported
+    '''
+    module, cls = DRIVERS[name]
+    return module in sys.modules
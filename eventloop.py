@@ -0,0 +1,157 @@
+############################################################
+#
+#  eventloop.py
+#
+#  Minimal timer-driven event loop used to run the SoCal
+#  state machine. Callbacks run one at a time on the loop's
+#  thread with a flat call stack; other threads hand work to
+#  the loop with call_soon(), which wakes it immediately.
+#
+############################################################
+
+import time
+import heapq
+import itertools
+import threading
+
+class SystemClock(object):
+    ''' Wall-clock time for the event loop '''
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, timeout):
+        ''' Block on `condition` (held by the caller) for up to `timeout` seconds '''
+        condition.wait(timeout)
+
+
+class Timer(object):
+    ''' Handle for a scheduled callback '''
+
+    __slots__ = ('when', 'fn', 'args', 'cancelled')
+
+    def __init__(self, when, fn, args):
+        self.when      = when
+        self.fn        = fn
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    '''
+    Run callbacks at given times. Everything scheduled on one loop runs on
+    the thread that called run_forever(), so callbacks never overlap.
+    '''
+
+    def __init__(self, clock=None):
+        self.clock    = SystemClock() if clock is None else clock
+        self._timers  = []  # heap of (when, seq, Timer)
+        self._seq     = itertools.count()
+        self._cond    = threading.Condition()
+        self._running = False
+        self._thread  = None
+
+    def time(self):
+        return self.clock.time()
+
+    def call_at(self, when, fn, *args):
+        ''' Run `fn(*args)` at time `when` (in the loop clock); safe to call from any thread '''
+        timer = Timer(when, fn, args)
+        with self._cond:
+            heapq.heappush(self._timers, (when, next(self._seq), timer))
+            self._cond.notify()
+        return timer
+
+    def call_later(self, delay, fn, *args):
+        ''' Run `fn(*args)` after `delay` seconds '''
+        return self.call_at(self.time() + delay, fn, *args)
+
+    def call_soon(self, fn, *args):
+        ''' Run `fn(*args)` as soon as possible, waking the loop if it is waiting '''
+        return self.call_at(-float('inf'), fn, *args)
+
+    @property
+    def pending(self):
+        ''' Number of scheduled (not cancelled) callbacks '''
+        with self._cond:
+            return sum(not timer.cancelled for _, _, timer in self._timers)
+
+    def next_time(self):
+        ''' Time of the next scheduled callback, or None '''
+        with self._cond:
+            self._drop_cancelled()
+            return self._timers[0][0] if self._timers else None
+
+    def _drop_cancelled(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+
+    def run_once(self, block=True):
+        '''
+        Run the next due callback, waiting for it if `block`
+
+        Returns: True if a callback ran
+        '''
+        with self._cond:
+            self._drop_cancelled()
+            if not self._timers:
+                if not block:
+                    return False
+                self.clock.wait(self._cond, None)
+                return False
+            when = self._timers[0][0]
+            now = self.time()
+            if when > now:
+                if not block:
+                    return False
+                self.clock.wait(self._cond, when - now)
+                return False # Re-check: time has passed or something new was scheduled
+            _, _, timer = heapq.heappop(self._timers)
+        try:
+            timer.fn(*timer.args)
+        except Exception as e:
+            print('Error in event loop callback {}: {}'.format(getattr(timer.fn, '__name__', timer.fn), repr(e)))
+        return True
+
+    def run_until(self, when):
+        '''
+        Run every callback due up to time `when`, then wait until `when`.
+        With a virtual clock this fast-forwards through idle time.
+        '''
+        while True:
+            nxt = self.next_time()
+            now = self.time()
+            if nxt is not None and nxt <= when:
+                self.run_once()
+            elif now < when:
+                with self._cond:
+                    self.clock.wait(self._cond, when - now)
+            else:
+                break
+
+    def run_forever(self):
+        ''' Run callbacks until stop() is called '''
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def start(self):
+        ''' Run the loop in a background thread '''
+        self._thread = threading.Thread(target=self.run_forever, name='socal-loop', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        ''' Stop the loop after the current callback '''
+        def _stop():
+            self._running = False
+        self.call_soon(_stop)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,197 @@
+############################################################
+#
+#  exposure_meter.py
+#
+#  Streaming exposure meter: integrates the pyrheliometer
+#  irradiance over the exposures of the spectrograph, each
+#  opened and closed by its exposure id, for the FITS header
+#  (accumulated flux, flux-weighted midpoint) and to end an
+#  exposure early once it reaches a target SNR.
+#
+#  Every sample updates each open exposure in O(1): the flux
+#  is taken as linear between samples (trapezoid rule), which
+#  also gives the exact integral of flux*time over each
+#  segment for the flux-weighted mean time. Between the last
+#  sample and the current time (an exposure still open, or
+#  stopped before the next sample) the last flux is held.
+#
+#      meter = ExposureMeter(snr_coefficient=...)
+#      meter.start('KP.20240621.12345.67')
+#      meter.add(time.time(), irradiance)      # for every sample
+#      meter.result('KP.20240621.12345.67')    # at any time
+#      meter.stop('KP.20240621.12345.67')
+#
+############################################################
+
+import math
+import time
+import threading
+from collections import OrderedDict
+
+KEEP_CLOSED = 100 # closed exposures kept for lookup by id
+
+class Exposure(object):
+    ''' Running integrals of one exposure window '''
+
+    __slots__ = ('id', 'start', 'stop', 'samples', 'integral', 'weighted_time',
+                 'last_time', 'last_flux', 'peak', 'gaps')
+
+    def __init__(self, exposure_id, start, flux=None):
+        self.id            = exposure_id
+        self.start         = start
+        self.stop          = None
+        self.samples       = 0
+        self.integral      = 0. # [J/m^2] integral of irradiance [W/m^2] over time [s]
+        self.weighted_time = 0. # integral of irradiance*(t - start), for the flux-weighted mean time
+        self.last_time     = start
+        self.last_flux     = flux # Irradiance at last_time, None until the first sample
+        self.peak          = flux if flux is not None else 0.
+        self.gaps          = 0    # samples that could not be read (NaN)
+
+    def segment(self, t, flux):
+        ''' Integrate from the last sample to (t, flux), the irradiance linear in between '''
+        if t > self.last_time:
+            # Before the first sample, its irradiance is held back to the start of the window
+            t0, f0 = self.last_time - self.start, flux if self.last_flux is None else self.last_flux
+            t1 = t - self.start
+            dt = t1 - t0
+            self.integral      += 0.5*(f0 + flux)*dt
+            self.weighted_time += dt*(f0*(2*t0 + t1) + flux*(t0 + 2*t1))/6.
+        if t >= self.last_time:
+            self.last_time, self.last_flux = t, flux
+
+    def totals(self, now):
+        ''' (integral, weighted time) up to `now`, holding the last irradiance after the last sample '''
+        integral, weighted = self.integral, self.weighted_time
+        if self.last_flux is not None and now > self.last_time:
+            t0, t1 = self.last_time - self.start, now - self.start
+            integral += self.last_flux*(t1 - t0)
+            weighted += 0.5*self.last_flux*(t1*t1 - t0*t0)
+        return integral, weighted
+
+
+class ExposureMeter(object):
+    '''
+    Integrates irradiance samples over any number of overlapping exposures.
+    Thread safe: samples typically come from the pyrheliometer poller while
+    exposures are started, stopped and read from KTL.
+    '''
+
+    def __init__(self, snr_coefficient=None, clock=time.time):
+        '''
+        Args:
+            snr_coefficient: SNR reached per sqrt(J/m^2) of accumulated flux, i.e.
+                             SNR = snr_coefficient*sqrt(integral) (photon noise);
+                             calibrate it from past exposures. None: no SNR estimates
+            clock:           callable returning the current (unix) time, as the samples
+        '''
+        self.snr_coefficient = snr_coefficient
+        self.clock  = clock
+        self.open   = {}            # exposure id -> Exposure
+        self.closed = OrderedDict() # exposure id -> result, the most recent KEEP_CLOSED
+        self.last   = None          # (time, irradiance) of the last sample
+        self._lock  = threading.Lock()
+
+    def start(self, exposure_id, t=None):
+        ''' Open the integration window of an exposure at time `t` (default now) '''
+        t = self.clock() if t is None else t
+        with self._lock:
+            assert exposure_id not in self.open, 'Exposure {} is already open'.format(exposure_id)
+            # Start from the last irradiance until the first sample in the window comes in
+            self.open[exposure_id] = Exposure(exposure_id, t, None if self.last is None else self.last[1])
+
+    def stop(self, exposure_id, t=None):
+        '''
+        Close the integration window of an exposure at time `t` (default now)
+
+        Returns: (dict) the final result, see result()
+        '''
+        t = self.clock() if t is None else t
+        with self._lock:
+            exposure = self.open.pop(exposure_id)
+            exposure.stop = t
+            result = self._result(exposure, t)
+            self.closed[exposure_id] = result
+            while len(self.closed) > KEEP_CLOSED:
+                self.closed.popitem(last=False)
+        return result
+
+    def add(self, t, irradiance):
+        ''' A new irradiance sample [W/m^2] taken at time `t`; unreadable (NaN/None) samples are skipped '''
+        if irradiance is None or math.isnan(irradiance):
+            with self._lock:
+                for exposure in self.open.values():
+                    exposure.gaps += 1
+            return
+        irradiance = float(irradiance)
+        with self._lock:
+            self.last = (t, irradiance)
+            for exposure in self.open.values():
+                if t >= exposure.start:
+                    exposure.segment(t, irradiance)
+                    exposure.samples += 1
+                    exposure.peak = max(exposure.peak, irradiance)
+
+    def result(self, exposure_id, now=None):
+        '''
+        Current integrals of an open exposure (up to `now`, default the current
+        time), or the final ones of a closed exposure
+
+        Returns: (dict) 'id', 'start', 'stop' (None while open), 'elapsed' [s],
+                 'samples', 'gaps', 'flux' (accumulated irradiance [J/m^2]),
+                 'mean_irradiance' and 'peak_irradiance' [W/m^2], 'midpoint'
+                 (flux-weighted mean time, unix; None before any flux) and
+                 'snr' (None without snr_coefficient)
+        '''
+        with self._lock:
+            if exposure_id in self.open:
+                return self._result(self.open[exposure_id], self.clock() if now is None else now)
+            return self.closed[exposure_id]
+
+    def _result(self, exposure, now):
+        end = now if exposure.stop is None else exposure.stop
+        integral, weighted = exposure.totals(end)
+        elapsed = end - exposure.start
+        return {'id'              : exposure.id,
+                'start'           : exposure.start,
+                'stop'            : exposure.stop,
+                'elapsed'         : elapsed,
+                'samples'         : exposure.samples,
+                'gaps'            : exposure.gaps,
+                'flux'            : integral,
+                'mean_irradiance' : integral/elapsed if elapsed > 0 else exposure.last_flux,
+                'peak_irradiance' : exposure.peak,
+                'midpoint'        : exposure.start + weighted/integral if integral > 0 else None,
+                'snr'             : self.snr(integral),
+               }
+
+    def snr(self, integral):
+        ''' SNR expected from an accumulated flux [J/m^2] '''
+        if self.snr_coefficient is None:
+            return None
+        return self.snr_coefficient*math.sqrt(max(integral, 0.))
+
+    def time_to_snr(self, exposure_id, target, now=None):
+        '''
+        Seconds left until an open exposure reaches SNR `target` at the current
+        irradiance: 0 once reached, inf if there is no light (or no SNR calibration)
+        '''
+        result = self.result(exposure_id, now)
+        if result['snr'] is None:
+            return math.inf
+        needed = (target/self.snr_coefficient)**2 - result['flux']
+        if needed <= 0:
+            return 0.
+        with self._lock:
+            irradiance = self.last[1] if self.last is not None else 0.
+        return needed/irradiance if irradiance > 0 else math.inf
+
+    def reached(self, exposure_id, target, now=None):
+        ''' True once an exposure has accumulated enough flux for SNR `target` '''
+        snr = self.result(exposure_id, now)['snr']
+        return snr is not None and snr >= target
+
+    def on_telemetry(self, snapshot, device, values):
+        ''' TelemetryPoller listener: feed the pyrheliometer polls to the meter '''
+        if device == 'pyrheliometer' and 'irradiance' in values:
+            self.add(snapshot.timestamp, values['irradiance'])
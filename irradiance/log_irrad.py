@@ -1,8 +1,15 @@
+import os
 import sys
 import csv
 import time
-import pyrheliometer
-from astropy.time import Time
+
+# Run from anywhere: the drivers import from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from irradiance import pyrheliometer
+
+def jd_now():
+    ''' Current time as a Julian Date (avoids importing astropy at startup) '''
+    return time.time()/86400. + 2440587.5
 
 try:
     pyr = pyrheliometer.EKOPyrheliometer()
@@ -13,9 +20,9 @@ try:
             while True:
 
                 # Timestamp for data polling
-                jd1 = Time.now().jd
+                jd1 = jd_now()
                 min_irrad, max_irrad, sensitivity, out_voltage, solar_irrad, temperature = pyr.poll()
-                jd2 = Time.now().jd
+                jd2 = jd_now()
                 time_poll = (jd1+jd2)/2  
 
                 # Write to file
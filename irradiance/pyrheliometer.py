@@ -14,40 +14,55 @@ from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.constants import Endian
 from pymodbus.payload import BinaryPayloadDecoder
 from pymodbus.exceptions import ModbusIOException
+from telemetry import metrics
 
 # Global static variables
 TCP_IP   = '192.168.23.243' # Lantronix UDS1100-IAP IP address
 TCP_PORT = 502 # Standard/default port for Modbus
 
+# Modbus TCP frame sizes for the metrics: 7 byte MBAP header + 5 byte
+# read request PDU, response PDU is 2 bytes + 2 bytes per register
+REQUEST_BYTES = 12
+def response_bytes(count):
+    return 9 + 2*count
+
 class EKOPyrheliometer(object):
 
-    def __init__(self):
+    def __init__(self, host=TCP_IP, port=TCP_PORT, transport=None):
         '''
         Initialize pyrheliometer object and open 
         the connection to the TCP/IP port
+
+        Args:
+            host: (str) Lantronix UDS1100-IAP IP address
+            port: (int) Modbus TCP port
+            transport: ModbusTcpClient class to use instead of pymodbus' own,
+                       e.g. a recording or replay client from telemetry.wirelog
         '''
-        self.client = ModbusTcpClient(host=TCP_IP, port=TCP_PORT,
+        self.host, self.port = host, int(port)
+        client_class = ModbusTcpClient if transport is None else transport
+        self.client = client_class(host=self.host, port=self.port,
                                       baudrate=9600, # 9600
                                       timeout=3,  # default is 3 sec
                                       parity='N', # N/O/E = none/odd/even
                                       stopbits=2, # 2 if parity=none, 1 if parity=odd/even,
                                       bytesize=8, # data length is 8 bits
                                       )
-        print('Connected to {} at Port {}'.format(TCP_IP, TCP_PORT))
+        print('Connected to {} at Port {}'.format(self.host, self.port))
 
     def close_connection(self):
         '''
         Close the Modbus TCP client
         '''
         self.client.close()
-        print('Closed connection to {} at Port {}'.format(TCP_IP, TCP_PORT))
+        print('Closed connection to {} at Port {}'.format(self.host, self.port))
 
     def open_connection(self):
         '''
         Open the Modbus TCP client
         '''
         self.client.connect()
-        print('Opened connection to {} at Port {}'.format(TCP_IP, TCP_PORT))
+        print('Opened connection to {} at Port {}'.format(self.host, self.port))
 
     def poll(self):
         '''
@@ -64,7 +79,11 @@ class EKOPyrheliometer(object):
         '''
 
         # Minimum and Maximum Irradiance settings on registers 13, 14 (UINT16)
-        rr = self.client.read_holding_registers(address=13, count=2, unit=1)
+        with metrics.timed('pyrheliometer', 'read_min_max') as stats:
+            rr = self.client.read_holding_registers(address=13, count=2, unit=1)
+            stats['sent'] = REQUEST_BYTES
+            stats['error'] = type(rr) is ModbusIOException
+            stats['received'] = 0 if stats['error'] else response_bytes(2)
         if type(rr) is ModbusIOException:
             print('ModbusIOException when polling min/max irradiance')
             min_irrad, max_irrad = np.nan, np.nan
@@ -72,7 +91,11 @@ class EKOPyrheliometer(object):
             min_irrad, max_irrad = rr.registers
             
         # Remaining parameters are all floats so we can read them all at once
-        rr = self.client.read_holding_registers(address=16, count=9, unit=1)
+        with metrics.timed('pyrheliometer', 'read_values') as stats:
+            rr = self.client.read_holding_registers(address=16, count=9, unit=1)
+            stats['sent'] = REQUEST_BYTES
+            stats['error'] = type(rr) is ModbusIOException
+            stats['received'] = 0 if stats['error'] else response_bytes(9)
         if type(rr) is ModbusIOException:
             sensitivity, out_voltage, solar_irrad, temperature = np.nan, np.nan, np.nan, np.nan
         else:
@@ -0,0 +1,470 @@
+############################################################
+#
+#  localktl.py
+#
+#  In-process stand-in for a KTL service, so that the SoCal
+#  state machine can run away from Keck. Mirrors the parts of
+#  the KTLPython API that SolarCalibrator uses:
+#
+#      service = localktl.Service('kpfsocal')
+#      service['ENCSTATUS'].read()
+#      service['ENCCMD'].write('open')
+#      service['WXSAFE'].callback(fn); service['WXSAFE'].monitor()
+#
+#  Keywords are backed by getter/setter functions, e.g. from a
+#  SoCalDispatcher (see dispatcher_service) or a simulator.
+#  Monitored keywords are broadcast to their callbacks only
+#  when they change: by more than their Deadband for noisy
+#  numbers, or at least every `heartbeat` seconds regardless.
+#
+############################################################
+
+import math
+import time
+import threading
+
+def to_ascii(value):
+    ''' KTL-style ascii representation of a keyword value '''
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+    return str(value)
+
+def as_bool(value):
+    ''' KTL keywords read as strings by default, so 'False'/'0'/'no'/'off' must count as False '''
+    if isinstance(value, str):
+        return value.strip().lower() in ['1', 'true', 'yes', 'on', 't', 'y']
+    return bool(value)
+
+
+class Deadband(object):
+    '''
+    Smallest change of a numeric keyword worth broadcasting: more than
+    `absolute`, or more than `relative` times the value last broadcast,
+    whichever is larger. Values that are not numbers change when they differ.
+    '''
+
+    __slots__ = ('absolute', 'relative')
+
+    def __init__(self, absolute=0., relative=0.):
+        self.absolute = absolute
+        self.relative = relative
+
+    def __repr__(self):
+        return '<Deadband absolute={} relative={}>'.format(self.absolute, self.relative)
+
+    def exceeded(self, last, value):
+        ''' True if `value` is worth broadcasting after `last` '''
+        if isinstance(value, bool) or isinstance(last, bool) or \
+           not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+            return value != last
+        if math.isnan(value) or math.isnan(last):
+            return math.isnan(value) != math.isnan(last)
+        return abs(value - last) > max(self.absolute, self.relative*abs(last))
+
+
+class Keyword(object):
+    '''
+    One keyword of a local Service. Its value comes from `getter` (or is held
+    in memory if there is none) and writes go to `setter` (or into memory).
+    A `blocking` setter (e.g. a dome move) runs on its own thread when written
+    with wait=False, as a KTL write would complete in the dispatcher.
+    Monitored callbacks fire when the value moves past the `deadband` from
+    the value last broadcast (any change without one), and at least every
+    `heartbeat` seconds that it is read. If `age` is given, it returns how old
+    [s] the getter's value is (e.g. served from a telemetry snapshot), and the
+    keyword's timestamp is when the value was read from the device.
+    '''
+
+    def __init__(self, service, name, getter=None, setter=None, value=None, blocking=False,
+                 deadband=None, heartbeat=None, age=None):
+        self.service    = service
+        self.name       = name
+        self.getter     = getter
+        self.age        = age
+        self.setter     = setter
+        self.blocking   = blocking
+        self.deadband   = deadband
+        self.heartbeat  = heartbeat
+        self.updates    = 0    # Values read or written
+        self.broadcasts = 0    # ... of which were broadcast to the callbacks
+        self._lock      = threading.RLock()
+        self._value     = value
+        self._timestamp = time.time() if value is not None else None
+        self._sent      = value # Value last broadcast (or that would have been, if not monitored)
+        self._sent_at   = self._timestamp
+        self._pending   = {} # sequence -> thread running a non-waited blocking write
+        self._sequence  = 0
+        self._callbacks = []
+        self._monitored = False
+
+    def __repr__(self):
+        return "<localktl.Keyword {}.{}>".format(self.service.name, self.name)
+
+    def __getitem__(self, key):
+        ''' Cached values, as in KTLPython: keyword['ascii'], keyword['binary'], ... '''
+        return {'ascii'    : lambda: to_ascii(self._value),
+                'binary'   : lambda: self._value,
+                'timestamp': lambda: self._timestamp,
+                'age'      : lambda: None if self._timestamp is None else time.time() - self._timestamp,
+                'monitored': lambda: self._monitored,
+                'name'     : lambda: self.name,
+                'populated': lambda: self._timestamp is not None,
+               }[key]()
+
+    def read(self, binary=False, both=False, wait=True, timeout=None):
+        '''
+        Read the keyword from its backing getter
+
+        Returns:
+            The ascii value (default), the binary (native) value if `binary`,
+            (binary, ascii) if `both`, or a sequence number if not `wait`
+        '''
+        if self.getter is not None:
+            value = self.getter()
+            self._update(value, None if self.age is None else time.time() - self.age())
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        if not wait:
+            return sequence # Reads are synchronous here, so the value is already cached
+        return self._value_as(binary, both)
+
+    def _value_as(self, binary, both):
+        if both:
+            return self._value, to_ascii(self._value)
+        return self._value if binary else to_ascii(self._value)
+
+    def wait(self, timeout=None, sequence=None, **kwargs):
+        '''
+        Wait for a write issued with wait=False to complete (reads are synchronous)
+
+        Returns: True if it completed
+        '''
+        with self._lock:
+            thread = self._pending.get(sequence)
+        if thread is None:
+            return True
+        thread.join(timeout)
+        if thread.is_alive():
+            return False
+        with self._lock:
+            self._pending.pop(sequence, None)
+        return True
+
+    def write(self, value, wait=True, binary=False, timeout=None):
+        '''
+        Write the keyword: calls its setter (e.g. a device command), or just
+        stores the value for memory-only keywords.
+
+        Returns: sequence number of the write, for wait()
+        '''
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        if self.setter is not None and self.blocking and not wait:
+            thread = threading.Thread(target=self._write, args=(value,), daemon=True,
+                                      name='write-{}'.format(self.name))
+            with self._lock:
+                self._pending[sequence] = thread
+            thread.start()
+            return sequence
+        if self.setter is not None:
+            self.setter(value)
+        self._update(value)
+        return sequence
+
+    def _write(self, value):
+        try:
+            self.setter(value)
+            self._update(value)
+        except Exception as e:
+            print('Writing {} = {} failed: {}'.format(self.name, value, repr(e)))
+
+    def monitor(self, start=True, prime=True, wait=True):
+        '''
+        Start (or stop) delivering value changes to the callbacks. If the priming
+        read fails (e.g. the device is offline or not polled yet), the keyword
+        stays unpopulated until a later read succeeds.
+        '''
+        self._monitored = start
+        if start and prime:
+            try:
+                self.read()
+            except Exception as e:
+                print('Priming {} failed: {}'.format(self.name, repr(e)))
+
+    def callback(self, function, remove=False, preferred=False):
+        ''' Register `function(keyword)` to be called whenever the (monitored) value changes '''
+        with self._lock:
+            if remove:
+                if function in self._callbacks:
+                    self._callbacks.remove(function)
+            elif function not in self._callbacks:
+                if preferred:
+                    self._callbacks.insert(0, function)
+                else:
+                    self._callbacks.append(function)
+
+    def _update(self, value, timestamp=None):
+        with self._lock:
+            now = time.time()
+            if self._sent_at is None:
+                changed = True
+            elif self.deadband is not None:
+                changed = self.deadband.exceeded(self._sent, value)
+            else:
+                changed = value != self._sent
+            if not changed and self.heartbeat is not None and self._monitored:
+                changed = now - self._sent_at >= self.heartbeat
+            self._value = value
+            self._timestamp = now if timestamp is None else timestamp
+            self.updates += 1
+            if changed:
+                self._sent, self._sent_at = value, now
+            callbacks = list(self._callbacks) if (changed and self._monitored) else []
+            if callbacks:
+                self.broadcasts += 1
+        for function in callbacks:
+            try:
+                function(self)
+            except Exception as e:
+                print('Keyword callback {} for {} failed: {}'.format(function, self.name, repr(e)))
+
+
+class Service(object):
+    ''' A named set of local keywords '''
+
+    def __init__(self, name):
+        self.name = name
+        self._keywords = {}
+
+    def __repr__(self):
+        return "<localktl.Service {}>".format(self.name)
+
+    def __getitem__(self, name):
+        try:
+            return self._keywords[name.upper()]
+        except KeyError:
+            raise KeyError('Service {} has no keyword {}'.format(self.name, name))
+
+    def __contains__(self, name):
+        return name.upper() in self._keywords
+
+    def keywords(self):
+        return list(self._keywords)
+
+    def define(self, name, getter=None, setter=None, value=None, blocking=False, deadband=None, heartbeat=None,
+               age=None):
+        '''
+        Add a keyword
+
+        Args:
+            name:     (str) keyword name, e.g. 'ENCSTATUS'
+            getter:   (callable) returns the current value; None for memory keywords
+            setter:   (callable) called with the written value, e.g. to send a command
+            value:    initial value of a memory keyword
+            blocking: (bool) the setter only returns once the command is done
+            deadband: (Deadband) smallest change broadcast; None: any change
+            heartbeat: (float) seconds after which an unchanged value is broadcast again
+            age:      (callable) returns the age [s] of the getter's value, for its timestamp
+        '''
+        keyword = Keyword(self, name.upper(), getter=getter, setter=setter, value=value, blocking=blocking,
+                          deadband=deadband, heartbeat=heartbeat, age=age)
+        self._keywords[keyword.name] = keyword
+        return keyword
+
+    def read_many(self, names, binary=False):
+        ''' Read several keywords in a single request '''
+        return {name: self[name].read(binary=binary) for name in names}
+
+    def refresh(self, names=None):
+        '''
+        Re-read monitored keywords (default: all of them) from their getters,
+        which fires callbacks on every keyword whose value changed
+        '''
+        for name in (names or self._keywords):
+            keyword = self[name]
+            if keyword._monitored and keyword.getter is not None:
+                try:
+                    keyword.read()
+                except Exception as e:
+                    print('Refreshing {} failed: {}'.format(name, repr(e)))
+
+    def attach(self, poller, keywords=None):
+        '''
+        Refresh monitored keywords every time a TelemetryPoller publishes new values
+
+        Args:
+            keywords: (dict) device -> names of the keywords refreshed after a poll of
+                      that device, plus None -> those refreshed after a poll of any
+                      device; None: all of them after every poll
+        '''
+        if keywords is None:
+            poller.subscribe(lambda snapshot, device, values: self.refresh())
+            return
+        polled = {device: [name.upper() for name in names + keywords.get(None, [])]
+                  for device, names in keywords.items() if device is not None}
+        always = [name.upper() for name in keywords.get(None, [])]
+        poller.subscribe(lambda snapshot, device, values: self.refresh(polled.get(device, always)))
+
+
+class BroadcastCounter(object):
+    '''
+    Stand-in KTL client: monitors keywords and counts the broadcasts it
+    receives, against the updates a server republishing every value read
+    would have sent, to measure what the deadbands save
+    '''
+
+    def __init__(self, service, names=None):
+        self.service  = service
+        self.names    = [name.upper() for name in (names or service.keywords())]
+        self.received = dict.fromkeys(self.names, 0)
+        self.bytes    = dict.fromkeys(self.names, 0) # ascii payload received
+        self._lock    = threading.Lock()
+        self._updates = {name: service[name].updates for name in self.names} # Before we came
+        for name in self.names:
+            service[name].callback(self._receive)
+            service[name].monitor()
+
+    def _receive(self, keyword):
+        with self._lock:
+            self.received[keyword.name] += 1
+            self.bytes[keyword.name] += len(keyword['ascii'])
+
+    def close(self):
+        ''' Stop counting (the keywords stay monitored) '''
+        for name in self.names:
+            self.service[name].callback(self._receive, remove=True)
+
+    def report(self):
+        '''
+        Returns: (dict) keyword -> {'updates': values read or written, 'received':
+                 broadcasts received, 'bytes'}, plus 'total' with the 'reduction'
+                 (fraction of the updates not broadcast)
+        '''
+        with self._lock:
+            report = {name: {'updates' : self.service[name].updates - self._updates[name],
+                             'received': self.received[name],
+                             'bytes'   : self.bytes[name]}
+                      for name in self.names}
+        total = {key: sum(counts[key] for counts in report.values()) for key in ['updates', 'received', 'bytes']}
+        total['reduction'] = 1. - total['received']/total['updates'] if total['updates'] else 0.
+        report['total'] = total
+        return report
+
+
+# Deadbands of the noisy numeric keywords of dispatcher_service
+DEADBANDS = {'EKOALT'    : Deadband(0.002),  # [deg], encoder steps are 0.001
+             'EKOAZ'     : Deadband(0.002),
+             'EKOOFFALT' : Deadband(0.002),
+             'EKOOFFAZ'  : Deadband(0.002),
+             'SUNALT'    : Deadband(0.002),
+             'SUNAZ'     : Deadband(0.002),
+             'IRRADIANCE': Deadband(1., 0.002), # [W/m^2]
+             'ENCMOTOR'  : Deadband(0.05),   # [A]
+             'ENCTEMPIN' : Deadband(0.3),    # [F]
+             'ENCTEMPOUT': Deadband(0.3),
+            }
+HEARTBEAT = 60. # [s] unchanged keywords are broadcast again at least this often
+
+# dispatcher_service keywords refreshed after each poll of a device; those under
+# None (liveness and power) after a poll of any device, so they also follow a hung one
+POLLED_KEYWORDS = {'dome'         : ['ENCSTATUS', 'ENCMOTOR', 'ENCTEMPIN', 'ENCTEMPOUT'],
+                   'tracker'      : ['EKOMODE', 'EKOALT', 'EKOAZ', 'EKOHOME', 'EKOGUIDING', 'SUNALT', 'SUNAZ'],
+                   'guiding'      : ['EKOOFFALT', 'EKOOFFAZ', 'EKOGUIDING'],
+                   'pyrheliometer': ['IRRADIANCE'],
+                   None           : ['ENCONLINE', 'EKOONLINE', 'EKOPOWER'],
+                  }
+
+# Telemetry snapshot keyword each dispatcher_service keyword is read from, for its age
+SNAPSHOT_KEYWORDS = {'ENCSTATUS' : 'dome_status',
+                     'ENCMOTOR'  : 'dome_status',
+                     'ENCTEMPIN' : 'dome_status',
+                     'ENCTEMPOUT': 'dome_status',
+                     'EKOMODE'   : 'tracking_mode',
+                     'EKOALT'    : 'current_alt',
+                     'EKOAZ'     : 'current_az',
+                     'EKOOFFALT' : 'guiding_offset_alt',
+                     'EKOOFFAZ'  : 'guiding_offset_az',
+                     'EKOHOME'   : 'tracking_mode',
+                     'EKOGUIDING': 'tracking_mode',
+                     'SUNALT'    : 'pred_sun_alt',
+                     'SUNAZ'     : 'pred_sun_az',
+                     'IRRADIANCE': 'irradiance',
+                    }
+
+def dispatcher_service(dispatcher, name='kpfsocal', deadbands=None, heartbeat=HEARTBEAT):
+    '''
+    Build the kpfsocal keywords on top of a SoCalDispatcher. If the dispatcher
+    is polling, monitored keywords follow its telemetry snapshots, broadcast
+    when they change by more than their deadband (DEADBANDS, updated with
+    `deadbands`; a None deadband broadcasts any change) or every `heartbeat`.
+    After a poll, only the keywords of the polled device are refreshed
+    (POLLED_KEYWORDS). Keyword getters never read a device while polling: they
+    serve the snapshot however old (see dispatcher.from_snapshot), and carry
+    the time their value was read from the device: keyword['timestamp'] and
+    keyword['age'].
+
+    Weather (WXSAFE) is not measured by SoCal: it is a memory keyword that the
+    weather feed must write. It starts out unsafe. Writing it unsafe while it
+    was safe closes the dome at once (dispatcher.emergency_close), without
+    waiting for SoCal to react.
+    '''
+    service = Service(name)
+    deadbands = dict(DEADBANDS, **(deadbands or {}))
+    def define(name, getter, **kwargs):
+        polled = SNAPSHOT_KEYWORDS.get(name)
+        age = None if polled is None else (lambda: dispatcher.keyword_age(polled))
+        return service.define(name, getter=lambda: dispatcher.from_snapshot(getter), deadband=deadbands.get(name),
+                              heartbeat=heartbeat, age=age, **kwargs)
+
+    def wx_update(value):
+        if not as_bool(value) and as_bool(service['WXSAFE']['binary']):
+            dispatcher.emergency_close('WXSAFE')
+
+    def enc_command(command):
+        {'open' : dispatcher.open_dome,
+         'close': dispatcher.close_dome,
+         'stop' : dispatcher.dome.stop}[command]()
+
+    def eko_command(command):
+        if command == 'guide':
+            dispatcher.acquire_sun()
+        elif command in ['stow', 'home']:
+            dispatcher.stow_tracker()
+        else:
+            raise ValueError('Unknown EKOCMD {}'.format(command))
+
+    # Enclosure
+    define('ENCSTATUS', getter=lambda: dispatcher.dome_status['Status'])
+    define('ENCONLINE', getter=lambda: dispatcher.dome_online)
+    define('ENCMOTOR', getter=lambda: dispatcher.dome_status['Motor']['current'])
+    define('ENCTEMPIN', getter=lambda: dispatcher.dome_status.get('Temperatures', {}).get('inside'))
+    define('ENCTEMPOUT', getter=lambda: dispatcher.dome_status.get('Temperatures', {}).get('outside'))
+    service.define('ENCCMD', setter=enc_command, value='', blocking=True)
+    # Sun tracker
+    define('EKOMODE', getter=lambda: dispatcher.tracking_mode,
+           setter=lambda mode: setattr(dispatcher, 'tracking_mode', mode), blocking=True)
+    define('EKOALT', getter=lambda: dispatcher.current_alt)
+    define('EKOAZ', getter=lambda: dispatcher.current_az)
+    define('EKOOFFALT', getter=lambda: dispatcher.guiding_offset_alt)
+    define('EKOOFFAZ', getter=lambda: dispatcher.guiding_offset_az)
+    define('EKOHOME', getter=lambda: dispatcher.is_home)
+    define('EKOGUIDING', getter=dispatcher.on_sun)
+    define('EKOONLINE', getter=lambda: dispatcher.tracker_alive)
+    service.define('EKOCMD', setter=eko_command, value='', blocking=True)
+    define('EKOPOWER', getter=lambda: dispatcher.tracker_power, setter=dispatcher.set_tracker_power, blocking=True)
+    define('SUNALT', getter=lambda: dispatcher.pred_sun_alt)
+    define('SUNAZ', getter=lambda: dispatcher.pred_sun_az)
+    # Pyrheliometer
+    define('IRRADIANCE', getter=lambda: dispatcher.irradiance)
+    # Memory keywords
+    service.define('WXSAFE', setter=wx_update, value=False)
+    service.define('OPERATE', value=True)
+    service.define('LASTSTATE', value='PoweredOff')
+
+    if dispatcher.poller is not None:
+        service.attach(dispatcher.poller, POLLED_KEYWORDS)
+    return service
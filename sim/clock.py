@@ -0,0 +1,32 @@
+############################################################
+#
+#  clock.py
+#
+#  Virtual clock for running SoCal in accelerated time.
+#  Drop-in for eventloop.SystemClock: sleeping or waiting
+#  just moves the clock forward, so a simulated day of
+#  operations executes in seconds.
+#
+############################################################
+
+class VirtualClock(object):
+
+    def __init__(self, start=0.):
+        self.t = float(start)
+
+    def time(self):
+        return self.t
+
+    def sleep(self, seconds):
+        ''' Blocking device operations "take" time by advancing the clock '''
+        if seconds > 0:
+            self.t += seconds
+
+    def advance_to(self, when):
+        self.t = max(self.t, when)
+
+    def wait(self, condition, timeout):
+        ''' Called by the event loop when idle: jump straight to the next timer '''
+        if timeout is None:
+            raise RuntimeError('Virtual clock would wait forever: nothing is scheduled')
+        self.sleep(timeout)
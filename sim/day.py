@@ -0,0 +1,274 @@
+############################################################
+#
+#  day.py
+#
+#  Run a full SoCal observing day in accelerated virtual time:
+#  the real SoCal state machine and event loop on top of the
+#  simulated hardware in sim.world, with a VirtualClock so
+#  that every timer, dome move and tracker slew takes no wall
+#  time. Reports transitions and on-sky efficiency.
+#
+#      python -m sim.day --date 2024-06-21 --unsafe 13:00-13:45
+#
+############################################################
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import contextlib
+from collections import Counter
+
+from eventloop import EventLoop
+from SolarCalibrator import SoCal
+from sim.clock import VirtualClock
+from telemetry.tracing import Tracer
+from sim.world import SimWorld, SimWeather, local_midnight
+
+DAY = 86400.
+
+class DayDriver(object):
+    '''
+    Stands in for the operator: powers SoCal on in the morning and off once
+    the day is over. SoCal opens by itself while the Sun is up (SoCal.reopen)
+    '''
+
+    def __init__(self, socal, world, power_on_at, power_off_at):
+        self.socal        = socal
+        self.world        = world
+        self.loop         = socal.loop
+        self.power_on_at  = power_on_at
+        self.power_off_at = power_off_at
+
+    def start(self):
+        self.loop.call_at(self.power_on_at, self.morning)
+        self.loop.call_at(self.power_off_at, self.evening)
+
+    def morning(self):
+        if self.socal.state == 'PoweredOff':
+            self.socal.power_on()
+
+    def evening(self):
+        if self.socal.state == 'Stowed':
+            self.socal.power_off()
+        elif self.socal.state != 'PoweredOff':
+            self.loop.call_later(60., self.evening) # Still closing up, try again shortly
+
+
+class TransitionLog(object):
+    ''' Records (time, source, dest) for every state change of a SoCal machine '''
+
+    def __init__(self, socal):
+        self.events = []
+        self._began = None
+        self.follow(socal)
+
+    def follow(self, socal):
+        ''' Log `socal`'s transitions from now on (e.g. a restarted instance) '''
+        self.socal  = socal
+        self._state = socal.state
+        # Stamp the transition when it starts: on_enter callbacks (dome moves, slews) take time
+        socal.machine.before_state_change.append(self.began)
+        socal.machine.after_state_change.append(self.changed)
+
+    def began(self, *args, **kwargs):
+        self._began = self.socal.loop.time()
+
+    def changed(self, *args, **kwargs):
+        state = self.socal.state
+        if state != self._state: # Internal transitions (staying OnSky) are not state changes
+            self.events.append((self._began, self._state, state))
+            self._state = state
+
+    def time_in(self, state, until):
+        ''' Total seconds spent in `state` up to time `until` '''
+        total, entered = 0., None
+        for t, source, dest in self.events:
+            if dest == state and entered is None:
+                entered = t
+            elif source == state and entered is not None:
+                total += t - entered
+                entered = None
+        if entered is not None:
+            total += until - entered
+        return total
+
+    def first(self, state):
+        ''' Time SoCal first entered `state`, or None '''
+        for t, source, dest in self.events:
+            if dest == state:
+                return t
+        return None
+
+
+def available_time(world, t0, t1, limit, step=10.):
+    '''
+    Seconds between t0 and t1 with the Sun above `limit` and safe weather,
+    and the first such time (or None)
+    '''
+    total, first = 0., None
+    t = t0
+    while t < t1:
+        if world.weather.is_safe(t) and world.sun.altitude(t) >= limit:
+            total += step
+            if first is None:
+                first = t
+        t += step
+    return total, first
+
+class SimInstance(object):
+    ''' One simulated calibrator: its world, keyword service, SoCal machine, operator and log '''
+
+    def __init__(self, clock, loop, midnight, unsafe=(), power_on='06:00', power_off='19:30',
+                 checkpoint=None, tracer=None, name='socal', socal_options=None, **world_kwargs):
+        at = lambda hhmm: local_time(midnight, hhmm)
+        self.midnight   = midnight
+        self.loop       = loop
+        self.checkpoint = checkpoint
+        self.tracer     = tracer
+        self.options    = dict(socal_options or {}, checkpoint=checkpoint, tracer=tracer, name=name)
+        self.world      = SimWorld(clock, loop, weather=SimWeather([(at(t0), at(t1)) for t0, t1 in unsafe]),
+                                   **world_kwargs)
+        self.service    = self.world.service()
+        socal           = SoCal(loop=loop, service=self.service, **self.options)
+        self.log        = TransitionLog(socal)
+        self.driver     = DayDriver(socal, self.world, at(power_on), at(power_off))
+        self.restarts   = []
+        self.driver.start()
+
+    @property
+    def socal(self):
+        return self.driver.socal
+
+    def restart(self):
+        ''' Kill the SoCal machine and start a new one, from the checkpoint if there is one '''
+        self.socal.shutdown()
+        socal = SoCal(loop=self.loop, service=self.service, **self.options)
+        self.restarts.append({'time': self.loop.time() - self.midnight, 'state': socal.state,
+                              'resumed': socal.restored is not None})
+        self.log.follow(socal)
+        self.driver.socal = socal
+
+    def report(self):
+        end = self.midnight + DAY
+        available, sun_up = available_time(self.world, self.midnight, end, SoCal.SUN_ALT_LIMIT)
+        onsky = self.log.time_in('OnSky', end)
+        first_onsky = self.log.first('OnSky')
+        events = self.log.events
+        return {'final_state'    : self.socal.state,
+                'transitions'    : len(events),
+                'by_transition'  : dict(Counter('{}->{}'.format(s, d) for _, s, d in events)),
+                'time_to_onsky'  : None if (first_onsky is None or sun_up is None) else first_onsky - sun_up,
+                'onsky_seconds'  : onsky,
+                'available_seconds': available,
+                'onsky_fraction' : onsky/available if available else 0.,
+                'restarts'       : self.restarts,
+                'overlap_saved'  : sum(self.socal.overlap_saved.values()),
+                'acquisitions'   : [t for times in self.socal.acquisition_times.values() for t in times],
+                'events'         : [(t - self.midnight, s, d) for t, s, d in events],
+               }
+
+def local_time(midnight, hhmm):
+    hours, minutes = hhmm.split(':')
+    return midnight + 3600*int(hours) + 60*int(minutes)
+
+def simulate_day(date='2024-06-21', unsafe=(), power_on='06:00', power_off='19:30', restart=None,
+                 trace=None, quiet=True, socal_options=None, **world_kwargs):
+    '''
+    Simulate one SoCal day
+
+    Args:
+        date:      (str) 'YYYY-MM-DD', local (HST) date
+        unsafe:    list of (start, end) local 'HH:MM' strings with unsafe weather
+        power_on:  (str) local time the operator powers SoCal on
+        power_off: (str) local time the operator powers SoCal off
+        restart:   (str) local time to kill SoCal and start a new instance from its checkpoint
+        trace:     (str) write a Chrome trace of the day (in simulated time) to this file
+        quiet:     (bool) silence SoCal's console messages
+        socal_options: (dict) extra SoCal arguments, e.g. {'overlap': True}
+        world_kwargs: passed to SimWorld (dome_move_time, slew_rate, lock_time, ...)
+
+    Returns: (dict) report
+    '''
+    midnight = local_midnight(date)
+    clock    = VirtualClock(midnight)
+    loop     = EventLoop(clock)
+    tracer   = Tracer(clock=lambda: int(clock.time()*1e9)) if trace else None
+
+    wall_start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp, \
+            open(os.devnull, 'w') if quiet else contextlib.nullcontext(sys.stdout) as out:
+        checkpoint = os.path.join(tmp, 'socal.json') if restart else None
+        with contextlib.redirect_stdout(out):
+            instance = SimInstance(clock, loop, midnight, unsafe, power_on, power_off,
+                                   checkpoint=checkpoint, tracer=tracer, socal_options=socal_options,
+                                   **world_kwargs)
+            if restart:
+                loop.call_at(local_time(midnight, restart), instance.restart)
+            loop.run_until(midnight + DAY)
+    wall = time.perf_counter() - wall_start
+    if tracer is not None:
+        tracer.export(trace)
+
+    report = instance.report()
+    report.update({'date': date, 'wall_seconds': wall, 'speedup': DAY/wall if wall else float('inf')})
+    return report
+
+def simulate_fleet(count, date='2024-06-21', unsafe=(), quiet=True, socal_options=None, **world_kwargs):
+    '''
+    Simulate `count` independent calibrators for one day, all multiplexed on a
+    single event loop (and virtual clock) in this thread. `unsafe` is a list of
+    weather windows for all of them, or a function of the instance number
+    returning one.
+
+    Returns: (dict) per-instance reports and the wall-clock cost of the day
+    '''
+    midnight = local_midnight(date)
+    clock    = VirtualClock(midnight)
+    loop     = EventLoop(clock)
+    wall_start = time.perf_counter()
+    with open(os.devnull, 'w') if quiet else contextlib.nullcontext(sys.stdout) as out:
+        with contextlib.redirect_stdout(out):
+            instances = [SimInstance(clock, loop, midnight, unsafe(i) if callable(unsafe) else unsafe,
+                                     name='socal-{}'.format(i), socal_options=socal_options, **world_kwargs)
+                         for i in range(count)]
+            loop.run_until(midnight + DAY)
+    wall = time.perf_counter() - wall_start
+    return {'date': date, 'count': count, 'wall_seconds': wall,
+            'reports': [instance.report() for instance in instances]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a full SoCal day in accelerated time')
+    parser.add_argument('--date', default='2024-06-21', help='local (HST) date, YYYY-MM-DD')
+    parser.add_argument('--unsafe', action='append', default=[], metavar='HH:MM-HH:MM',
+                        help='unsafe weather window (local time), may be repeated')
+    parser.add_argument('--restart', metavar='HH:MM', help='restart SoCal from its checkpoint at this local time')
+    parser.add_argument('--overlap', action='store_true', help='pre-position the tracker while the dome opens')
+    parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of the day (simulated time)')
+    parser.add_argument('--verbose', action='store_true', help="show SoCal's console output")
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = simulate_day(args.date, unsafe=[tuple(w.split('-')) for w in args.unsafe], restart=args.restart, trace=args.trace,
+                          socal_options={'overlap': args.overlap},
+                          quiet=not args.verbose)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for t, source, dest in report['events']:
+        print('{:02d}:{:02d}:{:02d}  {:>15} -> {}'.format(int(t//3600), int(t%3600//60), int(t%60), source, dest))
+    for r in report['restarts']:
+        print('Restarted at {:.0f} s: {} in {}'.format(r['time'], 'resumed' if r['resumed'] else 'cold start', r['state']))
+    print('Transitions:    {}'.format(report['transitions']))
+    if args.overlap:
+        print('Overlap saved:  {:.0f} s of acquisition'.format(report['overlap_saved']))
+    if report['time_to_onsky'] is not None:
+        print('Time to OnSky:  {:.0f} s after the Sun cleared {:.0f} deg'.format(report['time_to_onsky'], SoCal.SUN_ALT_LIMIT))
+    print('On sky:         {:.2f} h of {:.2f} h available ({:.1%})'.format(
+        report['onsky_seconds']/3600, report['available_seconds']/3600, report['onsky_fraction']))
+    print('Wall time:      {:.3f} s ({:.0f}x real time)'.format(report['wall_seconds'], report['speedup']))
+
+if __name__ == '__main__':
+    main()
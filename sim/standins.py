@@ -0,0 +1,227 @@
+############################################################
+#
+#  standins.py
+#
+#  Stand-in device drivers with the same interface as
+#  DougDimmadome, EKOSunTracker and EKOPyrheliometer, for
+#  running a real SoCalDispatcher (worker threads, poller,
+#  KTL keywords) without the hardware. Every request blocks
+#  for `latency` seconds, like a round trip on the wire, and
+#  the dome records when each command reached it. Readings
+#  are constant unless a NOISE (standard deviation) is set.
+#
+#      drivers.register('dome', 'sim.standins', 'StandInDome')
+#
+############################################################
+
+import time
+import random
+import threading
+
+def use_standins():
+    ''' Make the dispatcher create stand-ins instead of the real drivers '''
+    import drivers
+    drivers.register('dome', 'sim.standins', 'StandInDome')
+    drivers.register('tracker', 'sim.standins', 'StandInTracker')
+    drivers.register('pyrheliometer', 'sim.standins', 'StandInPyrheliometer')
+
+
+class StandInWebSocket(object):
+    connected = True
+
+
+class StandInDome(object):
+    '''
+    DomeGuard stand-in: answers like DougDimmadome and moves in `move_time`
+    seconds. `commands` holds (time.monotonic(), command) for every command as
+    it reaches the dome, after any requests ahead of it on the same connection.
+    '''
+
+    LATENCY   = 0.02 # [s] per request
+    MOVE_TIME = 60.  # [s] to open or close
+    NOISE     = 0.   # [A, C] on the motor current and temperatures
+
+    possible_responses = ["0 OK",
+                          "1 Rejected. Unknown command",
+                          "2 Rejected. Operation mode switch is in local mode",
+                          "3 Rejected. Switches on both ends are ON",
+                          "4 Rejected. System is running on battery",
+                          "5 Rejected. No Current sensor is present",
+                          "6 Rejected. Invalid output name",
+                          "7 Rejected. Operation blocked by sensor"
+                         ]
+
+    def __init__(self, host='standin', port=0, latency=None, move_time=None):
+        self.host, self.port = host, port
+        self.latency   = self.LATENCY if latency is None else latency
+        self.move_time = self.MOVE_TIME if move_time is None else move_time
+        self.ws        = StandInWebSocket()
+        self.rain      = 'off'
+        self.commands  = []
+        self.last_command = ''
+        self._moving   = None # (direction, start time)
+        self._position = 'Closed'
+        self._lock     = threading.Lock() # One request at a time, as on the WebSocket
+
+    def _request(self, command):
+        assert self._lock.acquire(blocking=False), 'Concurrent requests on the dome connection'
+        try:
+            self.commands.append((time.monotonic(), command))
+            if command not in ['s', 'status']:
+                self.last_command = command
+            time.sleep(self.latency)
+        finally:
+            self._lock.release()
+
+    def set_position(self, position):
+        ''' Put the dome in `position` ('Open' or 'Closed') at once '''
+        self._moving, self._position = None, position
+
+    @property
+    def position(self):
+        if self._moving is not None:
+            direction, start = self._moving
+            if time.monotonic() - start < self.move_time:
+                return direction
+            self._moving, self._position = None, {'Opening': 'Open', 'Closing': 'Closed'}[direction]
+        return self._position
+
+    def _move(self, direction):
+        if self.position != {'Opening': 'Open', 'Closing': 'Closed'}[direction]:
+            self._moving = (direction, time.monotonic())
+
+    def open(self):
+        self._request('open')
+        self._move('Opening')
+        return [self.possible_responses[0]]
+
+    def close(self):
+        self._request('close')
+        self._move('Closing')
+        return [self.possible_responses[0]]
+
+    def stop(self):
+        self._request('stop')
+        if self._moving is not None:
+            self._moving, self._position = None, 'Unknown'
+        return [self.possible_responses[0]]
+
+    def set_ch1(self, state):
+        assert state in ['on', 'off']
+        self._request('set ch1 {}'.format(state))
+        return [self.possible_responses[0]]
+
+    def status(self, short=False, verbose=False):
+        self._request('s' if short else 'status')
+        position = self.position
+        motor = position if position in ['Opening', 'Closing'] else 'Stopped'
+        current = round(abs((2.0 if motor != 'Stopped' else 0.0) + random.gauss(0., self.NOISE)), 2)
+        inside, outside, ebox = (round(t + random.gauss(0., self.NOISE), 1) for t in (20.0, 15.0, 30.0))
+        switch = lambda on: 'ON' if on else 'OFF'
+        if short:
+            text = '{},{:d},{:d},{:d},{:d},{},{},Remote,Sensors:, Power: on, Rain: {}, Light: off'.format(
+                position, position == 'Open', position == 'Open', position == 'Closed', position == 'Closed',
+                motor, current, self.rain)
+        else:
+            text = ('Status: {}\n'
+                    'OP mode: Remote\n'
+                    'Limits: open left: {}, open right: {}, close left: {}, close right: {}\n'
+                    'Motor: {}, actual current: {} A, measured max: 2.5 A, last overcurrent: N/A\n'
+                    'Temperatures: Inside {}, Outside {}, electronics {}\n'
+                    'Sensors:, Power: on, Rain: {}, Light: off\n'
+                    'Watchdog: on, timeout: 120 sec\n'
+                    'Last command: {}\n').format(
+                        position, switch(position == 'Open'), switch(position == 'Open'),
+                        switch(position == 'Closed'), switch(position == 'Closed'),
+                        motor, current, inside, outside, ebox, self.rain, self.last_command)
+        return [text, self.possible_responses[0]]
+
+
+class StandInTracker(object):
+    ''' EKO sun tracker stand-in, pointing wherever it was last slewed '''
+
+    LATENCY = 0.01 # [s] per request
+    NOISE   = 0.   # [deg] on the position and sun sensor offsets, read to 0.001 like the tracker
+
+    def __init__(self, host='standin', port=0, latency=None):
+        self.HOME_ALT = 0.0
+        self.HOME_AZ  = 0.0
+        self.host, self.port = host, port
+        self.latency  = self.LATENCY if latency is None else latency
+        self.mode     = '0'
+        self.alt, self.az = self.HOME_ALT, self.HOME_AZ
+        self.location = None
+        self._answering = threading.Event() # Cleared while hung
+        self._answering.set()
+        self._closed  = False
+
+    def _request(self):
+        self._answering.wait()
+        if self._closed:
+            raise OSError('Connection to the tracker stand-in is closed')
+        time.sleep(self.latency)
+
+    def hang(self):
+        ''' Stop answering, like a wedged serial port: requests block until the connection is closed '''
+        self._answering.clear()
+
+    def close_connection(self):
+        self._closed = True
+        self._answering.set()
+
+    def set_datetime(self, date, time):
+        self._request()
+        return 'OK'
+
+    def set_location(self, lat, lon):
+        self._request()
+        self.location = (lat, lon)
+        return 'OK'
+
+    def get_datetime(self):
+        self._request()
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+    def get_tracking_mode(self):
+        self._request()
+        return self.mode
+
+    def set_tracking_mode(self, mode):
+        self._request()
+        self.mode = str(mode)
+
+    def _read(self, angle):
+        return round(angle + random.gauss(0., self.NOISE), 3) if self.NOISE else angle
+
+    def get_corrected_position(self):
+        self._request()
+        return self._read(self.alt), self._read(self.az)
+
+    def get_calculated_position(self):
+        self._request()
+        return 45.0, 0.0
+
+    def get_sun_sensor_offset(self):
+        self._request()
+        return self._read(0.0), self._read(0.0)
+
+    def slew(self, alt, az, new_mode='0'):
+        self._request()
+        self.mode = new_mode
+        self.alt, self.az = alt, az
+
+
+class StandInPyrheliometer(object):
+    ''' EKO MS-57 stand-in reading a constant clear sky '''
+
+    LATENCY = 0.01 # [s] per request
+    NOISE   = 0.   # [W/m^2] on the irradiance
+
+    def __init__(self, host='standin', port=0, latency=None):
+        self.host, self.port = host, port
+        self.latency = self.LATENCY if latency is None else latency
+
+    def poll(self):
+        time.sleep(self.latency)
+        # min/max irradiance, sensitivity, output voltage, irradiance, heater temperature
+        return 0., 2000., 8.0, 7.2, 900. + random.gauss(0., self.NOISE), 25.
@@ -0,0 +1,289 @@
+############################################################
+#
+#  world.py
+#
+#  Simulated SoCal hardware and environment: Sun, weather,
+#  dome, tracker and pyrheliometer, all driven by one
+#  (virtual) clock and event loop. SimWorld.service()
+#  exposes them through the same kpfsocal keywords as the
+#  real dispatcher; device moves complete on loop timers.
+#
+############################################################
+
+import math
+import localktl
+from control import ephemeris
+from control.ephemeris import SITE_LAT, SITE_LON, UTC_OFFSET
+
+class SimSun(object):
+    ''' The Sun as seen from the site, from the same ephemeris the scheduler uses '''
+
+    def __init__(self, lat=SITE_LAT, lon=SITE_LON):
+        self.lat = lat
+        self.lon = lon
+
+    def position(self, t):
+        '''
+        Returns:
+            alt: (float) altitude in decimal degrees (0 = Horizon, 90 = Zenith)
+            az:  (float) azimuth in decimal degrees (0 = South, + West, - East)
+        '''
+        alt, az = ephemeris.sun_position(t, self.lat, self.lon)
+        return float(alt), float(az)
+
+    def altitude(self, t):
+        return self.position(t)[0]
+
+
+class SimWeather(object):
+    '''
+    Scripted weather: unsafe (and cloudy) during the given (start, end) windows
+    '''
+
+    def __init__(self, unsafe=()):
+        self.unsafe = sorted(unsafe)
+
+    def is_safe(self, t):
+        return not any(t0 <= t < t1 for t0, t1 in self.unsafe)
+
+    def changes(self):
+        ''' Times at which WXSAFE flips '''
+        return sorted(t for window in self.unsafe for t in window)
+
+
+class SimDome(object):
+    '''
+    Dome that takes `move_time` seconds to open or close. Commands return at
+    once, like a KTL write with wait=False; the move completes on a loop timer
+    and `changed()` is called so ENCSTATUS gets broadcast.
+    '''
+
+    def __init__(self, loop, changed, move_time=60.):
+        self.loop      = loop
+        self.changed   = changed
+        self.move_time = move_time
+        self.status    = 'Closed'
+        self.online    = True
+        self.fail_next = False # Set to make the next move stop halfway ('Unknown')
+        self._move     = None
+
+    def command(self, cmd):
+        if self._move is not None:
+            self._move.cancel()
+            self._move = None
+        if cmd == 'stop':
+            if self.status in ['Opening', 'Closing']:
+                self._finish('Unknown')
+            return
+        assert cmd in ['open', 'close'], 'Unknown dome command {}'.format(cmd)
+        target = {'open': 'Open', 'close': 'Closed'}[cmd]
+        if self.status == target:
+            return
+        self.status = {'open': 'Opening', 'close': 'Closing'}[cmd]
+        self.changed()
+        if self.fail_next:
+            self.fail_next = False
+            self._move = self.loop.call_later(self.move_time/2, self._finish, 'Unknown')
+        else:
+            self._move = self.loop.call_later(self.move_time, self._finish, target)
+
+    def _finish(self, status):
+        self._move  = None
+        self.status = status
+        self.changed()
+
+
+class SimTracker(object):
+    '''
+    Sun tracker: slews at `slew_rate` and, in sun-sensor modes, needs
+    `lock_time` of visible Sun to lock on. Commands return at once and
+    complete on loop timers, calling `changed()`.
+    '''
+
+    def __init__(self, clock, loop, sun, visible, changed, slew_rate=1.0, lock_time=30.):
+        self.clock     = clock
+        self.loop      = loop
+        self.sun       = sun
+        self.visible   = visible # callable: can the sun sensor see the Sun?
+        self.changed   = changed
+        self.slew_rate = slew_rate
+        self.lock_time = lock_time
+        self.home      = (0., 0.)
+        self.mode      = '0'
+        self.tracking  = False
+        self.locked    = False
+        self._alt, self._az = self.home
+        self.online    = True
+        self._busy     = None # Timer of the slew or lock in progress
+        self._slewing  = False
+
+    def position(self):
+        ''' Current pointing (alt, az) '''
+        if self.tracking:
+            return self.sun.position(self.clock.time())
+        return self._alt, self._az
+
+    def _slew_time(self, alt, az):
+        cur_alt, cur_az = self.position()
+        return max(abs(alt - cur_alt), abs(az - cur_az))/self.slew_rate
+
+    def _after(self, delay, fn):
+        if self._busy is not None:
+            self._busy.cancel()
+        self._busy = self.loop.call_later(delay, fn)
+
+    def set_mode(self, mode):
+        assert mode in ['0', '1', '2', '3'], 'Invalid tracking mode {}'.format(mode)
+        self.mode = mode
+        if mode == '0':
+            if self._busy is not None:
+                self._busy.cancel()
+                self._busy = None
+            self._slewing = False
+            self._alt, self._az = self.position()
+            self.tracking = self.locked = False
+        elif not self.tracking:
+            if not self._slewing: # A slew already on its way to the Sun just carries on in the new mode
+                self._slewing = True
+                self._after(self._slew_time(*self.sun.position(self.clock.time())), self._on_target)
+        else:
+            self._on_target()
+        self.changed()
+
+    def _on_target(self):
+        self._busy = None
+        self._slewing = False
+        self.tracking = True
+        if self.mode in ['2', '3'] and not self.locked:
+            self._after(self.lock_time, self._lock)
+        elif self.mode == '1':
+            self.locked = False
+        self.changed()
+
+    def _lock(self):
+        self._busy = None
+        self.locked = self.visible()
+        self.changed()
+
+    def stow(self):
+        self.set_mode('0')
+        self._after(self._slew_time(*self.home), self._homed)
+
+    def _homed(self):
+        self._busy = None
+        self._alt, self._az = self.home
+        self.changed()
+
+    @property
+    def on_sun(self):
+        return self.mode in ['2', '3'] and self.locked and self.visible()
+
+    @property
+    def is_home(self):
+        return self.mode == '0' and self._busy is None and (self._alt, self._az) == self.home
+
+
+class SimPyrheliometer(object):
+    ''' Direct normal irradiance seen by the pyrheliometer on the tracker '''
+
+    DNI_MAX = 1100. # [W/m^2] top of the clear-sky model
+
+    def __init__(self, clock, sun, tracker, dome, weather):
+        self.clock, self.sun, self.tracker, self.dome, self.weather = clock, sun, tracker, dome, weather
+
+    @property
+    def irradiance(self):
+        t = self.clock.time()
+        alt = self.sun.altitude(t)
+        if alt <= 0 or self.dome.status != 'Open' or not self.tracker.tracking:
+            return 0.
+        # Simple clear-sky model with airmass ~ 1/sin(alt); clouds when the weather is bad
+        dni = self.DNI_MAX*0.7**(1./math.sin(math.radians(alt)))**0.678
+        return dni if self.weather.is_safe(t) else 0.1*dni
+
+
+class SimWorld(object):
+    '''
+    All the simulated SoCal hardware and its environment on one clock
+    '''
+
+    def __init__(self, clock, loop, weather=None, dome_move_time=60., slew_rate=1.0, lock_time=30.,
+                 boot_time=30., lat=SITE_LAT, lon=SITE_LON):
+        self.clock   = clock
+        self.loop    = loop
+        self.sun     = SimSun(lat, lon)
+        self.weather = SimWeather() if weather is None else weather
+        self.dome    = SimDome(loop, lambda: self.changed(['ENCSTATUS']), move_time=dome_move_time)
+        self.tracker = SimTracker(clock, loop, self.sun, self.sun_visible,
+                                  lambda: self.changed(['EKOMODE', 'EKOHOME', 'EKOGUIDING']),
+                                  slew_rate=slew_rate, lock_time=lock_time)
+        self._services = []
+        self.pyr     = SimPyrheliometer(clock, self.sun, self.tracker, self.dome, self.weather)
+        self.power     = 'on' # Tracker relay, as EKOPOWER
+        self.boot_time = boot_time
+        self._boot     = None
+
+    def changed(self, keywords):
+        ''' A device changed state: broadcast the keywords (to their monitors) '''
+        for service in self._services:
+            service.refresh(keywords)
+
+    def sun_visible(self):
+        t = self.clock.time()
+        return self.dome.status == 'Open' and self.weather.is_safe(t) and self.sun.altitude(t) > 0
+
+    def eko_command(self, command):
+        if command == 'guide':
+            self.tracker.set_mode('3')
+        elif command in ['stow', 'home']:
+            self.tracker.stow()
+        else:
+            raise ValueError('Unknown EKOCMD {}'.format(command))
+
+    def tracker_power(self, state):
+        ''' The tracker's relay: powered off, it goes offline; powered on, it answers after boot_time '''
+        if self._boot is not None:
+            self._boot.cancel()
+            self._boot = None
+        self.tracker.online = False
+        self.power = 'booting' if state == 'on' else 'off'
+        if state == 'on':
+            self._boot = self.loop.call_later(self.boot_time, self._booted)
+        self.changed(['EKOONLINE', 'EKOPOWER'])
+
+    def _booted(self):
+        self._boot = None
+        self.tracker.online = True
+        self.power = 'on'
+        self.changed(['EKOONLINE', 'EKOPOWER'])
+
+    def service(self, name='kpfsocal'):
+        ''' kpfsocal keywords backed by the simulation (same names as localktl.dispatcher_service) '''
+        service = localktl.Service(name)
+        now = self.clock.time
+        service.define('ENCSTATUS', getter=lambda: self.dome.status)
+        service.define('ENCONLINE', getter=lambda: self.dome.online)
+        service.define('ENCCMD', setter=self.dome.command, value='')
+        service.define('EKOMODE', getter=lambda: self.tracker.mode, setter=self.tracker.set_mode)
+        service.define('EKOALT', getter=lambda: self.tracker.position()[0])
+        service.define('EKOAZ', getter=lambda: self.tracker.position()[1])
+        service.define('EKOHOME', getter=lambda: self.tracker.is_home)
+        service.define('EKOGUIDING', getter=lambda: self.tracker.on_sun)
+        service.define('EKOONLINE', getter=lambda: self.tracker.online)
+        service.define('EKOCMD', setter=self.eko_command, value='')
+        service.define('EKOPOWER', getter=lambda: self.power, setter=self.tracker_power)
+        service.define('SUNALT', getter=lambda: self.sun.position(now())[0])
+        service.define('SUNAZ', getter=lambda: self.sun.position(now())[1])
+        service.define('IRRADIANCE', getter=lambda: self.pyr.irradiance)
+        service.define('WXSAFE', getter=lambda: self.weather.is_safe(now()))
+        service.define('OPERATE', value=True)
+        service.define('LASTSTATE', value='PoweredOff')
+        self._services.append(service)
+        for t in self.weather.changes():
+            # Broadcast WXSAFE at every scripted weather change
+            self.loop.call_at(t, service.refresh, ['WXSAFE'])
+        return service
+
+def local_midnight(date, utc_offset=UTC_OFFSET):
+    ''' Unix time of local midnight at the start of `date` ('YYYY-MM-DD') '''
+    return ephemeris.date_midnight(date, utc_offset)
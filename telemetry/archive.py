@@ -0,0 +1,296 @@
+############################################################
+#
+#  archive.py
+#
+#  Append-only time-series archive for all dispatcher
+#  telemetry. Each device has a fixed schema; rows are
+#  buffered in memory and appended by a background thread to
+#  one raw binary file per column per UTC day:
+#
+#      <root>/<device>/<YYYYMMDD>/<column>.bin
+#
+#  so writes never wait on the disk and bulk reads are a
+#  handful of np.fromfile calls returning structured arrays.
+#
+############################################################
+
+import os
+import time
+import json
+import calendar
+import threading
+import numpy as np
+
+# Enumerations for the string-valued keywords
+DOME_STATUS  = {'Closed': 0, 'Open': 1, 'Opening': 2, 'Closing': 3, 'Unknown': 4}
+MOTOR_STATUS = {'Stopped': 0, 'Opening': 1, 'Closing': 2}
+SENSOR_STATE = {'off': 0, 'on': 1}
+
+# Fixed schema of each device. 'time' [unix] is always the first column
+SCHEMAS = {
+    'tracker': [('time', 'f8'),
+                ('tracking_mode', 'i1'),
+                ('current_alt', 'f4'), ('current_az', 'f4'),
+                ('pred_sun_alt', 'f4'), ('pred_sun_az', 'f4')],
+    'guiding': [('time', 'f8'),
+                ('guiding_offset_alt', 'f4'), ('guiding_offset_az', 'f4')], # Sun sensor, while guiding
+    'dome': [('time', 'f8'),
+             ('status', 'i1'), ('motor', 'i1'),
+             ('motor_current', 'f4'), ('motor_max', 'f4'), ('last_overcurrent', 'f4'),
+             ('open_left', 'i1'), ('open_right', 'i1'), ('close_left', 'i1'), ('close_right', 'i1'),
+             ('temp_inside', 'f4'), ('temp_outside', 'f4'), ('temp_ebox', 'f4'),
+             ('rain', 'i1'), ('light', 'i1'), ('power', 'i1')],
+    'pyrheliometer': [('time', 'f8'),
+                      ('irradiance', 'f4'), ('sensitivity', 'f4'),
+                      ('outputvolt', 'f4'), ('heater_temp', 'f4')],
+}
+
+def _code(table, value):
+    return table.get(value, -1)
+
+def flatten_dome(values):
+    ''' Flatten the nested `dome_status` dict from the dispatcher into dome schema columns '''
+    status  = values['dome_status']
+    motor   = status.get('Motor', {})
+    limits  = status.get('Limits', {})
+    temps   = status.get('Temperatures', {})
+    sensors = status.get('Sensors', {})
+    nan = float('nan')
+    return {'status'          : _code(DOME_STATUS, status.get('Status')),
+            'motor'           : _code(MOTOR_STATUS, motor.get('status')),
+            'motor_current'   : motor.get('current', nan),
+            'motor_max'       : motor.get('measured max', nan),
+            'last_overcurrent': motor.get('last overcurrent', nan),
+            'open_left'       : int(limits.get('open left', -1)),
+            'open_right'      : int(limits.get('open right', -1)),
+            'close_left'      : int(limits.get('close left', -1)),
+            'close_right'     : int(limits.get('close right', -1)),
+            'temp_inside'     : temps.get('inside', nan),
+            'temp_outside'    : temps.get('outside', nan),
+            'temp_ebox'       : temps.get('ebox', nan),
+            'rain'            : _code(SENSOR_STATE, sensors.get('rain')),
+            'light'           : _code(SENSOR_STATE, sensors.get('light')),
+            'power'           : _code(SENSOR_STATE, sensors.get('power')),
+           }
+
+# Per-device conversion of polled keyword values into schema columns
+FLATTEN = {'dome': flatten_dome}
+
+def _missing(dtype):
+    return float('nan') if np.dtype(dtype).kind == 'f' else -1
+
+def _convert(value, dtype):
+    ''' Cast a keyword value to its column type; unreadable values become NaN/-1 '''
+    try:
+        return float(value) if np.dtype(dtype).kind == 'f' else int(value)
+    except (TypeError, ValueError):
+        return _missing(dtype)
+
+
+class TelemetryArchive(object):
+    '''
+    Append-only, chunked (one chunk per device per UTC day), columnar
+    telemetry archive with background flushing.
+
+    Typical use, fed by the dispatcher's poller:
+        archive = TelemetryArchive('/data/socal/telemetry')
+        archive.start()
+        dispatcher.poller.subscribe(archive.listener)
+    '''
+
+    def __init__(self, root, flush_interval=10.):
+        self.root = root
+        self.flush_interval = flush_interval
+        self._buffers = {device: [] for device in SCHEMAS} # device -> list of row tuples
+        self._lock    = threading.Lock()     # Guards the buffers only
+        self._io_lock = threading.Lock()     # Serializes flushes
+        self._stop    = threading.Event()
+        self._thread  = None
+        for device, schema in SCHEMAS.items():
+            self._write_schema(device, schema)
+
+    def _write_schema(self, device, schema):
+        path = os.path.join(self.root, device)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'schema.json'), 'w') as f:
+            json.dump(schema, f)
+
+    ###################################### WRITING ######################################
+
+    def append(self, device, values, timestamp=None):
+        '''
+        Buffer one row of telemetry. Never touches the disk.
+
+        Args:
+            device:    (str) 'tracker', 'guiding', 'dome' or 'pyrheliometer'
+            values:    (dict) keyword values as polled by the dispatcher
+            timestamp: (float) unix time of the poll (default: now)
+        '''
+        schema = SCHEMAS[device]
+        if device in FLATTEN:
+            values = FLATTEN[device](values)
+        row = (time.time() if timestamp is None else timestamp,) + \
+              tuple(_convert(values.get(name), dtype) for name, dtype in schema[1:])
+        with self._lock:
+            self._buffers[device].append(row)
+
+    def listener(self, snapshot, device, values):
+        ''' TelemetryPoller listener: archive every successful poll (that read anything) '''
+        if device in SCHEMAS and values:
+            self.append(device, values, snapshot.timestamp)
+
+    def flush(self):
+        '''
+        Append all buffered rows to disk. Rows of a day that could not be written
+        go back to the front of the buffer for the next flush, then the error is raised
+        '''
+        error = None
+        with self._io_lock:
+            with self._lock:
+                buffers = self._buffers
+                self._buffers = {device: [] for device in SCHEMAS}
+            for device, rows in buffers.items():
+                if not rows:
+                    continue
+                table = np.array(rows, dtype=SCHEMAS[device])
+                days = (table['time']//86400).astype(np.int64)
+                for day in np.unique(days):
+                    try:
+                        self._write(device, day, table[days == day])
+                    except Exception as e:
+                        with self._lock:
+                            self._buffers[device][:0] = [row for row, d in zip(rows, days) if d >= day]
+                        error = error or e
+                        break
+        if error is not None:
+            raise error
+
+    def _write(self, device, day, rows):
+        # Append each column to that day's file, all or nothing: the columns are first cut back
+        # to their common length, so a write interrupted earlier (or now) leaves no ragged rows
+        path = os.path.join(self.root, device, time.strftime('%Y%m%d', time.gmtime(day*86400)))
+        os.makedirs(path, exist_ok=True)
+        self._align(path, rows.dtype)
+        try:
+            for name in rows.dtype.names:
+                with open(os.path.join(path, name + '.bin'), 'ab') as f:
+                    f.write(np.ascontiguousarray(rows[name]).tobytes())
+        except Exception:
+            try:
+                self._align(path, rows.dtype)
+            except OSError:
+                pass # Cut back before the next write instead
+            raise
+
+    @staticmethod
+    def _align(path, dtype):
+        ''' Truncate the column files of one day to the number of rows all of them hold '''
+        sizes = {}
+        for name in dtype.names:
+            column = os.path.join(path, name + '.bin')
+            sizes[name] = os.path.getsize(column) if os.path.exists(column) else 0
+        n = min(sizes[name]//dtype[name].itemsize for name in dtype.names)
+        for name in dtype.names:
+            if sizes[name] != n*dtype[name].itemsize:
+                os.truncate(os.path.join(path, name + '.bin'), n*dtype[name].itemsize)
+
+    def start(self):
+        ''' Start flushing in the background every `flush_interval` seconds '''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='telemetry-archive', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop the background thread and flush whatever is left '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print('Telemetry archive flush failed: {}'.format(repr(e)))
+
+    ###################################### READING ######################################
+
+    def query(self, device, t0=None, t1=None, fields=None):
+        '''
+        Read archived telemetry of one device
+
+        Args:
+            device: (str) 'tracker', 'guiding', 'dome' or 'pyrheliometer'
+            t0, t1: (float) unix time range [t0, t1) to return (default: everything)
+            fields: (list) columns to load, 'time' is always included (default: all)
+
+        Returns:
+            table: (np.ndarray) structured array sorted by time
+        '''
+        schema = dict(SCHEMAS[device])
+        names  = ['time'] + [f for f in (fields or list(schema)) if f != 'time']
+        dtype  = [(name, schema[name]) for name in names]
+        t0 = -np.inf if t0 is None else t0
+        t1 =  np.inf if t1 is None else t1
+
+        parts = []
+        device_dir = os.path.join(self.root, device)
+        with self._io_lock: # Don't read while rows are between the buffer and the disk
+            for day in sorted(os.listdir(device_dir)) if os.path.isdir(device_dir) else []:
+                if not day.isdigit():
+                    continue
+                # Skip whole days outside the requested range
+                day_start = calendar.timegm(time.strptime(day, '%Y%m%d'))
+                if day_start >= t1 or day_start + 86400 <= t0:
+                    continue
+                columns = {name: np.fromfile(os.path.join(device_dir, day, name + '.bin'), dtype=schema[name])
+                           for name in names}
+                parts.append(self._table(columns, dtype))
+
+            # Include rows that have not been flushed yet
+            with self._lock:
+                pending = list(self._buffers[device])
+        if pending:
+            pending = np.array(pending, dtype=SCHEMAS[device])
+            parts.append(self._table({name: pending[name] for name in names}, dtype))
+
+        if not parts:
+            return np.empty(0, dtype=dtype)
+        table = np.concatenate(parts)
+        table = table[(table['time'] >= t0) & (table['time'] < t1)]
+        return table[np.argsort(table['time'], kind='stable')]
+
+    @staticmethod
+    def _table(columns, dtype):
+        ''' Assemble columns into a structured array '''
+        n = min(len(c) for c in columns.values()) # A failed write not yet cut back leaves ragged columns
+        table = np.empty(n, dtype=dtype)
+        for name in columns:
+            table[name] = columns[name][:n]
+        return table
+
+    def asof(self, device, field, times, max_age=np.inf):
+        '''
+        Sample one column at the given times, using the latest value at or
+        before each time (NaN where there is none, or it is older than max_age).
+        E.g. the dome temperature at each sun sensor sample:
+
+            guiding = archive.query('guiding', t0, t1, ['guiding_offset_alt'])
+            temps   = archive.asof('dome', 'temp_inside', guiding['time'])
+        '''
+        times = np.asarray(times, dtype='f8')
+        if len(times) == 0:
+            return np.empty(0)
+        table = self.query(device, times.min() - max_age if np.isfinite(max_age) else None,
+                           np.nextafter(times.max(), np.inf), [field])
+        idx = np.searchsorted(table['time'], times, side='right') - 1
+        values = np.full(len(times), np.nan)
+        ok = idx >= 0
+        values[ok] = table[field][idx[ok]]
+        ok[ok] &= (times[ok] - table['time'][idx[ok]]) <= max_age
+        values[~ok] = np.nan
+        return values
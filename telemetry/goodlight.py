@@ -0,0 +1,226 @@
+############################################################
+#
+#  goodlight.py
+#
+#  Per-second good-light mask for the KPF pipeline: which
+#  seconds had the dome open, the tracker locked on the Sun
+#  and clear-sky direct normal irradiance. The three come
+#  from different devices, at different cadences and with
+#  their own timestamps; GoodLightJoin aligns them on a
+#  one-second grid with as-of semantics (each second takes
+#  the latest sample of each signal at or before it, unless
+#  older than MAX_AGE) and emits one byte of quality bits
+#  per second, as soon as every signal has moved past it.
+#  GoodLightMask keeps the bytes in one file per UTC day,
+#  byte i being second i of the day, so appending is a
+#  write at an offset and any window is one slice:
+#
+#      mask = GoodLightMask('/data/socal/goodlight')
+#      times, bits = mask.query(exposure_start, exposure_end)
+#      good = (bits & GOOD) == GOOD
+#
+############################################################
+
+import os
+import time
+import threading
+import numpy as np
+
+# Quality bits. A *_KNOWN bit is set when that signal had a recent enough sample;
+# the state bit is only meaningful (and only set) when its signal is known
+DOME_OPEN        = 0x01
+ON_SUN           = 0x02
+CLEAR_SKY        = 0x04
+DOME_KNOWN       = 0x08
+TRACKER_KNOWN    = 0x10
+IRRADIANCE_KNOWN = 0x20
+GOOD             = DOME_OPEN | ON_SUN | CLEAR_SKY
+
+SIGNALS  = ('dome_open', 'on_sun', 'irradiance')
+MAX_AGE  = {'dome_open': 5., 'on_sun': 5., 'irradiance': 5.} # [s] older samples count as unknown
+CLEAR_SKY_FRACTION = 0.7     # of the clear-sky model DNI
+DNI_MAX  = 1100.             # [W/m^2] top of the clear-sky model (as in sim.world)
+DAY      = 86400
+
+def clear_sky_dni(alt):
+    ''' Clear-sky direct normal irradiance [W/m^2] at Sun altitude(s) `alt` [deg] (Meinel, airmass 1/sin(alt)) '''
+    alt = np.asarray(alt, dtype=float)
+    sin_alt = np.sin(np.radians(np.maximum(alt, 0.1)))
+    return np.where(alt > 0, DNI_MAX*0.7**((1./sin_alt)**0.678), 0.)
+
+
+class GoodLightMask(object):
+    '''
+    The per-second quality bytes, one file per UTC day under `root`
+    (YYYYMMDD.bin, 86400 bytes); seconds never written read as 0 (unknown)
+    '''
+
+    def __init__(self, root):
+        self.root  = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, day):
+        return os.path.join(self.root, time.strftime('%Y%m%d', time.gmtime(day*DAY)) + '.bin')
+
+    def append(self, start, bits):
+        '''
+        Write the quality bytes of consecutive seconds from `start` (unix, whole second)
+
+        Args:
+            start: (int) first second
+            bits:  (uint8 array) one byte per second
+        '''
+        bits = np.asarray(bits, dtype=np.uint8)
+        start = int(start)
+        with self._lock:
+            while len(bits):
+                day, offset = divmod(start, DAY)
+                chunk = bits[:DAY - offset]
+                path = self._path(day)
+                with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+                    f.seek(offset)
+                    f.write(chunk.tobytes())
+                start += len(chunk)
+                bits = bits[len(chunk):]
+
+    def query(self, t0, t1):
+        '''
+        The quality bytes of every second in [t0, t1)
+
+        Returns: (times, bits) arrays: whole unix seconds, and their uint8 quality bits
+        '''
+        s0, s1 = int(np.floor(t0)), int(np.ceil(t1))
+        bits = np.zeros(max(s1 - s0, 0), dtype=np.uint8)
+        with self._lock:
+            for day in range(s0//DAY, (s1 - 1)//DAY + 1):
+                path = self._path(day)
+                if not os.path.exists(path):
+                    continue
+                lo, hi = max(s0, day*DAY), min(s1, (day + 1)*DAY)
+                data = np.fromfile(path, dtype=np.uint8, count=hi - day*DAY)
+                part = data[lo - day*DAY:]
+                bits[lo - s0:lo - s0 + len(part)] = part
+        return np.arange(s0, s1, dtype=np.int64), bits
+
+    def good_seconds(self, t0, t1, require=GOOD):
+        ''' Number of seconds in [t0, t1) with all the `require` bits set '''
+        return int(np.count_nonzero((self.query(t0, t1)[1] & require) == require))
+
+
+class GoodLightJoin(object):
+    '''
+    Streaming as-of join of the dome, tracker and pyrheliometer signals onto
+    whole seconds. Samples of each signal must arrive in time order; the
+    signals need not be in step. A second is emitted once every signal has a
+    sample after it, or once it is MAX_AGE old for the signals that went quiet
+    (a sample that late could not have counted anyway).
+    '''
+
+    def __init__(self, mask=None, max_age=None, clear_fraction=CLEAR_SKY_FRACTION, clock=time.time,
+                 sun_altitude=None):
+        '''
+        Args:
+            mask:           (GoodLightMask) where to append the bytes, or None (see listeners)
+            max_age:        (dict) signal -> seconds a sample stays valid (default MAX_AGE)
+            clear_fraction: clear sky if the irradiance is at least this fraction of the model
+            clock:          callable returning the current (unix) time
+            sun_altitude:   callable returning the Sun altitude [deg] for an array of unix
+                            times (default: control.ephemeris at the SoCal site)
+        '''
+        self.mask = mask
+        self.max_age = dict(MAX_AGE, **(max_age or {}))
+        self.clear_fraction = clear_fraction
+        self.clock = clock
+        if sun_altitude is None:
+            from control import ephemeris
+            sun_altitude = lambda t: ephemeris.sun_position(t)[0]
+        self.sun_altitude = sun_altitude
+        self.listeners = [] # Called with (start second, bits) for every emitted run
+        self.next      = None # First second not emitted yet
+        self._samples  = {signal: ([], []) for signal in SIGNALS} # signal -> (times, values), since `next`
+        self._latest   = {signal: None for signal in SIGNALS}     # signal -> time of its latest sample
+        self._lock     = threading.Lock()
+
+    def add(self, signal, t, value):
+        '''
+        A new sample of a signal: 'dome_open' and 'on_sun' (bools) or 'irradiance' [W/m^2]
+
+        Returns: (start, bits) of the seconds emitted as a result, or None
+        '''
+        with self._lock:
+            times, values = self._samples[signal]
+            if self._latest[signal] is not None and t < self._latest[signal]:
+                return None # Out of order, as-of would be ambiguous
+            times.append(t)
+            values.append(float(value) if value is not None else np.nan)
+            self._latest[signal] = t
+            if self.next is None:
+                self.next = int(np.floor(t))
+        return self.flush()
+
+    def flush(self, now=None):
+        '''
+        Emit every second that no sample still to come could change
+
+        Returns: (start, bits) of the seconds emitted, or None
+        '''
+        now = self.clock() if now is None else now
+        with self._lock:
+            if self.next is None:
+                return None
+            # Second s is final when each signal either has a sample after s, or s is older
+            # than that signal's MAX_AGE (later samples at or before s are out of order)
+            horizon = min(max(self._latest[signal] if self._latest[signal] is not None else -np.inf,
+                              now - self.max_age[signal]) for signal in SIGNALS)
+            end = int(np.floor(horizon)) # Seconds [next, end) are final
+            if end <= self.next:
+                return None
+            start = self.next
+            bits = self._join(np.arange(start, end, dtype=np.float64))
+            self.next = end
+            self._trim(end)
+        if self.mask is not None:
+            self.mask.append(start, bits)
+        for listener in list(self.listeners):
+            listener(start, bits)
+        return start, bits
+
+    def _asof(self, signal, grid):
+        ''' Latest value of a signal at or before each grid time, NaN if none or too old '''
+        times, values = self._samples[signal]
+        out = np.full(len(grid), np.nan)
+        if not times:
+            return out
+        times, values = np.asarray(times), np.asarray(values)
+        idx = np.searchsorted(times, grid, side='right') - 1
+        ok = idx >= 0
+        ok[ok] = grid[ok] - times[idx[ok]] <= self.max_age[signal]
+        out[ok] = values[idx[ok]]
+        return out
+
+    def _join(self, grid):
+        dome, sun, irradiance = (self._asof(signal, grid) for signal in SIGNALS)
+        bits = np.zeros(len(grid), dtype=np.uint8)
+        known = ~np.isnan(dome)
+        bits[known] |= DOME_KNOWN
+        bits[known & (dome == 1)] |= DOME_OPEN
+        known = ~np.isnan(sun)
+        bits[known] |= TRACKER_KNOWN
+        bits[known & (sun == 1)] |= ON_SUN
+        known = ~np.isnan(irradiance)
+        bits[known] |= IRRADIANCE_KNOWN
+        clear = np.zeros(len(grid), dtype=bool)
+        if known.any():
+            model = clear_sky_dni(self.sun_altitude(grid[known]))
+            clear[known] = (model > 0) & (irradiance[known] >= self.clear_fraction*model)
+        bits[clear] |= CLEAR_SKY
+        return bits
+
+    def _trim(self, end):
+        ''' Drop samples no second from `end` on needs: keep the last one before it for the as-of '''
+        for signal, (times, values) in self._samples.items():
+            keep = int(np.searchsorted(times, end, side='right')) - 1
+            if keep > 0:
+                del times[:keep]
+                del values[:keep]
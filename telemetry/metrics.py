@@ -0,0 +1,250 @@
+############################################################
+#
+#  metrics.py
+#
+#  Low-overhead device command metrics: per-command latency
+#  histograms, error/timeout counters and bytes on the wire.
+#  Exported in Prometheus text format over a local HTTP
+#  endpoint, or dumped to a file.
+#
+############################################################
+
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Latency bucket upper bounds [s], from 1 ms up to a minute (DomeGuard moves are slow)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Bucket upper bounds [s] for slow operations, from 5 s up to half an hour
+# (e.g. locking on the Sun after a slew, or power cycling the tracker)
+SLOW_BUCKETS = (5.0, 10.0, 20.0, 30.0, 60.0, 90.0, 120.0, 180.0, 300.0, 600.0, 900.0, 1200.0, 1800.0)
+
+# Port for the local /metrics endpoint
+METRICS_PORT = 9108
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    ''' Cumulative-bucket histogram, as in Prometheus '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0]*(len(self.buckets) + 1) # Last bin is +Inf
+        self.sum     = 0.
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Estimate the q-th quantile (0 < q < 1) by interpolating within the
+        bucket it falls in. Returns nan if nothing has been observed.
+        '''
+        if self.count == 0:
+            return float('nan')
+        rank = q*self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                lo = 0. if i == 0 else self.buckets[i-1]
+                if i == len(self.buckets):
+                    return lo
+                return lo + (self.buckets[i] - lo)*(rank - seen)/n
+            seen += n
+        return self.buckets[-1]
+
+
+class MetricsRegistry(object):
+    '''
+    Holds every counter and histogram, keyed by metric name and labels
+    '''
+
+    def __init__(self):
+        self._lock       = threading.Lock()
+        self._help       = {} # name -> (type, help)
+        self._counters   = {} # (name, labels) -> float
+        self._histograms = {} # (name, labels) -> Histogram
+        self._buckets    = {} # name -> bucket upper bounds of a histogram, if not LATENCY_BUCKETS
+
+    def describe(self, name, kind, help, buckets=None):
+        self._help[name] = (kind, help)
+        if buckets is not None:
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, amount=1, **labels):
+        ''' Increment a counter '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        ''' Add an observation to a histogram '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    ############################### Device command helpers ###############################
+
+    def record_command(self, device, command, seconds, sent=0, received=0, error=False, timeout=False):
+        '''
+        Record one device command
+
+        Args:
+            device:   (str) 'dome', 'tracker' or 'pyrheliometer'
+            command:  (str) command name, e.g. 'MR' or 'status'
+            seconds:  (float) latency of the command
+            sent:     (int) bytes written to the device
+            received: (int) bytes read back from the device
+            error:    (bool) the device rejected the command or returned garbage
+            timeout:  (bool) the device did not answer in time
+        '''
+        labels = (('command', command), ('device', device))
+        with self._lock:
+            histogram = self._histograms.get(('socal_command_latency_seconds', labels))
+            if histogram is None:
+                histogram = self._histograms[('socal_command_latency_seconds', labels)] = Histogram()
+            histogram.observe(seconds)
+            for name, amount in (('socal_command_bytes_sent_total', sent),
+                                 ('socal_command_bytes_received_total', received),
+                                 ('socal_command_errors_total', int(error)),
+                                 ('socal_command_timeouts_total', int(timeout))):
+                if amount:
+                    self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    @contextmanager
+    def timed(self, device, command):
+        '''
+        Time a block of device I/O. The yielded dict can be filled in with
+        'sent'/'received' byte counts and 'error'; exceptions count as errors
+        (or timeouts if they look like one) and are re-raised.
+        '''
+        stats = {'sent': 0, 'received': 0, 'error': False, 'timeout': False}
+        t0 = time.perf_counter()
+        try:
+            yield stats
+        except Exception as e:
+            if isinstance(e, TimeoutError) or 'timeout' in type(e).__name__.lower():
+                stats['timeout'] = True
+            else:
+                stats['error'] = True
+            raise
+        finally:
+            self.record_command(device, command, time.perf_counter() - t0, **stats)
+
+    ###################################### EXPORT ######################################
+
+    def render(self):
+        ''' Return all metrics in the Prometheus text exposition format '''
+        with self._lock:
+            counters   = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count, h.buckets))
+                                for key, h in self._histograms.items())
+        lines = []
+        described = set()
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                kind, help = self._help.get(name, (kind, name))
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(list(buckets) + [float('inf')], counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', _format_value(float(bound))),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(total)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        ''' Write the metrics to `path` (atomically, so a scraper never sees half a file) '''
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port=METRICS_PORT, host='127.0.0.1'):
+        '''
+        Serve the metrics at http://host:port/metrics from a background thread
+
+        Returns:
+            server: (http.server.ThreadingHTTPServer) call server.shutdown() to stop
+        '''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Don't print every scrape
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+        thread.start()
+        print('Serving SoCal metrics at http://{}:{}/metrics'.format(host, server.server_address[1]))
+        return server
+
+
+# Registry shared by all device drivers
+REGISTRY = MetricsRegistry()
+REGISTRY.describe('socal_command_latency_seconds', 'histogram', 'Latency of device commands')
+REGISTRY.describe('socal_command_bytes_sent_total', 'counter', 'Bytes written to the device')
+REGISTRY.describe('socal_command_bytes_received_total', 'counter', 'Bytes read back from the device')
+REGISTRY.describe('socal_command_errors_total', 'counter', 'Commands that were rejected or failed')
+REGISTRY.describe('socal_command_timeouts_total', 'counter', 'Commands that timed out')
+REGISTRY.describe('socal_overlap_seconds_saved_total', 'counter', 'Tracker slew time hidden behind the dome opening')
+REGISTRY.describe('socal_overlap_aborts_total', 'counter', 'Pre-positioned tracker sent home after a dome fault')
+REGISTRY.describe('socal_acquisition_seconds', 'histogram', 'Time from the guide command to locking on the Sun',
+                  buckets=SLOW_BUCKETS)
+REGISTRY.describe('socal_emergency_close_latency_seconds', 'histogram', 'Time from an unsafe signal to the dome close command')
+REGISTRY.describe('socal_emergency_closes_total', 'counter', 'Emergency dome closes, by reason')
+REGISTRY.describe('socal_recovery_seconds', 'histogram', 'Time from a device outage to its automated recovery',
+                  buckets=SLOW_BUCKETS)
+REGISTRY.describe('socal_recovery_incidents_total', 'counter', 'Automated recoveries attempted, by device and outcome')
+
+timed = REGISTRY.timed
@@ -0,0 +1,249 @@
+############################################################
+#
+#  profiling.py
+#
+#  Opt-in profiling of a running SoCalDispatcher: a sampling
+#  profiler (stacks of every thread, read with
+#  sys._current_frames() from a background thread, so the
+#  profiled threads are not slowed down), time and memory
+#  allocated by every device call (tracemalloc), and how
+#  often each dispatcher property is read. Everything goes
+#  to one JSON dump to analyse offline:
+#
+#      dispatcher.start_profiling()
+#      ...
+#      dispatcher.stop_profiling('socal-profile.json')
+#
+#      python -m telemetry.profiling socal-profile.json
+#
+#  or set SOCAL_PROFILE=/path/to/dir before CreateDispatcher()
+#  to profile from the start and dump at shutdown. While
+#  profiling is off, device calls and property reads only
+#  check that no profiler is attached.
+#
+############################################################
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005 # [s] between stack samples
+STACK_DEPTH     = 64    # frames kept per sampled stack
+MEMORY_FRAMES   = 10    # frames kept per allocation by tracemalloc
+TOP_ALLOCATIONS = 50    # allocation sites in the dump
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno)
+
+def fold(frame, depth=STACK_DEPTH):
+    ''' A stack as 'outermost;...;innermost' (the folded format of flame graph tools) '''
+    names = []
+    while frame is not None and len(names) < depth:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler(object):
+    '''
+    Samples the stacks of every thread but its own, and accounts device calls
+    and property reads reported to it (device_call, count) while running.
+    '''
+
+    def __init__(self, interval=SAMPLE_INTERVAL, memory=True, path=None):
+        '''
+        Args:
+            interval: (float) seconds between stack samples
+            memory:   (bool) trace allocations with tracemalloc (slows down every
+                      allocation in the process while profiling)
+            path:     (str) file to dump to when stopped
+        '''
+        self.interval   = interval
+        self.memory     = memory
+        self.path       = path
+        self.samples    = Counter() # 'thread;frame;...' -> samples
+        self.properties = Counter() # property -> reads
+        self.calls      = {}        # 'device.function' -> [calls, seconds, max seconds, bytes allocated, errors]
+        self.started    = None
+        self.stopped    = None
+        self._lock      = threading.Lock()
+        self._stop      = threading.Event()
+        self._thread    = None
+        self._baseline  = None  # tracemalloc snapshot at start
+        self._final     = None  # ... and at stop
+        self._own_trace = False # tracemalloc was started here (and is stopped here)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return self
+        self.started, self.stopped = time.time(), None
+        if self.memory:
+            self._own_trace = not tracemalloc.is_tracing()
+            if self._own_trace:
+                tracemalloc.start(MEMORY_FRAMES)
+            self._baseline = tracemalloc.take_snapshot()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop sampling, and dump to `path` if one was given '''
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.stopped = time.time()
+        if self.memory and tracemalloc.is_tracing():
+            self._final = tracemalloc.take_snapshot()
+            if self._own_trace:
+                tracemalloc.stop()
+        if self.path:
+            self.dump(self.path)
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [(names.get(ident, str(ident)), fold(frame))
+                      for ident, frame in sys._current_frames().items() if ident != me]
+            with self._lock:
+                for name, stack in stacks:
+                    self.samples['{};{}'.format(name, stack)] += 1
+
+    ###################################### Hooks ######################################
+    def count(self, name):
+        ''' A property was read '''
+        self.properties[name] += 1 # Counter updates are atomic enough for counting under the GIL
+
+    def device_call(self, device, fn, args, kwargs):
+        '''
+        Run a device call (on its worker thread), timing it and the memory it
+        allocated. The memory is the change of everything traced by tracemalloc
+        during the call, so calls on other threads at the same time show up too.
+        '''
+        name = '{}.{}'.format(device, getattr(fn, '__name__', type(fn).__name__))
+        tracing = self.memory and tracemalloc.is_tracing()
+        before = tracemalloc.get_traced_memory()[0] if tracing else 0
+        start = time.perf_counter()
+        error = False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            allocated = tracemalloc.get_traced_memory()[0] - before if tracing else 0
+            with self._lock:
+                stats = self.calls.setdefault(name, [0, 0., 0., 0, 0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+                stats[3] += allocated
+                stats[4] += error
+
+    ###################################### Dump ######################################
+    def allocations(self, limit=TOP_ALLOCATIONS):
+        ''' Allocation sites that grew the most between start and stop (or now) '''
+        if self._baseline is None:
+            return []
+        final = self._final
+        if final is None:
+            if not tracemalloc.is_tracing():
+                return []
+            final = tracemalloc.take_snapshot()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        diff = final.filter_traces(ignore).compare_to(self._baseline.filter_traces(ignore), 'traceback')
+        return [{'site': '{}:{}'.format(stat.traceback[-1].filename, stat.traceback[-1].lineno),
+                 'size_diff': stat.size_diff, 'size': stat.size, 'count_diff': stat.count_diff,
+                 'traceback': stat.traceback.format()} for stat in diff[:limit]]
+
+    def report(self):
+        with self._lock:
+            samples = dict(self.samples)
+            calls = {name: {'calls': n, 'seconds': total, 'max_seconds': worst, 'bytes': allocated, 'errors': errors}
+                     for name, (n, total, worst, allocated, errors) in self.calls.items()}
+        return {'started': self.started, 'stopped': self.stopped, 'interval': self.interval,
+                'samples': samples, 'device_calls': calls, 'properties': dict(self.properties),
+                'allocations': self.allocations()}
+
+    def dump(self, path):
+        ''' Write everything collected so far as JSON '''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f)
+        return path
+
+
+def count_properties(cls):
+    '''
+    Count the reads of every property of `cls` with the profiler of the
+    instance (its `profiler` attribute), if it has one. Installed once, on the
+    first profiled instance: until then the properties are untouched.
+    '''
+    if cls.__dict__.get('_counted_properties'):
+        return
+    for name, prop in list(vars(cls).items()):
+        if isinstance(prop, property) and prop.fget is not None:
+            def fget(obj, _get=prop.fget, _name=name):
+                profiler = getattr(obj, 'profiler', None)
+                if profiler is not None:
+                    profiler.count(_name)
+                return _get(obj)
+            setattr(cls, name, property(fget, prop.fset, prop.fdel, prop.__doc__))
+    cls._counted_properties = True
+
+
+def main(argv=None):
+    ''' Summarize a profile dump '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize a SoCal profile dump')
+    parser.add_argument('dump', help='JSON file written by Profiler.dump')
+    parser.add_argument('-n', '--top', type=int, default=15, help='rows per table')
+    parser.add_argument('--folded', help='also write the samples in folded format (for flamegraph.pl, speedscope)')
+    args = parser.parse_args(argv)
+    with open(args.dump) as f:
+        report = json.load(f)
+
+    samples = report['samples']
+    total = sum(samples.values()) or 1
+    own = Counter()
+    for stack, n in samples.items():
+        own[stack.rsplit(';', 1)[-1]] += n
+    print('{} samples every {:.0f} ms'.format(sum(samples.values()), 1e3*report['interval']))
+    print('\n{:>7}  {}'.format('self', 'frame'))
+    for frame, n in own.most_common(args.top):
+        print('{:>6.1%}  {}'.format(n/total, frame))
+
+    print('\n{:<40} {:>8} {:>10} {:>10} {:>12} {:>6}'.format('device call', 'calls', 'mean [ms]', 'max [ms]',
+                                                          'bytes', 'errors'))
+    calls = sorted(report['device_calls'].items(), key=lambda item: -item[1]['seconds'])
+    for name, c in calls[:args.top]:
+        print('{:<40} {:>8} {:>10.2f} {:>10.2f} {:>12} {:>6}'.format(
+            name, c['calls'], 1e3*c['seconds']/c['calls'], 1e3*c['max_seconds'], c['bytes'], c['errors']))
+
+    print('\n{:<40} {:>8}'.format('property', 'reads'))
+    for name, n in Counter(report['properties']).most_common(args.top):
+        print('{:<40} {:>8}'.format(name, n))
+
+    if report['allocations']:
+        print('\n{:>12} {:>8}  {}'.format('grew [B]', 'blocks', 'allocated at'))
+        for stat in report['allocations'][:args.top]:
+            print('{:>12} {:>8}  {}'.format(stat['size_diff'], stat['count_diff'], stat['site']))
+
+    if args.folded:
+        with open(args.folded, 'w') as f:
+            for stack, n in samples.items():
+                f.write('{} {}\n'.format(stack, n))
+
+if __name__ == '__main__':
+    main()
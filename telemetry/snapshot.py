@@ -0,0 +1,242 @@
+############################################################
+#
+#  snapshot.py
+#
+#  Background telemetry poller for the SoCal devices.
+#  Each device is polled in its own thread at its own cadence
+#  and the results are published as an immutable, timestamped
+#  Snapshot that keyword reads can serve without device I/O.
+#
+############################################################
+
+import time
+import threading
+from types import MappingProxyType
+from collections import namedtuple
+from concurrent.futures import CancelledError
+
+# A single keyword value and the (unix) time it was read from its device
+Reading = namedtuple('Reading', ['value', 'timestamp', 'device'])
+
+class Snapshot(object):
+    '''
+    Immutable view of the most recent value of every polled keyword.
+    A new Snapshot is published after each device poll; readers just
+    grab the current one and never see a partially updated set.
+    '''
+
+    __slots__ = ('_readings', '_errors', '_timestamp')
+
+    def __init__(self, readings=None, errors=None, timestamp=None):
+        object.__setattr__(self, '_readings', MappingProxyType(dict(readings or {})))
+        object.__setattr__(self, '_errors', MappingProxyType(dict(errors or {})))
+        object.__setattr__(self, '_timestamp', timestamp)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Snapshot is immutable')
+
+    def __contains__(self, keyword):
+        return keyword in self._readings
+
+    def __getitem__(self, keyword):
+        return self._readings[keyword].value
+
+    def __len__(self):
+        return len(self._readings)
+
+    @property
+    def timestamp(self):
+        ''' Time [unix] of the poll that produced this snapshot '''
+        return self._timestamp
+
+    @property
+    def errors(self):
+        ''' Last poll error of each device (None if its last poll succeeded) '''
+        return self._errors
+
+    def keywords(self):
+        return list(self._readings)
+
+    def get(self, keyword, default=None):
+        reading = self._readings.get(keyword)
+        return default if reading is None else reading.value
+
+    def reading(self, keyword):
+        ''' Return the Reading (value, timestamp, device) for a keyword, or None '''
+        return self._readings.get(keyword)
+
+    def age(self, keyword, now=None):
+        ''' Seconds since `keyword` was last read from its device (inf if never read) '''
+        reading = self._readings.get(keyword)
+        if reading is None:
+            return float('inf')
+        return (time.time() if now is None else now) - reading.timestamp
+
+    def read(self, keyword, now=None):
+        '''
+        Returns:
+            value: latest value of `keyword` (None if never read)
+            age:   (float) staleness of that value in seconds
+        '''
+        reading = self._readings.get(keyword)
+        if reading is None:
+            return None, float('inf')
+        return reading.value, (time.time() if now is None else now) - reading.timestamp
+
+    def updated(self, device, values, timestamp, error=None):
+        ''' Return a new Snapshot with the values from one device poll merged in '''
+        readings = dict(self._readings)
+        for keyword, value in values.items():
+            readings[keyword] = Reading(value, timestamp, device)
+        errors = dict(self._errors)
+        errors[device] = error
+        return Snapshot(readings, errors, timestamp)
+
+
+class TelemetryPoller(object):
+    '''
+    Poll a set of devices, each at its own cadence, and publish the
+    results as Snapshots.
+
+    A device is registered with a poll function that returns a dict
+    of {keyword: value}. If the poll raises, the previous values are
+    kept (and simply age) and the error is recorded in the snapshot.
+    '''
+
+    # Seconds stop() waits in all for the polling threads to finish
+    STOP_TIMEOUT = 5.
+
+    def __init__(self):
+        self._devices   = {} # name -> {'poll': fn, 'cadence': seconds, 'wake': Event, 'thread': Thread}
+        self._snapshot  = Snapshot()
+        self._lock      = threading.Lock() # Serializes publishing, reads are lock-free
+        self._listeners = []
+        self._stop      = threading.Event()
+        self._running   = False
+
+    def add_device(self, name, poll, cadence):
+        '''
+        Register a device to be polled
+
+        Args:
+            name:    (str) device name, e.g. 'tracker'
+            poll:    (callable) returns a dict of {keyword: value}
+            cadence: (float) seconds between the start of consecutive polls
+        '''
+        assert cadence > 0, 'Poll cadence must be positive, got {}'.format(cadence)
+        self._devices[name] = {'poll': poll, 'cadence': float(cadence),
+                               'wake': threading.Event(), 'thread': None}
+        if self._running:
+            self._start_device(name)
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    def cadence(self, name):
+        return self._devices[name]['cadence']
+
+    def set_cadence(self, name, cadence):
+        ''' Change how often a device is polled; takes effect immediately '''
+        assert cadence > 0, 'Poll cadence must be positive, got {}'.format(cadence)
+        self._devices[name]['cadence'] = float(cadence)
+        self._devices[name]['wake'].set()
+
+    def subscribe(self, listener):
+        '''
+        Call `listener(snapshot, device, values)` after every successful poll.
+        Listeners run in the polling thread of that device, so keep them short.
+        '''
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    @property
+    def snapshot(self):
+        ''' The current (immutable) snapshot '''
+        return self._snapshot
+
+    def read(self, keyword):
+        ''' Return (value, age in seconds) of a keyword from the current snapshot '''
+        return self._snapshot.read(keyword)
+
+    def publish(self, device, values, timestamp=None, error=None):
+        ''' Merge values into a new snapshot and notify listeners '''
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            snapshot = self._snapshot.updated(device, values, timestamp, error)
+            self._snapshot = snapshot
+        if error is None:
+            for listener in list(self._listeners):
+                try:
+                    listener(snapshot, device, values)
+                except Exception as e:
+                    print('Telemetry listener {} failed: {}'.format(listener, repr(e)))
+        return snapshot
+
+    def poll(self, name):
+        ''' Poll a device once, right now, and publish the result '''
+        device = self._devices[name]
+        try:
+            values = device['poll']()
+        except CancelledError:
+            return self._snapshot # Dropped to make way for an urgent request, poll again next time
+        except Exception as e:
+            print('Polling {} failed: {}'.format(name, repr(e)))
+            return self.publish(name, {}, error=repr(e))
+        return self.publish(name, values or {})
+
+    def poll_now(self, name):
+        ''' Ask the polling thread of a device to poll it immediately '''
+        self._devices[name]['wake'].set()
+
+    ###################################### THREADS ######################################
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        ''' Start one polling thread per device '''
+        if self._running:
+            return
+        self._stop.clear()
+        self._running = True
+        for name in self._devices:
+            self._start_device(name)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        '''
+        Stop polling and wait (at most `timeout` seconds in all) for the polling
+        threads to finish. A thread stuck in a hung device's poll is left behind:
+        it is a daemon and exits once the poll returns.
+        '''
+        self._running = False
+        self._stop.set()
+        for device in self._devices.values():
+            device['wake'].set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for name, device in self._devices.items():
+            thread = device['thread']
+            if thread is not None:
+                thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+                if thread.is_alive():
+                    print('Polling {} did not stop within {} s'.format(name, timeout))
+                device['thread'] = None
+
+    def _start_device(self, name):
+        thread = threading.Thread(target=self._run, args=(name,), name='poll-{}'.format(name), daemon=True)
+        self._devices[name]['thread'] = thread
+        thread.start()
+
+    def _run(self, name):
+        device = self._devices[name]
+        while not self._stop.is_set():
+            t_start = time.monotonic()
+            device['wake'].clear()
+            self.poll(name)
+            # Wait out the rest of the cadence, unless woken up early
+            delay = device['cadence'] - (time.monotonic() - t_start)
+            if delay > 0:
+                device['wake'].wait(delay)
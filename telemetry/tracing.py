@@ -0,0 +1,210 @@
+############################################################
+#
+#  tracing.py
+#
+#  Opt-in, high-resolution tracing of SoCal transitions.
+#  Spans (trigger, every machine callback, every KTL read
+#  and write) go into a bounded in-memory buffer and export
+#  as Chrome trace-event JSON, to open in chrome://tracing
+#  or https://ui.perfetto.dev
+#
+#      tracer = Tracer()
+#      socal = SoCal(tracer=tracer)
+#      ...
+#      tracer.export('socal-trace.json')
+#
+############################################################
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_CAPACITY = 100000 # spans kept (oldest dropped first)
+
+class Tracer(object):
+    '''
+    Bounded buffer of timed spans. Recording a span is a tuple append, so the
+    tracer can stay attached in operation; it does nothing while disabled.
+    '''
+
+    def __init__(self, capacity=TRACE_CAPACITY, clock=None, enabled=True):
+        '''
+        Args:
+            capacity: (int) most spans kept
+            clock:    callable returning integer nanoseconds (default time.perf_counter_ns);
+                      e.g. a virtual clock to trace simulated time
+            enabled:  (bool) record spans
+        '''
+        self.spans    = deque(maxlen=capacity) # (name, category, start_ns, end_ns, thread id, args)
+        self.now      = time.perf_counter_ns if clock is None else clock
+        self.enabled  = enabled
+        self._threads = {}
+
+    def __len__(self):
+        return len(self.spans)
+
+    def clear(self):
+        self.spans.clear()
+
+    def add(self, name, category, start, end, args=None):
+        ''' Record a span that ran from `start` to `end` (clock ns) on this thread '''
+        if self.enabled:
+            thread = threading.current_thread()
+            self._threads[thread.ident] = thread.name
+            self.spans.append((name, category, start, end, thread.ident, args))
+
+    @contextmanager
+    def span(self, name, category='', **args):
+        ''' Time the enclosed block '''
+        if not self.enabled:
+            yield
+            return
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, self.now(), args or None)
+
+    def wrap(self, fn, name, category='', args=None):
+        ''' `fn` with every call recorded as a span '''
+        def traced(*a, **k):
+            if not self.enabled:
+                return fn(*a, **k)
+            start = self.now()
+            try:
+                return fn(*a, **k)
+            finally:
+                self.add(name, category, start, self.now(), args)
+        return traced
+
+    def chrome_events(self):
+        ''' The spans as Chrome trace "complete" events (timestamps in us) '''
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in list(self._threads.items())]
+        for name, category, start, end, tid, args in list(self.spans):
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': start/1e3, 'dur': (end - start)/1e3}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return events
+
+    def export(self, path):
+        ''' Write the buffer as a Chrome trace JSON file '''
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.chrome_events(), 'displayTimeUnit': 'ms'}, f)
+        return path
+
+
+############################ State machine ############################
+def callback_phases(machine):
+    '''
+    Map each callback name registered on a transitions Machine to the phase
+    it runs in ('prepare', 'conditions', 'before', 'after', 'on_enter', ...)
+    '''
+    phases = {}
+    def note(callbacks, phase):
+        for callback in callbacks:
+            if isinstance(callback, str):
+                phases.setdefault(callback, phase)
+    for phase in ['prepare_event', 'before_state_change', 'after_state_change', 'finalize_event']:
+        note(getattr(machine, phase), phase)
+    for event in machine.events.values():
+        for transitions in event.transitions.values():
+            for transition in transitions:
+                note(transition.prepare, 'prepare')
+                note([condition.func for condition in transition.conditions], 'conditions')
+                note(transition.before, 'before')
+                note(transition.after, 'after')
+    for state in machine.states.values():
+        note(state.on_enter, 'on_enter')
+        note(state.on_exit, 'on_exit')
+    return phases
+
+def trace_machine(machine, tracer):
+    '''
+    Record a span for every trigger of `machine` and for every callback it
+    runs, named after the callback and categorized by its phase. Condition
+    properties are timed including their evaluation (and keyword reads).
+    '''
+    phases = callback_phases(machine)
+    resolve = machine.resolve_callable
+
+    def resolve_callable(func, event_data):
+        if not (tracer.enabled and isinstance(func, str)):
+            return resolve(func, event_data)
+        start = tracer.now() # Properties are evaluated while being resolved
+        callback = resolve(func, event_data)
+        def traced(*args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                tracer.add(func, phases.get(func, 'callback'), start, tracer.now(),
+                           {'event': event_data.event.name, 'state': event_data.state.name})
+        return traced
+    machine.resolve_callable = resolve_callable
+
+    for event in machine.events.values():
+        trigger = event._trigger
+        def _trigger(event_data, trigger=trigger, name=event.name):
+            if not tracer.enabled:
+                return trigger(event_data)
+            start = tracer.now()
+            source = machine.get_model_state(event_data.model).name
+            try:
+                return trigger(event_data)
+            finally:
+                tracer.add(name, 'trigger', start, tracer.now(),
+                           {'source': source, 'dest': machine.get_model_state(event_data.model).name,
+                            'result': bool(event_data.result)})
+        event._trigger = _trigger
+    return machine
+
+
+############################ KTL ############################
+class TracedKeyword(object):
+    ''' KTL keyword whose reads, writes and waits are recorded as spans '''
+
+    def __init__(self, keyword, tracer):
+        self._keyword = keyword
+        self._tracer  = tracer
+        self._name    = keyword['name']
+
+    def __getitem__(self, key):
+        return self._keyword[key]
+
+    def __getattr__(self, attr):
+        value = getattr(self._keyword, attr)
+        if attr in ['read', 'write', 'wait']:
+            return self._tracer.wrap(value, '{} {}'.format(attr, self._name), 'ktl')
+        return value
+
+class TracedService(object):
+    ''' KTL service (ktl.Service or localktl.Service) whose keyword I/O is traced '''
+
+    def __init__(self, service, tracer):
+        self._service  = service
+        self._tracer   = tracer
+        self._keywords = {}
+
+    def __getitem__(self, name):
+        keyword = self._keywords.get(name)
+        if keyword is None:
+            keyword = self._keywords[name] = TracedKeyword(self._service[name], self._tracer)
+        return keyword
+
+    def __contains__(self, name):
+        return name in self._service
+
+    def __getattr__(self, attr):
+        value = getattr(self._service, attr) # AttributeError if the service has no such method (e.g. read_many)
+        if attr == 'read_many':
+            def read_many(names, *args, **kwargs):
+                with self._tracer.span('read_many', 'ktl', keywords=list(names)):
+                    return value(names, *args, **kwargs)
+            return read_many
+        return value
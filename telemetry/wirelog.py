@@ -0,0 +1,412 @@
+############################################################
+#
+#  wirelog.py
+#
+#  Wire-level record and replay of the three device
+#  protocols: EKO tracker (raw TCP socket), DomeGuard
+#  (WebSocket text frames) and the MS-57 pyrheliometer
+#  (Modbus TCP via pymodbus).
+#
+#  Recording appends every frame sent and received, with its
+#  time.monotonic() timestamp, to a compact binary log per
+#  device and dispatcher (<dir>/<name>/<device>.wire). Replay serves those frames back to the unmodified
+#  drivers (and so to the dispatcher and SoCal), as fast as
+#  possible or at the original timing:
+#
+#      wirelog.record('/data/socal/wire')   # or SOCAL_WIRELOG=/data/socal/wire
+#      CreateDispatcher()
+#      ...
+#      wirelog.replay('/data/socal/wire', timing='original')
+#      CreateDispatcher()                  # same traffic, no hardware
+#
+#  Log format: MAGIC, then records of a 13 byte header
+#  (float64 time, uint8 kind, uint32 length) and the payload.
+#
+#      python -m telemetry.wirelog /data/socal/wire/socal/dome.wire
+#
+############################################################
+
+import os
+import time
+import struct
+import threading
+from collections import namedtuple
+
+MAGIC  = b'SOCALWIRE\x01'
+HEADER = struct.Struct('<dBI')
+
+# Record kinds
+SENT     = 0
+RECEIVED = 1
+TEXT     = 0x10 # Flag: the frame was a str (WebSocket text), not bytes
+
+DEVICES = ['tracker', 'dome', 'pyrheliometer']
+
+Frame = namedtuple('Frame', ['time', 'direction', 'data']) # data is bytes or str
+
+class ReplayMismatch(Exception):
+    ''' The driver sent something other than what was recorded (strict replay) '''
+
+
+############################ Log files ############################
+class WireLog(object):
+    ''' Append-only binary log of the frames on one device connection '''
+
+    def __init__(self, path):
+        self.path  = path
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if new:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def write(self, direction, data):
+        kind = direction
+        if isinstance(data, str):
+            kind |= TEXT
+            data = data.encode('utf-8')
+        with self._lock:
+            self._file.write(HEADER.pack(time.monotonic(), kind, len(data)))
+            self._file.write(data)
+            self._file.flush() # Keep the log useful after a crash
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def read_log(path):
+    ''' All the frames of a wire log, in order '''
+    with open(path, 'rb') as f:
+        blob = f.read()
+    assert blob.startswith(MAGIC), '{} is not a SoCal wire log'.format(path)
+    frames = []
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(blob):
+        t, kind, length = HEADER.unpack_from(blob, offset)
+        offset += HEADER.size
+        data = blob[offset:offset + length]
+        offset += length
+        if len(data) < length:
+            break # Truncated last record (e.g. crashed mid-write)
+        frames.append(Frame(t, kind & ~TEXT, data.decode('utf-8') if kind & TEXT else data))
+    return frames
+
+
+############################ Recording ############################
+class RecordingSocket(object):
+    ''' A socket (the tracker's) that logs what goes through it '''
+
+    def __init__(self, sock, log):
+        self._sock = sock
+        self._log  = log
+
+    def send(self, data, *args):
+        sent = self._sock.send(data, *args)
+        self._log.write(SENT, data[:sent])
+        return sent
+
+    def sendall(self, data, *args):
+        self._sock.sendall(data, *args)
+        self._log.write(SENT, data)
+
+    def recv(self, size, *args):
+        data = self._sock.recv(size, *args)
+        self._log.write(RECEIVED, data)
+        return data
+
+    def __getattr__(self, attr):
+        return getattr(self._sock, attr)
+
+class RecordingWebSocket(object):
+    ''' A websocket.WebSocket (the dome's) that logs every frame '''
+
+    def __init__(self, ws, log):
+        self._ws  = ws
+        self._log = log
+
+    def send(self, payload, *args, **kwargs):
+        result = self._ws.send(payload, *args, **kwargs)
+        self._log.write(SENT, payload)
+        return result
+
+    def recv(self):
+        payload = self._ws.recv()
+        self._log.write(RECEIVED, payload)
+        return payload
+
+    def __getattr__(self, attr):
+        return getattr(self._ws, attr)
+
+def recording_modbus_client(log):
+    ''' ModbusTcpClient class whose raw Modbus TCP frames are logged '''
+    from pymodbus.client.sync import ModbusTcpClient
+
+    class RecordingModbusTcpClient(ModbusTcpClient):
+        def _send(self, request):
+            sent = super()._send(request)
+            if request:
+                self._log.write(SENT, bytes(request))
+            return sent
+
+        def _recv(self, size):
+            data = super()._recv(size)
+            self._log.write(RECEIVED, bytes(data))
+            return data
+    RecordingModbusTcpClient._log = log
+    return RecordingModbusTcpClient
+
+
+############################ Replay ############################
+class Replay(object):
+    '''
+    Serves the received frames of a log back, in order, as the driver sends
+    the recorded requests.
+
+    Args:
+        frames: list of Frames (see read_log)
+        timing: 'fast' (no waiting) or 'original' (each reply takes as long
+                after the request as it did when recorded)
+        strict: raise ReplayMismatch if a request differs from the recording
+                (otherwise just count it in `mismatches`)
+        modbus: give replies the Modbus TCP transaction id of the live request
+    '''
+
+    def __init__(self, frames, timing='fast', strict=False, modbus=False):
+        assert timing in ['fast', 'original'], 'timing must be fast or original, got {}'.format(timing)
+        self.frames     = frames
+        self.timing     = timing
+        self.strict     = strict
+        self.modbus     = modbus
+        self.mismatches = 0
+        self._cursor    = 0
+        self._pending   = None # Rest of a received frame larger than the read
+        self._last      = None # (recorded time, replay time) of the last frame served
+        self._tid       = None # Transaction id of the last Modbus request
+        self._lock      = threading.Lock()
+
+    @property
+    def exhausted(self):
+        return self._cursor >= len(self.frames) and not self._pending
+
+    def _next(self, direction):
+        while self._cursor < len(self.frames):
+            frame = self.frames[self._cursor]
+            self._cursor += 1
+            if frame.direction == direction:
+                return frame
+            # A frame of the other direction was skipped: the driver diverged
+            self.mismatches += 1
+        raise EOFError('Wire log exhausted')
+
+    def _wait(self, frame):
+        if self.timing == 'original' and self._last is not None:
+            recorded, replayed = self._last
+            delay = (frame.time - recorded) - (time.monotonic() - replayed)
+            if delay > 0:
+                time.sleep(delay)
+        self._last = (frame.time, time.monotonic())
+
+    def send(self, data):
+        with self._lock:
+            frame = self._next(SENT)
+            self._last = (frame.time, time.monotonic())
+            if self.modbus:
+                self._tid = bytes(data[:2])
+                same = bytes(frame.data[2:]) == bytes(data[2:])
+            else:
+                same = frame.data == data
+            if not same:
+                self.mismatches += 1
+                if self.strict:
+                    raise ReplayMismatch('Sent {!r}, recorded {!r}'.format(data, frame.data))
+            return len(data)
+
+    def recv(self, size=None):
+        with self._lock:
+            if self._pending:
+                data, self._pending = self._pending[:size], self._pending[size:]
+                return data
+            frame = self._next(RECEIVED)
+            self._wait(frame)
+            data = frame.data
+            if self.modbus and self._tid is not None and len(data) >= 2:
+                data, self._tid = self._tid + bytes(data[2:]), None
+            if size is not None and len(data) > size:
+                data, self._pending = data[:size], data[size:]
+            return data
+
+class ReplaySocket(object):
+    ''' Socket stand-in serving a Replay (the tracker's) '''
+
+    def __init__(self, replay, peer=('replay', 0)):
+        self.replay = replay
+        self._peer  = peer
+
+    def connect(self, address):
+        self._peer = address
+
+    def getpeername(self):
+        return self._peer
+
+    def send(self, data, *args):
+        return self.replay.send(data)
+
+    def sendall(self, data, *args):
+        self.replay.send(data)
+
+    def recv(self, size, *args):
+        return self.replay.recv(size)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+class ReplayWebSocket(object):
+    ''' websocket.WebSocket stand-in serving a Replay (the dome's) '''
+
+    def __init__(self, replay):
+        self.replay    = replay
+        self.connected = False
+
+    def connect(self, url, **options):
+        self.connected = True
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, payload, *args, **kwargs):
+        return self.replay.send(payload)
+
+    def recv(self):
+        return self.replay.recv()
+
+    def close(self, *args, **kwargs):
+        self.connected = False
+
+def replay_modbus_client(replay):
+    ''' ModbusTcpClient class that talks to a Replay instead of a socket '''
+    from pymodbus.client.sync import ModbusTcpClient
+
+    class ReplayModbusTcpClient(ModbusTcpClient):
+        def connect(self):
+            self.socket = self.socket or ReplaySocket(replay, (self.host, self.port))
+            return True
+
+        def _send(self, request):
+            if not self.socket:
+                self.connect()
+            return replay.send(request) if request else 0
+
+        def _recv(self, size):
+            return replay.recv(size)
+    return ReplayModbusTcpClient
+
+
+############################ Drivers ############################
+_originals = {} # device -> (module, class) registered before record()/replay()
+_config    = {} # mode, directory and replay options
+
+def _log_path(directory, instance, device):
+    return os.path.join(directory, instance, '{}.wire'.format(device))
+
+def _register(mode, directory, **options):
+    import drivers
+    for device in DEVICES:
+        if device not in _originals:
+            _originals[device] = drivers.DRIVERS[device]
+        drivers.register(device, __name__, '{}_{}'.format(mode, device))
+    _config.update(mode=mode, directory=directory, **options)
+
+def record(directory):
+    '''
+    From now on, drivers created through the registry (e.g. by the dispatcher)
+    record their traffic to <directory>/<instance>/<device>.wire (appending),
+    <instance> being the name of the dispatcher they belong to (default 'socal')
+    '''
+    os.makedirs(directory, exist_ok=True)
+    _register('record', directory)
+
+def replay(directory, timing='fast', strict=False):
+    '''
+    From now on, drivers created through the registry are served the traffic
+    recorded in <directory>/<instance>/<device>.wire instead of talking to the
+    hardware. See Replay for `timing` and `strict`.
+    '''
+    _register('replay', directory, timing=timing, strict=strict)
+
+def restore():
+    ''' Go back to the drivers registered before record()/replay() '''
+    import drivers
+    for device, (module, cls) in _originals.items():
+        drivers.register(device, module, cls)
+    _originals.clear()
+    _config.clear()
+
+def _original(device):
+    import importlib
+    module, cls = _originals[device]
+    return getattr(importlib.import_module(module), cls)
+
+def _replay(instance, device, **options):
+    return Replay(read_log(_log_path(_config['directory'], instance, device)),
+                  timing=_config['timing'], strict=_config['strict'], **options)
+
+def _wirelog(instance, device):
+    path = _log_path(_config['directory'], instance, device)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return WireLog(path)
+
+# Driver factories registered by record() and replay(), one per device and mode. `instance`
+# is the name of the dispatcher the driver is created for (see drivers.create)
+def record_tracker(*args, instance='socal', **kwargs):
+    import socket
+    transport = RecordingSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), _wirelog(instance, 'tracker'))
+    return _original('tracker')(*args, transport=transport, **kwargs)
+
+def record_dome(*args, instance='socal', **kwargs):
+    import websocket
+    return _original('dome')(*args, transport=RecordingWebSocket(websocket.WebSocket(), _wirelog(instance, 'dome')),
+                             **kwargs)
+
+def record_pyrheliometer(*args, instance='socal', **kwargs):
+    return _original('pyrheliometer')(*args, transport=recording_modbus_client(_wirelog(instance, 'pyrheliometer')),
+                                      **kwargs)
+
+def replay_tracker(*args, instance='socal', **kwargs):
+    return _original('tracker')(*args, transport=ReplaySocket(_replay(instance, 'tracker')), **kwargs)
+
+def replay_dome(*args, instance='socal', **kwargs):
+    return _original('dome')(*args, transport=ReplayWebSocket(_replay(instance, 'dome')), **kwargs)
+
+def replay_pyrheliometer(*args, instance='socal', **kwargs):
+    return _original('pyrheliometer')(*args, transport=replay_modbus_client(_replay(instance, 'pyrheliometer',
+                                                                                   modbus=True)), **kwargs)
+
+
+def main(argv=None):
+    ''' Print the frames of wire logs '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Dump SoCal wire logs')
+    parser.add_argument('logs', nargs='+', help='.wire files')
+    parser.add_argument('--summary', action='store_true', help='only print frame and byte counts')
+    args = parser.parse_args(argv)
+    for path in args.logs:
+        frames = read_log(path)
+        sent = [f for f in frames if f.direction == SENT]
+        span = frames[-1].time - frames[0].time if frames else 0.
+        print('{}: {} frames sent ({} bytes), {} received ({} bytes) over {:.1f} s'.format(
+            path, len(sent), sum(len(f.data) for f in sent), len(frames) - len(sent),
+            sum(len(f.data) for f in frames if f.direction == RECEIVED), span))
+        if not args.summary:
+            for frame in frames:
+                print('{:12.6f} {} {!r}'.format(frame.time - frames[0].time,
+                                                '>' if frame.direction == SENT else '<', frame.data))
+
+if __name__ == '__main__':
+    main()